@@ -1,4 +1,8 @@
+import os
 import shutil
+import pytest
+
+from pydra.engine.helpers_file import file_hash_cache
 
 
 def pytest_addoption(parser):
@@ -23,3 +27,20 @@ def pytest_generate_tests(metafunc):
         else:
             Plugins = ["cf"]
         metafunc.parametrize("plugin", Plugins)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def hash_cache_db(tmp_path_factory):
+    """ the hashes of the files are stored in a temporary database
+        (also by the processes running the tasks), not in the cache of the user
+    """
+    path = tmp_path_factory.mktemp("hash_cache") / "file_hashes.sqlite"
+    orig_env, orig_path = os.environ.get("PYDRA_HASH_CACHE"), file_hash_cache.path
+    os.environ["PYDRA_HASH_CACHE"] = str(path)
+    file_hash_cache.path = path
+    yield path
+    file_hash_cache.path = orig_path
+    if orig_env is None:
+        del os.environ["PYDRA_HASH_CACHE"]
+    else:
+        os.environ["PYDRA_HASH_CACHE"] = orig_env
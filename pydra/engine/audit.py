@@ -48,7 +48,6 @@ class Audit:
         if self.audit_check(AuditFlag.PROV):
             self.aid = "uid:{}".format(gen_uuid())
             start_message = {"@id": self.aid, "@type": "task", "startedAtTime": now()}
-        os.chdir(self.odir)
         if self.audit_check(AuditFlag.PROV):
             self.audit_message(start_message, AuditFlag.PROV)
         if self.audit_check(AuditFlag.RESOURCE):
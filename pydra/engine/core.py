@@ -1,17 +1,20 @@
 """Basic processing graph elements."""
 import abc
+import asyncio
 import attr
 import json
 import logging
 import os
 from pathlib import Path
 import typing as ty
-from copy import deepcopy, copy
+from copy import copy
+from contextlib import contextmanager
 
 import cloudpickle as cp
-from filelock import SoftFileLock
+from filelock import SoftFileLock, Timeout
 import shutil
 from tempfile import mkdtemp
+from time import time
 
 from . import state
 from . import helpers_state as hlpst
@@ -30,14 +33,23 @@ from .helpers import (
     create_checksum,
     print_help,
     load_result,
+    enter_output_dir,
+    exit_output_dir,
     save,
     ensure_list,
     record_error,
     hash_function,
+    hash_value,
     output_from_inputfields,
     output_names_from_inputfields,
 )
-from .helpers_file import copyfile_input, template_update
+from .helpers_file import (
+    copyfile_input,
+    template_update,
+    get_hash_algorithm,
+    hash_algorithm,
+    resolve_hash_algorithm,
+)
 from .graph import DiGraph
 from .audit import Audit
 from ..utils.messenger import AuditFlag
@@ -68,9 +80,11 @@ class TaskBase:
 
     _can_resume = False  # Does the task allow resuming from previous state
     _redirect_x = False  # Whether an X session should be created/directed
+    _uses_cwd = True  # Whether the task can use paths relative to the working directory
 
     _runtime_requirements = RuntimeSpec()
     _runtime_hints = None
+    _hash_algorithm = None  # Hash algorithm of the checksums, the default if None
 
     _cache_dir = None  # Working directory in which to operate
     _references = None  # List of references for a task
@@ -182,6 +196,8 @@ class TaskBase:
 
         self.plugin = None
         self.hooks = TaskHook()
+        # instance copy, so the resources can be set for a single task
+        self._runtime_requirements = attr.evolve(self._runtime_requirements)
 
     def __str__(self):
         return self.name
@@ -196,6 +212,8 @@ class TaskBase:
                 k = k[1:]
             inputs[k] = v
         state["inputs"] = inputs
+        # the default algorithm of the process running the task could differ
+        state["_hash_algorithm"] = self.hash_algorithm
         return state
 
     def __setstate__(self, state):
@@ -215,6 +233,20 @@ class TaskBase:
         if returnhelp:
             return help_obj
 
+    @property
+    def hash_algorithm(self):
+        """
+        Get the hash algorithm used by the checksums of the task.
+
+        The default algorithm (see
+        :py:func:`~pydra.engine.helpers_file.set_hash_algorithm`) is used if not set.
+        """
+        return self._hash_algorithm or get_hash_algorithm()
+
+    @hash_algorithm.setter
+    def hash_algorithm(self, name):
+        self._hash_algorithm = resolve_hash_algorithm(name) if name else None
+
     @property
     def version(self):
         """Get version of this task structure."""
@@ -227,14 +259,16 @@ class TaskBase:
             and to create nodes checksums needed for graph checkums
             (before the tasks have inputs etc.)
         """
-        input_hash = self.inputs.hash
-        if self.state is None:
-            self._checksum = create_checksum(self.__class__.__name__, input_hash)
-        else:
-            splitter_hash = hash_function(self.state.splitter)
-            self._checksum = create_checksum(
-                self.__class__.__name__, hash_function([input_hash, splitter_hash])
-            )
+        with hash_algorithm(self._hash_algorithm):
+            input_hash = self.inputs.hash
+            if self.state is None:
+                self._checksum = create_checksum(self.__class__.__name__, input_hash)
+            else:
+                splitter_hash = hash_function(self.state.splitter)
+                self._checksum = create_checksum(
+                    self.__class__.__name__,
+                    hash_function([input_hash, splitter_hash]),
+                )
         return self._checksum
 
     def checksum_states(self, state_index=None):
@@ -243,37 +277,107 @@ class TaskBase:
         Replaces lists in the inputs fields with a specific values for states.
         Used to recreate names of the task directories,
 
+        Every element of the inputs used by the states is hashed once,
+        the checksums are cached in the state until the inputs
+        or the splitter change (or until the states, or the states
+        of the upstream tasks, are prepared again).
+
         Parameters
         ----------
-        state_index :
-            TODO
+        state_index : :obj:`int`
+            Index of the state, the checksums of all the states are returned if None.
 
         """
-        self.state.prepare_states(self.inputs)
-        self.state.prepare_inputs()
-        if state_index is not None:
-            inputs_copy = deepcopy(self.inputs)
-            for key, ind in self.state.inputs_ind[state_index].items():
-                setattr(
-                    inputs_copy,
-                    key.split(".")[1],
-                    getattr(inputs_copy, key.split(".")[1])[ind],
+        with hash_algorithm(self._hash_algorithm):
+            key = [
+                get_hash_algorithm(),
+                self.inputs.hash,
+                hash_function(self.state.splitter),
+            ]
+            if is_workflow(self):
+                key.append(hash_function(self._connections))
+            # the states depend on the states of the upstream tasks too
+            key.append(
+                [(name, inp) for name, (_, inp) in self.state.other_states.items()]
+            )
+            cached = getattr(self.state, "_checksums", None)
+            if (
+                cached is None
+                or cached[0] != key
+                # the states could be prepared again in the meantime
+                or cached[1] is not getattr(self.state, "inputs_ind", None)
+                or any(
+                    old is not new
+                    for old, new in zip(cached[3], self._upstream_states_ind())
                 )
-            input_hash = inputs_copy.hash
+            ):
+                self.state.prepare_states(self.inputs)
+                self.state.prepare_inputs()
+                if cached is None or cached[:2] != (key, self.state.inputs_ind):
+                    checksums = self._compute_checksum_states()
+                else:
+                    checksums = cached[2]
+                self.state._checksums = (
+                    key,
+                    self.state.inputs_ind,
+                    checksums,
+                    self._upstream_states_ind(),
+                )
+            else:
+                checksums = cached[2]
+            if state_index is not None:
+                return checksums[state_index]
+            return list(checksums)
+
+    def _upstream_states_ind(self):
+        """Return the state indices of the upstream tasks (None if not prepared)."""
+        return [
+            getattr(st, "states_ind", None)
+            for st, _ in self.state.other_states.values()
+        ]
+
+    def _compute_checksum_states(self):
+        """Calculate the checksums of all the states, composing the input hashes."""
+        inp_dict, _ = self.inputs.hash_fields()
+        # the hashes of the inputs are combined as the string of the dictionary,
+        # only the inputs that differ between the states are formatted for every state
+        positions = {name: pos for pos, name in enumerate(inp_dict)}
+        items = [f"{name!r}: {val!r}" for name, val in inp_dict.items()]
+        element_items = {}
+        checksum_list = []
+        for inputs_ind in self.state.inputs_ind:
+            state_items = list(items)
+            for key, ind in inputs_ind.items():
+                name = key.split(".")[1]
+                if name not in positions:
+                    continue
+                if (name, ind) not in element_items:
+                    element_items[(name, ind)] = self._element_item(name, ind, inp_dict)
+                state_items[positions[name]] = element_items[(name, ind)]
+            input_hash = self.inputs.hash_from_fields(
+                "{" + ", ".join(state_items) + "}"
+            )
             if is_workflow(self):
-                con_hash = hash_function(self._connections)
-                hash_list = [input_hash, con_hash]
                 checksum_ind = create_checksum(
                     self.__class__.__name__, self._checksum_wf(input_hash)
                 )
             else:
                 checksum_ind = create_checksum(self.__class__.__name__, input_hash)
-            return checksum_ind
+            checksum_list.append(checksum_ind)
+        return checksum_list
+
+    def _element_item(self, name, ind, inp_dict):
+        """Format the hash of an element of an input, as an item of the dictionary."""
+        value = getattr(self.inputs, name)
+        if isinstance(value, (list, tuple)):
+            # the hash of a list is the list of the hashes of the elements
+            element_hash = inp_dict[name][ind]
         else:
-            checksum_list = []
-            for ind in range(len(self.state.inputs_ind)):
-                checksum_list.append(self.checksum_states(state_index=ind))
-            return checksum_list
+            field = attr.fields_dict(type(self.inputs))[name]
+            element_hash = hash_value(
+                value[ind], tp=field.type, metadata=field.metadata
+            )
+        return f"{name!r}: {element_hash!r}"
 
     def set_state(self, splitter, combiner=None):
         """
@@ -368,6 +472,46 @@ class TaskBase:
         return res
 
     def _run(self, rerun=False, **kwargs):
+        with self._running(rerun=rerun, **kwargs) as (result, cached):
+            if not cached:
+                self._run_task()
+                result.output = self._collect_outputs()
+        return result
+
+    async def _run_async(self, rerun=False, poll_delay=0.1, **kwargs):
+        """Run the task in the event loop (see :py:meth:`_run_task_async`)."""
+        self.inputs = attr.evolve(self.inputs, **kwargs)
+        lock = SoftFileLock(self.cache_dir / (self.checksum + ".lock"))
+        # the lock can be held by a task with the same checksum running in the loop,
+        # so the loop is not blocked while waiting for it
+        while True:
+            try:
+                lock.acquire(timeout=0)
+                break
+            except Timeout:
+                await asyncio.sleep(poll_delay)
+        try:
+            # the working directory is shared by all the tasks running in the loop
+            with self._running(rerun=rerun, change_dir=False, lock=lock) as (
+                result,
+                cached,
+            ):
+                if not cached:
+                    await self._run_task_async()
+                    result.output = self._collect_outputs()
+        finally:
+            lock.release()
+        return result
+
+    @contextmanager
+    def _running(self, rerun=False, change_dir=True, lock=None, **kwargs):
+        """
+        Prepare the output directory and the audit of the task, and save the result.
+
+        Yields the result and whether it is a cached result; if it isn't,
+        the task has to be run and its outputs set in the result.
+        The lock of the checksum is acquired, unless it is given already acquired.
+        """
         self.inputs = attr.evolve(self.inputs, **kwargs)
         self.inputs.check_fields_input_spec()
         checksum = self.checksum
@@ -375,16 +519,17 @@ class TaskBase:
         # Eagerly retrieve cached - see scenarios in __init__()
         self.hooks.pre_run(self)
         # TODO add signal handler for processes killed after lock acquisition
-        with SoftFileLock(lockfile):
+        with lock or SoftFileLock(lockfile):
             if not (rerun or self.task_rerun):
                 result = self.result()
-                if result is not None:
-                    return result
+                # the task is run again if it failed before
+                if result is not None and not result.errored:
+                    yield result, True
+                    return
             # Let only one equivalent process run
             odir = self.output_dir
             if not self.can_resume and odir.exists():
                 shutil.rmtree(odir)
-            cwd = os.getcwd()
             odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
             orig_inputs = attr.asdict(self.inputs)
             map_copyfiles = copyfile_input(self.inputs, self.output_dir)
@@ -394,23 +539,31 @@ class TaskBase:
             self.audit.start_audit(odir)
             result = Result(output=None, runtime=None, errored=False)
             self.hooks.pre_run_task(self)
+            if change_dir:
+                cwd = enter_output_dir(odir, uses_cwd=self._uses_cwd)
+            else:
+                cwd = None
+            start = time()
             try:
                 self.audit.monitor()
-                self._run_task()
-                result.output = self._collect_outputs()
+                yield result, False
             except Exception as e:
                 record_error(self.output_dir, e)
                 result.errored = True
                 raise
             finally:
+                result.duration = time() - start
                 self.hooks.post_run_task(self, result)
                 self.audit.finalize_audit(result)
                 save(odir, result=result, task=self)
                 for k, v in orig_inputs.items():
                     setattr(self.inputs, k, v)
-                os.chdir(cwd)
+                exit_output_dir(cwd)
         self.hooks.post_run(self, result)
-        return result
+
+    async def _run_task_async(self):
+        """Run the task without blocking the event loop, if the task supports it."""
+        raise NotImplementedError
 
     def _collect_outputs(self):
         run_output = self.output_
@@ -448,6 +601,77 @@ class TaskBase:
             self.set_state(splitter)
         return self
 
+    def set_resources(self, cpus=None, mem_gb=None, timeout=None):
+        """
+        Declare the resources used by the task.
+
+        The resources are used by the workers to limit the number
+        of tasks running at the same time.
+
+        Parameters
+        ----------
+        cpus : :obj:`int`
+            Number of CPUs used by the task (default is 1).
+        mem_gb : :obj:`float`
+            Memory (in GB) used by the task.
+        timeout : :obj:`float`
+            Wall-clock time limit (in seconds), the task is killed
+            when it runs longer (see
+            :class:`~pydra.engine.workers.ConcurrentFuturesWorker`).
+
+        """
+        if cpus is not None:
+            if cpus < 1:
+                raise ValueError(f"cpus has to be a positive integer, got {cpus}")
+            self._runtime_requirements.cpus = cpus
+        if mem_gb is not None:
+            if mem_gb < 0:
+                raise ValueError(f"mem_gb can't be negative, got {mem_gb}")
+            self._runtime_requirements.mem_gb = mem_gb
+        if timeout is not None:
+            if timeout <= 0:
+                raise ValueError(f"timeout has to be positive, got {timeout}")
+            self._runtime_requirements.timeout = timeout
+        return self
+
+    def set_retries(self, retries, delay=1, backoff=2, retry_on=None):
+        """
+        Run the task again when it fails.
+
+        Every state of a task with a splitter is retried separately,
+        the results of the states that are already cached are kept.
+
+        Parameters
+        ----------
+        retries : :obj:`int`
+            Number of times the task is run again after failing.
+        delay : :obj:`float`
+            Delay (in seconds) before the first retry.
+        backoff : :obj:`float`
+            Factor multiplying the delay after every retry.
+        retry_on : exception class or :obj:`tuple` of exception classes
+            Only the failures raising these exceptions are retried
+            (all the exceptions by default), the failures of the tasks run
+            by other processes are matched by the exceptions recorded
+            in their error files.
+
+        """
+        if retries < 0:
+            raise ValueError(f"retries can't be negative, got {retries}")
+        if delay < 0:
+            raise ValueError(f"delay can't be negative, got {delay}")
+        if backoff < 1:
+            raise ValueError(f"backoff has to be at least 1, got {backoff}")
+        if retry_on is None:
+            retry_on = (Exception,)
+        elif not isinstance(retry_on, tuple):
+            retry_on = (retry_on,)
+        self._runtime_requirements.retries = retries
+        self._runtime_requirements.retry_delay = delay
+        self._runtime_requirements.retry_backoff = backoff
+        self._runtime_requirements.retry_on = retry_on
+        return self
+
     def combine(self, combiner, overwrite=False):
         """
         Combine inputs parameterized by one or more previous tasks.
@@ -493,7 +717,10 @@ class TaskBase:
             input_ind = self.state.inputs_ind[ind]
             inputs_dict = {}
             for inp in set(self.input_names):
-                if f"{self.name}.{inp}" in input_ind:
+                # lazy fields are left for the submitter to resolve for the state
+                if f"{self.name}.{inp}" in input_ind and not isinstance(
+                    getattr(self.inputs, inp), LazyField
+                ):
                     inputs_dict[inp] = getattr(self.inputs, inp)[
                         input_ind[f"{self.name}.{inp}"]
                     ]
@@ -775,16 +1002,17 @@ class Workflow(TaskBase):
         if is_workflow(self) and self.inputs._graph_checksums is attr.NOTHING:
             self.inputs._graph_checksums = [nd.checksum for nd in self.graph_sorted]
 
-        input_hash = self.inputs.hash
-        if not self.state:
-            self._checksum = create_checksum(
-                self.__class__.__name__, self._checksum_wf(input_hash)
-            )
-        else:
-            self._checksum = create_checksum(
-                self.__class__.__name__,
-                self._checksum_wf(input_hash, with_splitter=True),
-            )
+        with hash_algorithm(self._hash_algorithm):
+            input_hash = self.inputs.hash
+            if not self.state:
+                self._checksum = create_checksum(
+                    self.__class__.__name__, self._checksum_wf(input_hash)
+                )
+            else:
+                self._checksum = create_checksum(
+                    self.__class__.__name__,
+                    self._checksum_wf(input_hash, with_splitter=True),
+                )
         return self._checksum
 
     def _checksum_wf(self, input_hash, with_splitter=False):
@@ -887,7 +1115,8 @@ class Workflow(TaskBase):
         # Eagerly retrieve cached
         if not (rerun or self.task_rerun):
             result = self.result()
-            if result is not None:
+            # the cached nodes are not run again if the workflow failed before
+            if result is not None and not result.errored:
                 return result
         # creating connections that were defined after adding tasks to the wf
         for task in self.graph.nodes:
@@ -907,11 +1136,13 @@ class Workflow(TaskBase):
             odir = self.output_dir
             if not self.can_resume and odir.exists():
                 shutil.rmtree(odir)
-            cwd = os.getcwd()
             odir.mkdir(parents=False, exist_ok=True if self.can_resume else False)
+            # the working directory is not changed while the nodes run
+            # (they change it themselves, possibly in other threads)
             self.audit.start_audit(odir=odir)
             result = Result(output=None, runtime=None, errored=False)
             self.hooks.pre_run_task(self)
+            start = time()
             try:
                 self.audit.monitor()
                 await self._run_task(submitter, rerun=rerun)
@@ -921,10 +1152,10 @@ class Workflow(TaskBase):
                 result.errored = True
                 raise
             finally:
+                result.duration = time() - start
                 self.hooks.post_run_task(self, result)
                 self.audit.finalize_audit(result=result)
                 save(odir, result=result, task=self)
-                os.chdir(cwd)
         self.hooks.post_run(self, result)
         return result
 
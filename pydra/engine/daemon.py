@@ -0,0 +1,137 @@
+"""
+A daemon running the tasks sent by :class:`~pydra.engine.workers.RemoteWorker`.
+
+The tasks are run on the host of the daemon, so the cache directories have to
+be shared with the submitter (e.g., a network file system).
+Every request is a single line of JSON, answered by a single line of JSON:
+
+* ``{"cmd": "status"}`` returns the number of processes of the daemon,
+  and the numbers of the running and finished tasks,
+* ``{"cmd": "run", "task_pkl": ..., "ind": ..., "rerun": ...}`` runs a task
+  (or a state of a task) with :py:func:`~pydra.engine.helpers.load_and_run`,
+  and returns the path of the result file (or the error).
+
+The pickled tasks are loaded from the paths sent by the clients,
+so the daemon should only be reachable from trusted hosts
+(a token shared with the submitter can be required).
+"""
+import asyncio
+import json
+import concurrent.futures as cf
+from pathlib import Path
+
+from .helpers import get_available_cpus, load_and_run
+
+import logging
+
+logger = logging.getLogger("pydra.daemon")
+
+
+class WorkerDaemon:
+    """Run the tasks received on a TCP socket in a pool of processes."""
+
+    def __init__(self, host="127.0.0.1", port=8765, n_procs=None, token=None):
+        """
+        Initialize the daemon.
+
+        Parameters
+        ----------
+        host : :obj:`str`
+            Address the daemon listens on.
+        port : :obj:`int`
+            Port the daemon listens on (0 picks a free port).
+        n_procs : :obj:`int`
+            Number of processes running the tasks, all available CPUs by default.
+        token : :obj:`str`
+            If set, the requests without this token are rejected.
+
+        """
+        self.host = host
+        self.port = port
+        self.n_procs = get_available_cpus() if n_procs is None else n_procs
+        self.token = token
+        self.running = 0
+        self.finished = 0
+        self.pool = None
+
+    async def serve(self):
+        """Accept the requests until the daemon is stopped."""
+        self.pool = cf.ProcessPoolExecutor(self.n_procs)
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        # the address is printed, so it can be read by the process starting the daemon
+        print(f"pydra-worker listening on {self.host}:{self.port}", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown()
+
+    async def handle(self, reader, writer):
+        """Answer a single request."""
+        try:
+            request = json.loads(await reader.readline())
+            response = await self.respond(request)
+        except Exception as e:
+            response = {"error": str(e)}
+        writer.write(json.dumps(response).encode() + b"\n")
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def respond(self, request):
+        """Run the command of the request."""
+        if self.token and request.get("token") != self.token:
+            return {"error": "Invalid token"}
+        cmd = request.get("cmd")
+        if cmd == "status":
+            return {
+                "n_procs": self.n_procs,
+                "running": self.running,
+                "finished": self.finished,
+            }
+        if cmd == "run":
+            logger.debug(f"Running {request['task_pkl']} (state {request['ind']})")
+            loop = asyncio.get_event_loop()
+            self.running += 1
+            try:
+                resultfile = await loop.run_in_executor(
+                    self.pool,
+                    load_and_run,
+                    Path(request["task_pkl"]),
+                    request["ind"],
+                    request["rerun"],
+                )
+            except Exception as e:
+                return {"error": str(e)}
+            finally:
+                self.running -= 1
+                self.finished += 1
+            return {"result": str(resultfile)}
+        return {"error": f"Unknown command {cmd}"}
+
+
+def main(argv=None):
+    """Start a daemon (the ``pydra-worker`` command)."""
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on")
+    parser.add_argument(
+        "-n", "--n-procs", type=int, help="number of processes running the tasks"
+    )
+    parser.add_argument("--token", help="token required from the submitters")
+    args = parser.parse_args(argv)
+    daemon = WorkerDaemon(
+        host=args.host, port=args.port, n_procs=args.n_procs, token=args.token
+    )
+    try:
+        asyncio.run(daemon.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
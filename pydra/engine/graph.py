@@ -273,3 +273,34 @@ class DiGraph:
         for nm in first_nodes:
             self.max_paths[nm] = {}
             self._checking_path(node_name=nm, first_name=nm)
+
+    def calculate_critical_paths(self, weights=None):
+        """
+        Calculate the remaining critical path for every node.
+
+        The critical path of a node is the longest (weighted) path
+        from the node to any node without successors, including the node itself.
+        Contrary to :py:meth:`~DiGraph.calculate_max_paths` the paths are measured
+        towards the end of the graph, and every node is visited once.
+
+        Parameters
+        ----------
+        weights : :obj:`dict`
+            Weights of the nodes (e.g., durations) keyed by the node names,
+            nodes without a weight have weight 1.
+
+        Returns
+        -------
+        critical_paths : :obj:`dict`
+            Length of the critical path keyed by the node names.
+
+        """
+        weights = weights or {}
+        critical_paths = {}
+        for nd in reversed(self.sorted_nodes):
+            successors_path = max(
+                [critical_paths[nd_in.name] for nd_in in self.successors[nd.name]],
+                default=0,
+            )
+            critical_paths[nd.name] = weights.get(nd.name, 1) + successors_path
+        return critical_paths
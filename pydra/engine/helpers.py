@@ -3,20 +3,30 @@ import asyncio
 import asyncio.subprocess as asp
 import attr
 import cloudpickle as cp
+from collections import OrderedDict
+from copy import copy
 from pathlib import Path
 from filelock import SoftFileLock
 import os
 import sys
-from hashlib import sha256
 import subprocess as sp
 import getpass
+import threading
 import uuid
-from time import strftime
+import json
+from time import sleep, strftime, time
 from traceback import format_exception
 
 
 from .specs import Runtime, File, Directory, attr_fields, Result
-from .helpers_file import hash_file, hash_dir, copyfile, is_existing_file
+from .helpers_file import (
+    hash_file,
+    hash_dir,
+    copyfile,
+    is_existing_file,
+    get_hash_algorithm,
+    new_hash,
+)
 
 
 def ensure_list(obj, tuple2list=False):
@@ -76,10 +86,113 @@ def print_help(obj):
     return lines
 
 
+class ResultRegistry:
+    """
+    In-memory registry of the results of finished tasks.
+
+    The results are kept by their output directory, with the modification time
+    and the size of their result files: a result is dropped when its file is
+    removed or modified. The least recently used results are dropped when
+    the total size of the result files exceeds ``max_size``.
+    """
+
+    def __init__(self, max_size=256 * 1024 ** 2):
+        """
+        Initialize the registry.
+
+        Parameters
+        ----------
+        max_size : :obj:`int`
+            Maximum total size (in bytes) of the pickled results kept in memory.
+
+        """
+        self.max_size = max_size
+        self.size = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _signature(output_dir, stat=None):
+        """Return the signature of the result file (None if there is no file)."""
+        if stat is None:
+            try:
+                stat = (Path(output_dir) / "_result.pklz").stat()
+            except OSError:
+                return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, output_dir):
+        """Return the result saved in the output directory, or None if not known."""
+        signature = self._signature(output_dir)
+        with self._lock:
+            entry = self._results.get(str(output_dir))
+            if entry is None:
+                return None
+            if entry[1] != signature:
+                # the result file was removed or written again
+                self._discard(str(output_dir))
+                return None
+            self._results.move_to_end(str(output_dir))
+            return entry[0]
+
+    def put(self, output_dir, result, stat=None):
+        """
+        Add the result saved in the output directory.
+
+        Parameters
+        ----------
+        output_dir : :obj:`os.pathlike`
+            Output directory of the task.
+        result : :obj:`Result`
+            Result of the task.
+        stat : :obj:`os.stat_result`
+            Status of the result file the result was read from,
+            the result file is stat'ed if not provided
+            (the result is not kept if there is no file).
+
+        """
+        signature = self._signature(output_dir, stat)
+        if signature is None:
+            return
+        size = signature[1]
+        with self._lock:
+            self._discard(str(output_dir))
+            if size > self.max_size:
+                return
+            self._results[str(output_dir)] = (result, signature)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, (_, size_old)) = self._results.popitem(last=False)
+                self.size -= size_old
+
+    def discard(self, output_dir):
+        """Remove the result of the output directory (e.g. when the task is rerun)."""
+        with self._lock:
+            self._discard(str(output_dir))
+
+    def _discard(self, key):
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1][1]
+
+    def clear(self):
+        """Remove all the results."""
+        with self._lock:
+            self._results.clear()
+            self.size = 0
+
+
+result_registry = ResultRegistry()
+"""Results of the tasks finished or loaded by this process."""
+
+
 def load_result(checksum, cache_locations):
     """
     Restore a result from the cache.
 
+    The in-memory :py:data:`result_registry` is checked first,
+    the results read from the disk are added to it.
+
     Parameters
     ----------
     checksum : :obj:`str`
@@ -91,11 +204,22 @@ def load_result(checksum, cache_locations):
     """
     if not cache_locations:
         return None
+    for location in cache_locations:
+        result = result_registry.get(location / checksum)
+        if result is not None:
+            return result
     for location in cache_locations:
         if (location / checksum).exists():
             result_file = location / checksum / "_result.pklz"
-            if result_file.exists() and result_file.stat().st_size > 0:
-                return cp.loads(result_file.read_bytes())
+            try:
+                # stat'ed first, a result written again meanwhile is read again
+                stat = result_file.stat()
+            except OSError:
+                return None
+            if stat.st_size > 0:
+                result = cp.loads(result_file.read_bytes())
+                result_registry.put(location / checksum, result, stat)
+                return result
             return None
     return None
 
@@ -126,11 +250,12 @@ def save(task_path: Path, result=None, task=None, name_prefix=None):
     lockfile = task_path.parent / (task_path.name + "_save.lock")
     with SoftFileLock(lockfile):
         if result:
-            if task_path.name.startswith("Workflow"):
+            if task_path.name.startswith("Workflow") and result.output is not None:
                 # copy files to the workflow directory
                 result = copyfile_workflow(wf_path=task_path, result=result)
-            with (task_path / f"{name_prefix}_result.pklz").open("wb") as fp:
-                cp.dump(result, fp)
+            (task_path / f"{name_prefix}_result.pklz").write_bytes(cp.dumps(result))
+            if not name_prefix:
+                result_registry.put(task_path, result)
         if task:
             with (task_path / f"{name_prefix}_task.pklz").open("wb") as fp:
                 cp.dump(task, fp)
@@ -283,7 +408,7 @@ async def read_stream_and_display(stream, display):
     return b"".join(output).decode()
 
 
-async def read_and_display_async(*cmd, hide_display=False, strip=False):
+async def read_and_display_async(*cmd, hide_display=False, strip=False, cwd=None):
     """
     Capture standard input and output of a process, displaying them as they arrive.
 
@@ -292,7 +417,7 @@ async def read_and_display_async(*cmd, hide_display=False, strip=False):
     """
     # start process
     process = await asyncio.create_subprocess_exec(
-        *cmd, stdout=asp.PIPE, stderr=asp.PIPE
+        *cmd, stdout=asp.PIPE, stderr=asp.PIPE, cwd=cwd
     )
 
     stdout_display = sys.stdout.buffer.write if not hide_display else None
@@ -315,10 +440,10 @@ async def read_and_display_async(*cmd, hide_display=False, strip=False):
         return rc, stdout, stderr
 
 
-def read_and_display(*cmd, strip=False, hide_display=False):
+def read_and_display(*cmd, strip=False, hide_display=False, cwd=None):
     """Capture a process' standard output."""
     try:
-        process = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+        process = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE, cwd=cwd)
     except Exception:
         # TODO editing some tracing?
         raise
@@ -337,7 +462,7 @@ def read_and_display(*cmd, strip=False, hide_display=False):
         )
 
 
-def execute(cmd, strip=False):
+def execute(cmd, strip=False, cwd=None):
     """
     Run the event loop with coroutine.
 
@@ -351,9 +476,11 @@ def execute(cmd, strip=False):
         The command line to be executed.
     strip : :obj:`bool`
         TODO
+    cwd : :obj:`os.pathlike`
+        Working directory of the command, the current one by default.
 
     """
-    rc, stdout, stderr = read_and_display(*cmd, strip=strip)
+    rc, stdout, stderr = read_and_display(*cmd, strip=strip, cwd=cwd)
     """
     loop = get_open_loop()
     if loop.is_running():
@@ -378,6 +505,10 @@ def create_checksum(name, inputs):
         String of inputs.
 
     """
+    algorithm = get_hash_algorithm()
+    if algorithm != "sha256":
+        # the checksums of different algorithms can't collide in the cache
+        inputs = f"{algorithm}-{inputs}"
     return "_".join((name, inputs))
 
 
@@ -437,8 +568,10 @@ def get_open_loop():
 
 
 def hash_function(obj):
-    """Generate hash of object."""
-    return sha256(str(obj).encode()).hexdigest()
+    """Generate hash of object, with the hash algorithm currently used."""
+    crypto_obj = new_hash()
+    crypto_obj.update(str(obj).encode())
+    return crypto_obj.hexdigest()
 
 
 def hash_value(value, tp=None, metadata=None):
@@ -559,7 +692,112 @@ def load_and_run(
             result = Result(output=None, runtime=None, errored=True)
             save(task_pkl.parent, result=result)
         raise
+    return run_task(task, rerun=rerun, submitter=submitter, plugin=plugin, **kwargs)
+
+
+def load_and_run_result(task_pkl, ind=None, rerun=False):
+    """
+     loading and running a task (see load_and_run), returning the result file
+     and the result, so the process submitting the task doesn't read the file
+    """
+    resultfile = load_and_run(task_pkl, ind=ind, rerun=rerun)
+    # saved in the registry of this process
+    return resultfile, result_registry.get(resultfile.parent)
+
+
+def run_state(task, ind, rerun=False):
+    """
+     running a single state of a task (e.g. a task template sent once to
+     the workers of a cluster), a stateless copy of the task is run
+     """
+    return run_task(state_task(task, ind), rerun=rerun)
+
+
+def load_and_run_batch(task_pkl, inds, rerun=False, with_results=False):
+    """
+     running a batch of states of a task from a pickle file
+     (the task is loaded once, see load_task),
+     every state is saved in its own output directory;
+     returns the result file (with the result if with_results is set)
+     or the exception of every state
+     """
+    run = load_and_run_result if with_results else load_and_run
+    outcomes = []
+    for ind in inds:
+        try:
+            outcomes.append(run(task_pkl, ind=ind, rerun=rerun))
+        except Exception as excinfo:
+            outcomes.append(excinfo)
+    return outcomes
+
 
+def run_pilot(queue_dir, idle_timeout=60, poll_delay=0.5, lease=60):
+    """
+     running the tasks from a queue directory until it stays empty
+     for idle_timeout seconds (or until a stop file is created);
+     every task is claimed by moving its file to queue_dir/running,
+     and its outcome is written to queue_dir/done;
+     the claimed file is touched every lease/4 seconds while the task runs,
+     so the tasks of a pilot that died can be queued again by the submitter
+     """
+    queue_dir = Path(queue_dir)
+    (queue_dir / "running").mkdir(exist_ok=True)
+    (queue_dir / "done").mkdir(exist_ok=True)
+    idle_since = time()
+    while True:
+        claimed = None
+        for job in sorted(queue_dir.glob("*.json")):
+            try:
+                # renaming is atomic, so a task is claimed by a single pilot
+                os.rename(job, queue_dir / "running" / job.name)
+            except OSError:
+                continue
+            claimed = queue_dir / "running" / job.name
+            break
+        if claimed is None:
+            if (queue_dir / "stop").exists() or time() - idle_since > idle_timeout:
+                return
+            sleep(poll_delay)
+            continue
+        spec = json.loads(claimed.read_text())
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(
+            target=_heartbeat, args=(claimed, lease / 4, stop_heartbeat), daemon=True
+        )
+        heartbeat.start()
+        try:
+            load_and_run(Path(spec["task_pkl"]), ind=spec["ind"], rerun=spec["rerun"])
+            error = None
+        except Exception as excinfo:
+            error = str(excinfo)
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        done = queue_dir / "done" / claimed.name
+        tmp = done.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"error": error}))
+        os.rename(tmp, done)
+        try:
+            claimed.unlink()
+        except OSError:
+            # queued again by the submitter, after a late heartbeat
+            pass
+        idle_since = time()
+
+
+def _heartbeat(path, interval, stop):
+    """renewing the lease of a claimed task until stop is set"""
+    while True:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if stop.wait(interval):
+            return
+
+
+def run_task(task, rerun=False, submitter=None, plugin=None, **kwargs):
+    """running a stateless task, creating the result and error files if it fails"""
     resultfile = task.output_dir / "_result.pklz"
     try:
         task(rerun=rerun, plugin=plugin, submitter=submitter, **kwargs)
@@ -592,9 +830,125 @@ def load_task(task_pkl, ind=None):
     """ loading a task from a pickle file, settings proper input for the specific ind"""
     if isinstance(task_pkl, str):
         task_pkl = Path(task_pkl)
-    task = cp.loads(task_pkl.read_bytes())
-    if ind is not None:
-        _, inputs_dict = task.get_input_el(ind)
-        task.inputs = attr.evolve(task.inputs, **inputs_dict)
-        task.state = None
+    if ind is None:
+        return cp.loads(task_pkl.read_bytes())
+    task, template = _load_task_template(task_pkl)
+    if template:
+        return state_task(task, ind)
+    _, inputs_dict = task.get_input_el(ind)
+    task.inputs = attr.evolve(task.inputs, **inputs_dict)
+    task.state = None
     return task
+
+
+# tasks loaded by this process: path -> (mtime, size, task)
+_task_templates = OrderedDict()
+_task_templates_lock = threading.Lock()
+_task_templates_max = 32
+
+
+def _load_task_template(task_pkl):
+    """
+    loading a task with states from a pickle file only once per process
+    (until the file is modified), the states are run on copies of the task;
+    workflows are not kept, since they modify their nodes when running
+
+    Returns
+    -------
+    task : :class:`~pydra.engine.core.TaskBase`
+        The task loaded from the pickle file.
+    template : :obj:`bool`
+        True if the task is shared by the states (False for a workflow,
+        loaded for this state only).
+
+    """
+    stat = task_pkl.stat()
+    key = str(task_pkl)
+    with _task_templates_lock:
+        entry = _task_templates.get(key)
+        if entry and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            _task_templates.move_to_end(key)
+            return entry[2], True
+    task = cp.loads(task_pkl.read_bytes())
+    if hasattr(task, "graph"):
+        return task, False
+    with _task_templates_lock:
+        _task_templates[key] = (stat.st_mtime_ns, stat.st_size, task)
+        _task_templates.move_to_end(key)
+        while len(_task_templates) > _task_templates_max:
+            _task_templates.popitem(last=False)
+    return task, True
+
+
+# held by the task running in its output directory
+_cwd_lock = threading.RLock()
+_thread_state = threading.local()
+
+
+def enter_output_dir(odir, uses_cwd=True):
+    """
+    Change the working directory to the output directory of a running task.
+
+    The working directory is shared by all the threads of the process,
+    so the tasks running in their output directories run one at a time
+    (until :py:func:`exit_output_dir`). The tasks that don't use the working
+    directory (e.g. shell commands, run in the output directory explicitly)
+    keep it in the threads of :class:`~pydra.engine.workers.ThreadWorker`,
+    so they run concurrently.
+
+    Parameters
+    ----------
+    odir : :obj:`os.pathlike`
+        Output directory of the task.
+    uses_cwd : :obj:`bool`
+        If False, the task doesn't depend on the working directory.
+
+    Returns
+    -------
+    cwd : :obj:`str` or None
+        The previous working directory, to be restored when the task finishes,
+        None if the working directory was not changed.
+
+    """
+    if not uses_cwd and getattr(_thread_state, "keep_cwd", False):
+        return None
+    _cwd_lock.acquire()
+    try:
+        cwd = os.getcwd()
+        os.chdir(odir)
+    except BaseException:
+        _cwd_lock.release()
+        raise
+    return cwd
+
+
+def exit_output_dir(cwd):
+    """Restore the working directory changed by :py:func:`enter_output_dir`."""
+    if cwd is None:
+        return
+    try:
+        os.chdir(cwd)
+    finally:
+        _cwd_lock.release()
+
+
+def keep_cwd_in_thread():
+    """
+    Keep the working directory for the tasks not using it in this thread
+    (the initializer of the threads of :class:`~pydra.engine.workers.ThreadWorker`).
+    """
+    _thread_state.keep_cwd = True
+
+
+def state_task(task, ind):
+    """ creating a stateless copy of the task with the inputs of a single state"""
+    _, inputs_dict = task.get_input_el(ind)
+    # the attributes are replaced (not modified) when running the task,
+    # so a shallow copy is enough
+    task_el = object.__new__(type(task))
+    task_el.__dict__.update(task.__dict__)
+    task_el.state = None
+    task_el.audit = copy(task.audit)
+    task_el.inputs = attr.evolve(task.inputs, **inputs_dict)
+    task_el._checksum = None
+    return task_el
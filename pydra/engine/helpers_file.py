@@ -1,12 +1,20 @@
 """Functions ported from Nipype 1, after removing parts that were related to py2."""
 import attr
+import json
 import subprocess as sp
-from hashlib import sha256
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+import concurrent.futures as cf
+from functools import partial
+from hashlib import sha256, blake2b
 import os
 import os.path as op
 import re
 import shutil
 import posixpath
+import sqlite3
+import threading
+from time import time
 from builtins import str, bytes, open
 import logging
 from pathlib import Path
@@ -16,6 +24,94 @@ related_filetype_sets = [(".hdr", ".img", ".mat"), (".nii", ".mat"), (".BRIK", "
 
 logger = logging.getLogger("pydra")
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_ALGORITHMS = {
+    "sha256": sha256,
+    # the same length as sha256, so the checksums are not longer
+    "blake2b": partial(blake2b, digest_size=32),
+}
+"""Hash algorithms used for the checksums, by name."""
+if xxhash is not None:
+    HASH_ALGORITHMS["xxh3"] = xxhash.xxh3_128
+
+_default_hash_algorithm = "sha256"
+_hash_algorithm = ContextVar("hash_algorithm", default=None)
+
+
+def resolve_hash_algorithm(name):
+    """
+    Check the name of a hash algorithm.
+
+    ``"fast"`` is resolved to the fastest available non-cryptographic
+    algorithm (``xxh3`` if :mod:`xxhash` is installed, ``blake2b`` otherwise).
+    """
+    if name == "fast":
+        return "xxh3" if "xxh3" in HASH_ALGORITHMS else "blake2b"
+    if name not in HASH_ALGORITHMS:
+        raise ValueError(
+            f"Unknown hash algorithm {name}, "
+            f"available algorithms: fast, {', '.join(HASH_ALGORITHMS)}"
+        )
+    return name
+
+
+def set_hash_algorithm(name):
+    """
+    Set the hash algorithm used by default by all the tasks.
+
+    The default can also be set by the ``PYDRA_HASH_ALGORITHM``
+    environment variable (that is also read by the processes
+    running the tasks on other hosts).
+    """
+    global _default_hash_algorithm
+    _default_hash_algorithm = resolve_hash_algorithm(name)
+
+
+def get_hash_algorithm():
+    """Return the name of the hash algorithm currently used."""
+    return _hash_algorithm.get() or _default_hash_algorithm
+
+
+@contextmanager
+def hash_algorithm(name):
+    """Use a hash algorithm (or the default one if name is None) in the context."""
+    token = _hash_algorithm.set(resolve_hash_algorithm(name) if name else None)
+    try:
+        yield
+    finally:
+        _hash_algorithm.reset(token)
+
+
+def new_hash():
+    """Create a hash object of the algorithm currently used."""
+    return HASH_ALGORITHMS[get_hash_algorithm()]()
+
+
+def _crypto_id(crypto, crypto_obj):
+    """
+    Return the id of a hash function, used in the keys of the cached hashes.
+
+    The functions of :py:data:`HASH_ALGORITHMS` are identified by their names,
+    the other functions by their qualified names (and the name and digest size
+    of their hash objects). None is returned for the functions that can't be
+    identified (e.g., partials or lambdas), their hashes are not cached.
+    """
+    for name, algorithm in HASH_ALGORITHMS.items():
+        if crypto is algorithm:
+            return name
+    qualname = getattr(crypto, "__qualname__", None)
+    if qualname is None or "<" in qualname:
+        return None
+    return f"{crypto.__module__}.{qualname}:{crypto_obj.name}:{crypto_obj.digest_size}"
+
+
+if os.environ.get("PYDRA_HASH_ALGORITHM"):
+    set_hash_algorithm(os.environ["PYDRA_HASH_ALGORITHM"])
+
 
 def split_filename(fname):
     """
@@ -66,8 +162,204 @@ def split_filename(fname):
     return pth, fname, ext
 
 
-def hash_file(afile, chunk_len=8192, crypto=sha256, raise_notfound=True):
-    """Compute hash of a file using 'crypto' module."""
+class FileHashCache:
+    """
+    Persistent cache of the hashes of files.
+
+    A hash is kept with the signature of the file it was computed from
+    (device, inode, size and modification time), and it is used as long as
+    the file at the same path has the same signature.
+    The hashes are stored in a sqlite database shared by the processes
+    (set by the ``PYDRA_HASH_CACHE`` environment variable, an empty value
+    keeps the hashes only in memory), and the hashes used by a process
+    are also kept in memory.
+    The hashes of the files of a directory are also stored together,
+    in a manifest of the directory (see :py:func:`hash_dir`).
+    """
+
+    default_path = Path("~/.cache/pydra/file_hashes.sqlite")
+    racy_delay = 2
+
+    def __init__(self, path=None, max_entries=100000, max_manifests=64):
+        """
+        Initialize the cache.
+
+        Parameters
+        ----------
+        path : :obj:`os.pathlike`
+            Path of the sqlite database, read from ``PYDRA_HASH_CACHE``
+            (or ``~/.cache/pydra/file_hashes.sqlite``) by default.
+        max_entries : :obj:`int`
+            Maximum number of hashes kept in memory.
+        max_manifests : :obj:`int`
+            Maximum number of manifests of directories kept in memory.
+
+        """
+        if path is None:
+            path = os.environ.get("PYDRA_HASH_CACHE", self.default_path)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_manifests = max_manifests
+        self._hashes = {}
+        self._manifests = {}
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    @property
+    def path(self):
+        """Path of the sqlite database (None if the hashes are kept in memory)."""
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        self._path = Path(path).expanduser() if path else None
+        self._db = None
+
+    def signature(self, afile):
+        """
+        Return the signature of the file.
+
+        None is returned if the file can't be stat'ed, or if it was modified
+        less than :py:attr:`racy_delay` seconds ago (it could be modified
+        again without changing its modification time).
+        """
+        try:
+            st = os.stat(afile)
+        except OSError:
+            return None
+        if time() - st.st_mtime < self.racy_delay:
+            return None
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def key(self, afile, algorithm):
+        """Return the key of the hash of the file (None if it can't be cached)."""
+        signature = self.signature(afile)
+        if signature is None:
+            return None
+        return op.abspath(afile), algorithm, signature
+
+    def get(self, key):
+        """Return the hash stored with the key, or None."""
+        if key is None:
+            return None
+        with self._lock:
+            digest = self._hashes.get(key)
+            if digest is None:
+                row = self._execute(
+                    "SELECT hash FROM file_hashes "
+                    "WHERE path = ? AND algorithm = ? AND signature = ?",
+                    key,
+                )
+                if row:
+                    digest = row[0]
+                    self._remember(key, digest)
+            return digest
+
+    def put(self, key, digest):
+        """Store the hash of a file."""
+        if key is None:
+            return
+        with self._lock:
+            self._remember(key, digest)
+            self._execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                key + (digest,),
+            )
+
+    def get_manifest(self, dirpath, algorithm):
+        """
+        Return the manifest of a directory.
+
+        The manifest maps the relative paths of the files to their signatures
+        and hashes, it is empty if the directory was not hashed yet.
+        """
+        key = (op.abspath(dirpath), algorithm)
+        with self._lock:
+            manifest = self._manifests.get(key)
+            if manifest is None:
+                row = self._execute(
+                    "SELECT manifest FROM dir_manifests "
+                    "WHERE path = ? AND algorithm = ?",
+                    key,
+                )
+                manifest = json.loads(row[0]) if row else {}
+                self._remember_manifest(key, manifest)
+            return manifest
+
+    def put_manifest(self, dirpath, algorithm, manifest):
+        """Store the manifest of a directory."""
+        key = (op.abspath(dirpath), algorithm)
+        with self._lock:
+            self._remember_manifest(key, manifest)
+            self._execute(
+                "INSERT OR REPLACE INTO dir_manifests VALUES (?, ?, ?)",
+                key + (json.dumps(manifest),),
+            )
+
+    def clear(self):
+        """Remove the hashes kept in memory."""
+        with self._lock:
+            self._hashes.clear()
+            self._manifests.clear()
+
+    def _remember(self, key, digest):
+        if len(self._hashes) >= self.max_entries:
+            self._hashes.clear()
+        self._hashes[key] = digest
+
+    def _remember_manifest(self, key, manifest):
+        if len(self._manifests) >= self.max_manifests:
+            self._manifests.clear()
+        self._manifests[key] = manifest
+
+    def _execute(self, query, params):
+        """Run a query on the database, the errors only disable the database."""
+        if self._path is None:
+            return None
+        try:
+            if self._db is None or self._db_pid != os.getpid():
+                # a connection can't be shared with the forked processes
+                self._path.parent.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(
+                    str(self._path),
+                    timeout=30,
+                    isolation_level=None,
+                    check_same_thread=False,
+                )
+                self._db_pid = os.getpid()
+                # a hash lost in a crash is computed again, the writes are not synced
+                self._db.execute("PRAGMA synchronous = OFF")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS file_hashes (path TEXT, "
+                    "algorithm TEXT, signature TEXT, hash TEXT, "
+                    "PRIMARY KEY (path, algorithm))"
+                )
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS dir_manifests (path TEXT, "
+                    "algorithm TEXT, manifest TEXT, PRIMARY KEY (path, algorithm))"
+                )
+            return self._db.execute(query, params).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Not using the file hash cache {self._path}: {e}")
+            self._path = None
+            self._db = None
+            return None
+
+
+file_hash_cache = FileHashCache()
+"""Hashes of the files, by their path and signature."""
+
+
+def hash_file(afile, chunk_len=2 ** 20, crypto=None, raise_notfound=True):
+    """
+    Compute hash of a file using 'crypto' module.
+
+    If ``crypto`` is not set, the algorithm currently used is used
+    (see :py:func:`hash_algorithm`).
+    The hashes of the files that are not modified are read
+    from :py:data:`file_hash_cache`.
+    """
     from .specs import LazyField
 
     if afile is None or isinstance(afile, LazyField) or isinstance(afile, list):
@@ -77,35 +369,53 @@ def hash_file(afile, chunk_len=8192, crypto=sha256, raise_notfound=True):
             raise RuntimeError('File "%s" not found.' % afile)
         return None
 
-    crypto_obj = crypto()
-    with open(afile, "rb") as fp:
+    if crypto is None:
+        algorithm = get_hash_algorithm()
+        crypto_obj = HASH_ALGORITHMS[algorithm]()
+    else:
+        crypto_obj = crypto()
+        algorithm = _crypto_id(crypto, crypto_obj)
+    key = file_hash_cache.key(afile, algorithm) if algorithm else None
+    digest = file_hash_cache.get(key)
+    if digest is not None:
+        return digest
+    # reading into the same buffer, without copying the chunks
+    buffer = bytearray(chunk_len)
+    view = memoryview(buffer)
+    with open(afile, "rb", buffering=0) as fp:
         while True:
-            data = fp.read(chunk_len)
-            if not data:
+            size = fp.readinto(buffer)
+            if not size:
                 break
-            crypto_obj.update(data)
-    return crypto_obj.hexdigest()
+            crypto_obj.update(view[:size])
+    digest = crypto_obj.hexdigest()
+    file_hash_cache.put(key, digest)
+    return digest
 
 
 def hash_dir(
     dirpath,
-    crypto=sha256,
+    crypto=None,
     ignore_hidden_files=False,
     ignore_hidden_dirs=False,
     raise_notfound=True,
+    max_workers=None,
 ):
     """Compute hash of directory contents.
 
     This function computes the hash of every file in directory `dirpath` and then
     computes the hash of that list of hashes to return a single hash value. The
-    directory is traversed recursively.
+    directory is traversed recursively, the files are hashed in a pool of threads.
+    The hashes of the files are stored in a manifest of the directory
+    (see :py:data:`file_hash_cache`), so only the files that were modified since
+    the directory was hashed are read again.
 
     Parameters
     ----------
     dirpath : :obj:`str`
         Path to directory.
     crypto : :obj: `function`
-        cryptographic hash functions
+        cryptographic hash functions, the algorithm currently used by default
     ignore_hidden_files : :obj:`bool`
         If `True`, ignore filenames that begin with `.`.
     ignore_hidden_dirs : :obj:`bool`
@@ -113,6 +423,9 @@ def hash_dir(
     raise_notfound : :obj:`bool`
         If `True` and `dirpath` does not exist, raise `FileNotFound` exception. If
         `False` and `dirpath` does not exist, return `None`.
+    max_workers : :obj:`int`
+        Number of threads hashing the files (the default of
+        :class:`~concurrent.futures.ThreadPoolExecutor` if None).
 
     Returns
     -------
@@ -128,7 +441,7 @@ def hash_dir(
             raise FileNotFoundError(f"Directory {dirpath} not found.")
         return None
 
-    file_hashes = []
+    paths = []
     for dpath, dirnames, filenames in os.walk(dirpath):
         # Sort in-place to guarantee order.
         dirnames.sort()
@@ -139,10 +452,45 @@ def hash_dir(
         for filename in filenames:
             if ignore_hidden_files and filename.startswith("."):
                 continue
-            this_hash = hash_file(dpath / filename)
-            file_hashes.append(this_hash)
+            paths.append(dpath / filename)
+
+    crypto_obj = new_hash() if crypto is None else crypto()
+    if crypto is None:
+        algorithm = get_hash_algorithm()
+    else:
+        algorithm = _crypto_id(crypto, crypto_obj)
+    manifest = file_hash_cache.get_manifest(dirpath, algorithm) if algorithm else {}
+    new_manifest = {}
+    file_hashes = [None] * len(paths)
+    to_hash = []
+    for ind, path in enumerate(paths):
+        relpath = op.relpath(path, dirpath)
+        signature = file_hash_cache.signature(path)
+        entry = manifest.get(relpath)
+        if signature is not None and entry is not None and entry[0] == signature:
+            file_hashes[ind] = entry[1]
+            new_manifest[relpath] = entry
+        else:
+            to_hash.append((ind, relpath, signature))
+    if len(to_hash) > 1:
+        with cf.ThreadPoolExecutor(max_workers) as pool:
+            # the threads don't inherit the context (with the hash algorithm)
+            futures = [
+                pool.submit(copy_context().run, hash_file, paths[ind], crypto=crypto)
+                for ind, _, _ in to_hash
+            ]
+            for (ind, _, _), future in zip(to_hash, futures):
+                file_hashes[ind] = future.result()
+    else:
+        for ind, _, _ in to_hash:
+            file_hashes[ind] = hash_file(paths[ind], crypto=crypto)
+    for ind, relpath, signature in to_hash:
+        # the files modified a moment ago are hashed again the next time
+        if signature is not None:
+            new_manifest[relpath] = [signature, file_hashes[ind]]
+    if algorithm and new_manifest != manifest:
+        file_hash_cache.put_manifest(dirpath, algorithm, new_manifest)
 
-    crypto_obj = crypto()
     for h in file_hashes:
         crypto_obj.update(h.encode())
 
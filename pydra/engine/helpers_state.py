@@ -763,11 +763,15 @@ def map_splits(split_iter, inputs, cont_dim=None):
     """generate a dictionary of inputs prescribed by the splitter."""
     if cont_dim is None:
         cont_dim = {}
+    # every input is flattened once, not for every split
+    flattened = {}
     for split in split_iter:
-        yield {
-            k: list(flatten(ensure_list(inputs[k]), max_depth=cont_dim.get(k, None)))[v]
-            for k, v in split.items()
-        }
+        for k in split:
+            if k not in flattened:
+                flattened[k] = list(
+                    flatten(ensure_list(inputs[k]), max_depth=cont_dim.get(k, None))
+                )
+        yield {k: flattened[k][v] for k, v in split.items()}
 
 
 def inputs_types_to_dict(name, inputs):
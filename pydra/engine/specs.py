@@ -28,19 +28,80 @@ class SpecInfo:
     """Keeps track of this specification inheritance."""
 
 
+def _is_file_type(tp):
+    """Check if the values of a type are hashed by the content of files."""
+    tp = str(tp)
+    return "pydra.engine.specs.File" in tp or "pydra.engine.specs.Directory" in tp
+
+
 @attr.s(auto_attribs=True, kw_only=True)
 class BaseSpec:
     """The base dataclass specs for all inputs and outputs."""
 
+    def __setattr__(self, name, value):
+        # the cached hashes of the field and of the spec are out of date
+        field_hashes = self.__dict__.get("_field_hashes")
+        if field_hashes is not None:
+            field_hashes.pop(name, None)
+            self.__dict__.pop("_hash", None)
+        super().__setattr__(name, value)
+
+    def __copy__(self):
+        # the copy gets its own cache of the hashes, so setting its fields
+        # doesn't change the cached hashes of the original
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        new.__dict__["_field_hashes"] = {}
+        new.__dict__.pop("_hash", None)
+        return new
+
     def collect_additional_outputs(self, input_spec, inputs, output_dir):
         """Get additional outputs."""
         return {}
 
     @property
     def hash(self):
-        """Compute a basic hash for any given set of fields."""
-        from .helpers import hash_value, hash_function
+        """
+        Compute a basic hash for any given set of fields.
+
+        The hashes of the fields are cached until the fields are set again,
+        except for the files and directories, which can be modified
+        (their hashes are cached by :py:data:`~pydra.engine.helpers_file.file_hash_cache`).
+        The values of the fields shouldn't be modified in place.
+        """
+        from .helpers_file import get_hash_algorithm
+
+        algorithm = get_hash_algorithm()
+        cached = self.__dict__.get("_hash")
+        if cached is not None and cached[0] == algorithm:
+            return cached[1]
+        inp_dict, with_files = self.hash_fields()
+        inp_hash = self.hash_from_fields(inp_dict)
+        if not with_files:
+            self.__dict__["_hash"] = (algorithm, inp_hash)
+        return inp_hash
+
+    def hash_fields(self):
+        """
+        Compute the hashes of the fields used by :py:attr:`hash`.
+
+        Returns
+        -------
+        inp_dict : :obj:`dict`
+            Hashes of the fields, by name.
+        with_files : :obj:`bool`
+            Whether some of the fields are files or directories.
 
+        """
+        from .helpers import hash_value
+        from .helpers_file import get_hash_algorithm
+
+        if self.__dict__.get("_hashes_algorithm") != get_hash_algorithm():
+            # the hashes computed with another algorithm are dropped
+            self.__dict__["_field_hashes"] = {}
+            self.__dict__["_hashes_algorithm"] = get_hash_algorithm()
+        field_hashes = self.__dict__["_field_hashes"]
+        with_files = False
         inp_dict = {}
         for field in attr_fields(self):
             if field.name in ["_graph_checksums", "bindings"] or field.metadata.get(
@@ -50,19 +111,34 @@ class BaseSpec:
             # removing values that are notset from hash calculation
             if getattr(self, field.name) is attr.NOTHING:
                 continue
+            if field.name in field_hashes:
+                inp_dict[field.name] = field_hashes[field.name]
+                continue
             inp_dict[field.name] = hash_value(
                 value=getattr(self, field.name), tp=field.type, metadata=field.metadata
             )
+            if _is_file_type(field.type):
+                with_files = True
+            else:
+                field_hashes[field.name] = inp_dict[field.name]
+        return inp_dict, with_files
+
+    def hash_from_fields(self, inp_dict):
+        """Compute the hash of the spec from the hashes of the fields."""
+        from .helpers import hash_function
+
         inp_hash = hash_function(inp_dict)
         if hasattr(self, "_graph_checksums"):
-            return hash_function((inp_hash, self._graph_checksums))
-        else:
-            return inp_hash
+            inp_hash = hash_function((inp_hash, self._graph_checksums))
+        return inp_hash
 
-    def retrieve_values(self, wf, state_index=None):
-        """Get values contained by this spec."""
+    def retrieve_values(self, wf, state_index=None, exclude=None):
+        """Get values contained by this spec (fields from ``exclude`` stay lazy)."""
+        exclude = exclude or []
         temp_values = {}
         for field in attr_fields(self):
+            if field.name in exclude:
+                continue
             value = getattr(self, field.name)
             if isinstance(value, LazyField):
                 value = value.get_value(wf, state_index=state_index)
@@ -70,6 +146,11 @@ class BaseSpec:
         for field, value in temp_values.items():
             setattr(self, field, value)
 
+    def retrieve_state_values(self, values):
+        """Set values retrieved for a single state of lazy fields."""
+        for field, value in values.items():
+            setattr(self, field, value)
+
     def check_metadata(self):
         """Check contained metadata."""
 
@@ -102,6 +183,8 @@ class Result:
     output: ty.Optional[ty.Any] = None
     runtime: ty.Optional[Runtime] = None
     errored: bool = False
+    duration: ty.Optional[float] = None
+    """Time (in seconds) the task took to run."""
 
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -145,6 +228,20 @@ class RuntimeSpec:
     outdir: ty.Optional[str] = None
     container: ty.Optional[str] = "shell"
     network: bool = False
+    cpus: int = 1
+    """Number of CPUs used by the task."""
+    mem_gb: ty.Optional[float] = None
+    """Memory (in GB) used by the task."""
+    timeout: ty.Optional[float] = None
+    """Wall-clock time limit (in seconds) of the task."""
+    retries: int = 0
+    """Number of times the task is run again after failing."""
+    retry_delay: float = 1
+    """Delay (in seconds) before the first retry."""
+    retry_backoff: float = 2
+    """Factor multiplying the delay after every retry."""
+    retry_on: tuple = (Exception,)
+    """Exceptions after which the task is run again."""
 
 
 @attr.s(auto_attribs=True, kw_only=True)
@@ -165,10 +262,13 @@ class ShellSpec(BaseSpec):
         },
     )
 
-    def retrieve_values(self, wf, state_index=None):
+    def retrieve_values(self, wf, state_index=None, exclude=None):
         """Parse output results."""
+        exclude = exclude or []
         temp_values = {}
         for field in attr_fields(self):
+            if field.name in exclude:
+                continue
             # retrieving values that do not have templates
             if not field.metadata.get("output_file_template"):
                 value = getattr(self, field.name)
@@ -179,6 +279,13 @@ class ShellSpec(BaseSpec):
             value = path_to_string(value)
             setattr(self, field, value)
 
+    def retrieve_state_values(self, values):
+        """Parse output results for a single state."""
+        for field, value in values.items():
+            # converting the value as an element of the list retrieved for all states
+            value = path_to_string([value])[0]
+            setattr(self, field, value)
+
     def check_metadata(self):
         """
         Check the metadata for fields in input_spec and fields.
@@ -488,28 +595,30 @@ class LazyField:
         elif self.attr_type == "output":
             node = getattr(wf, self.name)
             result = node.result(state_index=state_index)
-            if isinstance(result, list):
-                if len(result) and isinstance(result[0], list):
-                    results_new = []
-                    for res_l in result:
-                        if self.field == "all_":
-                            res_l_new = [attr.asdict(res.output) for res in res_l]
-                        else:
-                            res_l_new = [
-                                getattr(res.output, self.field) for res in res_l
-                            ]
-                        results_new.append(res_l_new)
-                    return results_new
-                else:
+            return self.get_value_from_result(result)
+
+    def get_value_from_result(self, result):
+        """Return the value of a lazy output field from the result(s) of the node."""
+        if isinstance(result, list):
+            if len(result) and isinstance(result[0], list):
+                results_new = []
+                for res_l in result:
                     if self.field == "all_":
-                        return [attr.asdict(res.output) for res in result]
+                        res_l_new = [attr.asdict(res.output) for res in res_l]
                     else:
-                        return [getattr(res.output, self.field) for res in result]
+                        res_l_new = [getattr(res.output, self.field) for res in res_l]
+                    results_new.append(res_l_new)
+                return results_new
             else:
                 if self.field == "all_":
-                    return attr.asdict(result.output)
+                    return [attr.asdict(res.output) for res in result]
                 else:
-                    return getattr(result.output, self.field)
+                    return [getattr(res.output, self.field) for res in result]
+        else:
+            if self.field == "all_":
+                return attr.asdict(result.output)
+            else:
+                return getattr(result.output, self.field)
 
 
 def donothing(*args, **kwargs):
@@ -1,8 +1,25 @@
 """Handle execution backends."""
 import asyncio
-from .workers import SerialWorker, ConcurrentFuturesWorker, SlurmWorker, DaskWorker
-from .core import is_workflow
-from .helpers import get_open_loop, load_and_run_async
+import heapq
+import itertools
+import json
+from time import time
+from filelock import SoftFileLock
+from .workers import (
+    SerialWorker,
+    ConcurrentFuturesWorker,
+    ThreadWorker,
+    SlurmWorker,
+    SGEWorker,
+    PBSWorker,
+    LSFWorker,
+    DaskWorker,
+    RemoteWorker,
+)
+from .core import is_workflow, TaskBase
+from .task import ShellCommandTask
+from .specs import LazyField, attr_fields
+from .helpers import get_open_loop, load_and_run_async, load_result, state_task
 
 import logging
 
@@ -13,7 +30,14 @@ logger = logging.getLogger("pydra.submitter")
 class Submitter:
     """Send a task to the execution backend."""
 
-    def __init__(self, plugin="cf", **kwargs):
+    def __init__(
+        self,
+        plugin="cf",
+        pipeline_states=False,
+        window=1000,
+        shell_procs=None,
+        **kwargs,
+    ):
         """
         Initialize task submission.
 
@@ -21,20 +45,50 @@ class Submitter:
         ----------
         plugin : :obj:`str`
             The identifier of the execution backend.
-            Default is ``cf`` (Concurrent Futures).
+            Default is ``cf`` (Concurrent Futures), ``threads`` runs the tasks
+            in threads of the current process, ``slurm``, ``sge``, ``pbs``
+            and ``lsf`` submit the tasks as jobs of a batch system, ``remote``
+            sends the tasks to ``pydra-worker`` daemons (``hosts``).
+        pipeline_states : :obj:`bool`
+            If True, a state of a workflow node is submitted as soon as
+            the states of the upstream nodes it is connected to are finished,
+            instead of waiting for all the states of the upstream nodes.
+        window : :obj:`int`
+            Maximum number of tasks (or states) submitted to the worker
+            at the same time, the next states of a splitter are submitted
+            as the previous ones finish. If None, everything that is ready
+            is submitted at once.
+        shell_procs : :obj:`int`
+            If set, the shell commands (and containers) are run as asyncio
+            subprocesses by the submitter loop instead of the worker,
+            with at most ``shell_procs`` commands running at the same time.
 
         """
         self.loop = get_open_loop()
         self._own_loop = not self.loop.is_running()
         self.plugin = plugin
+        self.pipeline_states = pipeline_states
+        self.window = window
+        self.shell_procs = shell_procs
+        self._shell_slots = None
         if self.plugin == "serial":
             self.worker = SerialWorker()
         elif self.plugin == "cf":
             self.worker = ConcurrentFuturesWorker(**kwargs)
+        elif self.plugin == "threads":
+            self.worker = ThreadWorker(**kwargs)
         elif self.plugin == "slurm":
             self.worker = SlurmWorker(**kwargs)
+        elif self.plugin == "sge":
+            self.worker = SGEWorker(**kwargs)
+        elif self.plugin == "pbs":
+            self.worker = PBSWorker(**kwargs)
+        elif self.plugin == "lsf":
+            self.worker = LSFWorker(**kwargs)
         elif self.plugin == "dask":
             self.worker = DaskWorker(**kwargs)
+        elif self.plugin == "remote":
+            self.worker = RemoteWorker(**kwargs)
         else:
             raise Exception("plugin {} not available".format(self.plugin))
         self.worker.loop = self.loop
@@ -111,21 +165,21 @@ class Submitter:
                 f"Expanding {runnable} into {len(runnable.state.states_val)} states"
             )
             task_pkl = runnable.pickle_task()
-
-            for sidx in range(len(runnable.state.states_val)):
-                job_tuple = (sidx, task_pkl, runnable)
-                if is_workflow(runnable):
-                    # job has no state anymore
-                    futures.add(self.submit_workflow(job_tuple, rerun=rerun))
-                else:
-                    # tasks are submitted to worker for execution
-                    futures.add(self.worker.run_el(job_tuple, rerun=rerun))
+            # the coroutines are created only when the jobs are consumed
+            jobs = (
+                self.submit_state((sidx, task_pkl, runnable), rerun=rerun)
+                for sidx in range(len(runnable.state.states_val))
+            )
+            if wait:
+                await self.submit_window(jobs)
+                return
+            futures.update(jobs)
         else:
             if is_workflow(runnable):
                 await self._run_workflow(runnable, rerun=rerun)
             else:
                 # submit task to worker
-                futures.add(self.worker.run_el(runnable, rerun=rerun))
+                futures.add(self.run_el(runnable, rerun=rerun))
 
         if wait and futures:
             # run coroutines concurrently and wait for execution
@@ -135,10 +189,75 @@ class Submitter:
         # pass along futures to be awaited independently
         return futures
 
+    def submit_state(self, job_tuple, rerun=False):
+        """Return the coroutine running a single state of a task or workflow."""
+        if is_workflow(job_tuple[-1]):
+            # job has no state anymore
+            return self.submit_workflow(job_tuple, rerun=rerun)
+        # tasks are submitted to worker for execution
+        return self.run_el(job_tuple, rerun=rerun)
+
+    def run_el(self, runnable, rerun=False):
+        """
+        Return the coroutine running a task (or a state of a task).
+
+        The shell commands are run by the loop if :py:attr:`shell_procs` is set,
+        the other tasks are run by the worker.
+        The tasks with retries are run again when they fail
+        (see :py:meth:`~pydra.engine.workers.Worker.run_with_retries`).
+        """
+        task = runnable if isinstance(runnable, TaskBase) else runnable[-1]
+        if self.shell_procs and isinstance(task, ShellCommandTask):
+            run_el = self.run_shell
+        else:
+            run_el = self.worker.run_el
+        if task._runtime_requirements.retries:
+            return self.worker.run_with_retries(runnable, rerun=rerun, run_el=run_el)
+        return run_el(runnable, rerun=rerun)
+
+    async def run_shell(self, runnable, rerun=False):
+        """Run a shell command task as an asyncio subprocess."""
+        if self._shell_slots is None:
+            # created lazily, so it is bound to the running loop
+            self._shell_slots = asyncio.Semaphore(self.shell_procs)
+        if not isinstance(runnable, TaskBase):
+            ind, _, task_orig = runnable
+            runnable = state_task(task_orig, ind)
+        async with self._shell_slots:
+            return await runnable._run_async(rerun=rerun)
+
+    async def submit_window(self, jobs):
+        """
+        Run the jobs keeping at most :py:attr:`window` of them submitted.
+
+        Parameters
+        ----------
+        jobs : iterable of coroutines
+            The jobs, consumed as the previous jobs finish.
+
+        """
+        pending = set()
+        for job in jobs:
+            if self.window and len(pending) >= self.window:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for fut in done:
+                    # raising the errors
+                    fut.result()
+            pending.add(asyncio.ensure_future(job))
+        if pending:
+            await asyncio.gather(*pending)
+
     async def _run_workflow(self, wf, rerun=False):
         """
         Expand and execute a stateless :class:`~pydra.engine.core.Workflow`.
 
+        The nodes are dispatched by a :class:`GraphScheduler`, or the whole
+        workflow is run by the worker if it compiles the workflows
+        (see :py:meth:`~pydra.engine.workers.DaskWorker.run_workflow`),
+        and none of the nodes is a workflow.
+
         Parameters
         ----------
         wf : :obj:`~pydra.engine.core.Workflow`
@@ -150,28 +269,16 @@ class Submitter:
             The computed workflow
 
         """
-        # creating a copy of the graph that will be modified
-        # the copy contains new lists with original runnable objects
-        graph_copy = wf.graph.copy()
-        # keep track of pending futures
-        task_futures = set()
-        while not wf.done_all_tasks or len(task_futures):
-            tasks = get_runnable_tasks(graph_copy)
-            if not tasks and not task_futures:
-                raise Exception("Nothing queued or todo - something went wrong")
-            for task in tasks:
-                # grab inputs if needed
-                logger.debug(f"Retrieving inputs for {task}")
-                # TODO: add state idx to retrieve values to reduce waiting
-                task.inputs.retrieve_values(wf)
-                # checksum has to be updated, so resetting
-                task._checksum = None
-                if is_workflow(task) and not task.state:
-                    await self.submit_workflow(task, rerun=rerun)
-                else:
-                    for fut in await self.submit(task, rerun=rerun):
-                        task_futures.add(fut)
-            task_futures = await self.worker.fetch_finished(task_futures)
+        if getattr(self.worker, "compile_workflows", False) and not any(
+            is_workflow(nd) for nd in wf.graph.nodes
+        ):
+            # the whole graph is sent to the worker
+            await self.worker.run_workflow(wf, rerun=rerun)
+            return wf
+        scheduler = GraphScheduler(
+            wf, submitter=self, rerun=rerun, pipeline_states=self.pipeline_states
+        )
+        await scheduler.run()
         return wf
 
     def __enter__(self):
@@ -192,34 +299,336 @@ class Submitter:
             self.loop.close()
 
 
-def get_runnable_tasks(graph):
-    """Parse a graph and return all runnable tasks."""
-    tasks = []
-    to_remove = []
-    for tsk in graph.sorted_nodes:
-        # since the list is sorted (breadth-first) we can stop
-        # when we find a task that depends on any task that is already in tasks
-        if set(graph.predecessors[tsk.name]).intersection(set(tasks)):
-            break
-        if is_runnable(graph, tsk):
-            tasks.append(tsk)
-            to_remove.append(tsk)
-    # removing tasks that are ready to run from the graph
-    for nd in to_remove:
-        graph.remove_nodes(nd)
-    return tasks
-
-
-def is_runnable(graph, obj):
-    """Check if a task within a graph is runnable."""
-    connections_to_remove = []
-    for pred in graph.predecessors[obj.name]:
-        is_done = pred.done
-        if not is_done:
-            return False
+class GraphScheduler:
+    """
+    Dispatch the nodes of a stateless workflow to the submitter.
+
+    Every node keeps a counter of unfinished predecessors.
+    When all the futures of a node are finished, the counters of its
+    successors are decremented, and the successors that are left
+    without unfinished predecessors are queued for submission,
+    so the graph and the results on the disk are never polled.
+
+    With ``pipeline_states``, the states of a node that has a splitter
+    are submitted by the scheduler one by one.
+    If an input of such a node is connected to a single state (or a single
+    combined group of states) of an upstream node, the node waits only for the
+    upstream node to be expanded into states, and its state is submitted as soon
+    as the matching upstream states are finished.
+
+    The nested workflows without a state are dispatched like the other nodes,
+    so the nodes of the parent workflow that are ready don't wait for them.
+
+    The tasks that are ready are submitted in order of their remaining critical
+    path (see :py:meth:`~pydra.engine.graph.DiGraph.calculate_critical_paths`),
+    weighted by the durations of the nodes recorded in the previous runs
+    of the workflow (kept in ``_durations.json`` in the workflow cache directory).
+    The duration of a node is the longest time one of its states took to run,
+    as recorded in the results; the nodes whose results were all found
+    in the cache keep the durations of the runs that computed them.
+
+    """
+
+    durations_file = "_durations.json"
+
+    def __init__(self, wf, submitter, rerun=False, pipeline_states=False):
+        """
+        Initialize the scheduler.
+
+        Parameters
+        ----------
+        wf : :obj:`~pydra.engine.core.Workflow`
+            Stateless workflow with the connections already created
+        submitter : :obj:`Submitter`
+            Submitter used to send the tasks to the worker
+        rerun : :obj:`bool`
+            Passed to the tasks
+        pipeline_states : :obj:`bool`
+            Resolve the dependencies between the nodes with states state-by-state
+
+        """
+        self.wf = wf
+        self.graph = wf.graph
+        self.submitter = submitter
+        self.rerun = rerun
+        self.pipeline_states = pipeline_states
+        # inputs resolved separately for every state: {node: {field: upstream node}}
+        self.state_fields = {nd.name: self._state_fields(nd) for nd in self.graph.nodes}
+        # number of predecessors that are not finished (or not expanded) yet
+        self.blocking = {
+            nd.name: len(self.graph.predecessors[nd.name]) for nd in self.graph.nodes
+        }
+        # number of futures that are not finished yet
+        self.outstanding = {}
+        self.nodes_left = len(self.graph.nodes)
+        # durations of the nodes from the previous runs are used as weights
+        self.durations = self._load_durations()
+        weights = {
+            nd.name: self.durations[self._duration_key(nd)]
+            for nd in self.graph.nodes
+            if self._duration_key(nd) in self.durations
+        }
+        if weights:
+            # nodes without a recorded duration get the average weight
+            default = sum(weights.values()) / len(weights)
+            for nd in self.graph.nodes:
+                weights.setdefault(nd.name, default)
+        self.priority = self.graph.calculate_critical_paths(weights=weights)
+        self.started = {}
+        # heap of (-priority, order, task, state index) for the tasks ready to run
+        self.ready = []
+        self._order = itertools.count()
+        for nd in self.graph.sorted_nodes:
+            if not self.blocking[nd.name]:
+                self.queue(nd)
+        # bookkeeping for the nodes submitted state-by-state
+        self.task_pkls = {}
+        self.state_checksums = {}
+        self.finished_states = {}
+        self.state_blocking = {}
+        self.state_waiting = {}
+        self.errors = []
+
+    def _duration_key(self, task):
+        return f"{self.wf.name}.{task.name}"
+
+    def _load_durations(self):
+        """Read the durations of the nodes recorded in the workflow cache directory."""
+        durations_file = self.wf.cache_dir / self.durations_file
+        if not durations_file.exists():
+            return {}
+        try:
+            return json.loads(durations_file.read_text())
+        except ValueError:
+            logger.warning(f"Ignoring corrupted durations file {durations_file}")
+            return {}
+
+    def _save_durations(self):
+        """Update the durations of the nodes in the workflow cache directory."""
+        durations_file = self.wf.cache_dir / self.durations_file
+        with SoftFileLock(str(durations_file) + ".lock"):
+            durations = self._load_durations()
+            durations.update(self.durations)
+            durations_file.write_text(json.dumps(durations))
+
+    def queue(self, task, ind=None):
+        """Add a task (or a single state of a task) to the tasks ready to run."""
+        heapq.heappush(
+            self.ready, (-self.priority[task.name], next(self._order), task, ind)
+        )
+
+    def _pipelined(self, task):
+        """Check if the states of the task can wait only for the upstream states."""
+        return self.pipeline_states and task.state and not is_workflow(task)
+
+    def _state_fields(self, task):
+        """Find the inputs of the task that are resolved state-by-state."""
+        if not self._pipelined(task) or not task.state.other_states:
+            return {}
+        lazy_fields = {}
+        for field in attr_fields(task.inputs):
+            val = getattr(task.inputs, field.name)
+            if isinstance(val, LazyField) and val.name != self.wf.name:
+                lazy_fields.setdefault(val.name, []).append(field.name)
+        state_fields = {}
+        for name, fields in lazy_fields.items():
+            if name not in task.state.other_states or not self._pipelined(
+                getattr(self.wf, name)
+            ):
+                continue
+            # the upstream state is connected by a single field, that is not used
+            # in the splitter of the task (the values would be needed to split)
+            if fields == [task.state.other_states[name][1]] and (
+                f"{task.name}.{fields[0]}" not in task.state.splitter_rpn
+            ):
+                state_fields[fields[0]] = name
+        return state_fields
+
+    async def run(self):
+        """Run all the nodes of the workflow."""
+        # keep track of pending futures
+        task_futures = set()
+        while self.nodes_left:
+            if self.errors:
+                # letting the running tasks finish before reporting the error
+                if task_futures:
+                    await asyncio.gather(*task_futures)
+                raise self.errors[0]
+            if not (self.ready or task_futures):
+                raise Exception("Nothing queued or todo - something went wrong")
+            window = self.submitter.window
+            while self.ready and (not window or len(task_futures) < window):
+                _, _, task, ind = heapq.heappop(self.ready)
+                if ind is None:
+                    futures = await self.dispatch(task)
+                else:
+                    futures = [(self.submit_state(task, ind), ind)]
+                # starting the futures right away, so the workers get them in order
+                for fut, ind_fut in futures:
+                    task_futures.add(
+                        asyncio.ensure_future(self.track(fut, task, ind_fut))
+                    )
+            if task_futures:
+                task_futures = await self.submitter.worker.fetch_finished(task_futures)
+        self._save_durations()
+
+    async def dispatch(self, task):
+        """Submit a task that is ready, return its futures with the state indices."""
+        self.started[task.name] = time()
+        if task.state:
+            # the states are queued and submitted as the window allows
+            self.expand(task)
+            return []
+        # grab inputs if needed
+        logger.debug(f"Retrieving inputs for {task}")
+        task.inputs.retrieve_values(self.wf)
+        # checksum has to be updated, so resetting
+        task._checksum = None
+        if is_workflow(task):
+            # the nested workflow runs concurrently with the other nodes
+            futures = {self.submitter.submit_workflow(task, rerun=self.rerun)}
         else:
-            connections_to_remove.append(pred)
-    # removing nodes that are done from connections
-    for nd in connections_to_remove:
-        graph.remove_nodes_connections(nd)
-    return True
+            futures = await self.submitter.submit(task, rerun=self.rerun)
+        self.outstanding[task.name] = len(futures)
+        if not futures:
+            self.release(task)
+        return [(fut, None) for fut in futures]
+
+    def expand(self, task):
+        """Prepare the states of a task and queue the states that are ready."""
+        state_fields = self.state_fields[task.name]
+        logger.debug(f"Retrieving inputs for {task}")
+        task.inputs.retrieve_values(self.wf, exclude=state_fields)
+        task._checksum = None
+        task.state.prepare_states(task.inputs)
+        task.state.prepare_inputs()
+        nr_states = len(task.state.states_val)
+        logger.debug(f"Expanding {task} into {nr_states} states")
+        self.finished_states[task.name] = set()
+        self.outstanding[task.name] = nr_states
+        if state_fields:
+            self.state_checksums[task.name] = [None] * nr_states
+            for ind in range(nr_states):
+                waiting_for = set()
+                for field, name in state_fields.items():
+                    upstream = getattr(self.wf, name)
+                    ind_up = task.state.inputs_ind[ind][f"{task.name}.{field}"]
+                    for ind_st in upstream.state.final_combined_ind_mapping[ind_up]:
+                        if ind_st not in self.finished_states[name]:
+                            waiting_for.add((name, ind_st))
+                for key in waiting_for:
+                    self.state_waiting.setdefault(key, []).append((task, ind))
+                if waiting_for:
+                    self.state_blocking[(task.name, ind)] = len(waiting_for)
+                else:
+                    self.queue(task, ind)
+        else:
+            self.task_pkls[task.name] = task.pickle_task()
+            for ind in range(nr_states):
+                self.queue(task, ind)
+        # the successors connected state-by-state can be expanded now
+        for nd_in in self.graph.successors[task.name]:
+            if task.name in self.state_fields[nd_in.name].values():
+                self.unblock(nd_in)
+        if not nr_states:
+            self.release(task)
+
+    def submit_state(self, task, ind):
+        """Send a single state of a task to the worker."""
+        if self.state_fields[task.name]:
+            task_el = self._task_el(task, ind)
+            self.state_checksums[task.name][ind] = task_el.checksum
+            return self.submitter.run_el(task_el, rerun=self.rerun)
+        return self.submitter.submit_state(
+            (ind, self.task_pkls[task.name], task), rerun=self.rerun
+        )
+
+    def _task_el(self, task, ind):
+        """Create a stateless copy of the task with the inputs of a single state."""
+        values = {}
+        for field, name in self.state_fields[task.name].items():
+            upstream = getattr(self.wf, name)
+            ind_up = task.state.inputs_ind[ind][f"{task.name}.{field}"]
+            results = [
+                load_result(
+                    self._state_checksum(upstream, ind_st), upstream.cache_locations
+                )
+                for ind_st in upstream.state.final_combined_ind_mapping[ind_up]
+            ]
+            if not upstream.state.combiner:
+                results = results[0]
+            values[field] = getattr(task.inputs, field).get_value_from_result(results)
+        task_el = state_task(task, ind)
+        task_el.inputs.retrieve_state_values(values)
+        return task_el
+
+    def _state_checksum(self, task, ind):
+        """Get the checksum of a state of the task that was expanded."""
+        if task.name not in self.state_checksums:
+            self.state_checksums[task.name] = task.checksum_states()
+        return self.state_checksums[task.name][ind]
+
+    async def track(self, fut, task, ind=None):
+        """Await a future of the task, releasing the task after the last one."""
+        try:
+            await fut
+        except Exception as e:
+            self.errors.append(e)
+            return
+        if ind is not None:
+            self.state_finished(task, ind)
+        self.outstanding[task.name] -= 1
+        if not self.outstanding[task.name]:
+            self.release(task)
+
+    def state_finished(self, task, ind):
+        """Queue the downstream states that were waiting only for this state."""
+        self.finished_states[task.name].add(ind)
+        for (task_dn, ind_dn) in self.state_waiting.pop((task.name, ind), []):
+            self.state_blocking[(task_dn.name, ind_dn)] -= 1
+            if not self.state_blocking[(task_dn.name, ind_dn)]:
+                del self.state_blocking[(task_dn.name, ind_dn)]
+                self.queue(task_dn, ind_dn)
+
+    def release(self, task):
+        """Mark the task as finished and queue the successors that are ready."""
+        if self.state_fields[task.name]:
+            # all the upstream nodes are finished, the values can be retrieved
+            task.inputs.retrieve_values(self.wf)
+            task._checksum = None
+        duration = self._run_duration(task)
+        if duration is not None:
+            self.durations[self._duration_key(task)] = duration
+        self.nodes_left -= 1
+        for nd_in in self.graph.successors[task.name]:
+            if task.name not in self.state_fields[nd_in.name].values():
+                self.unblock(nd_in)
+
+    def _run_duration(self, task):
+        """Return the duration of the task, None if it wasn't run by this workflow."""
+        if task.state:
+            checksums = [
+                self._state_checksum(task, ind)
+                for ind in range(len(task.state.states_val))
+            ]
+        else:
+            checksums = [task.checksum]
+        durations = []
+        for checksum in checksums:
+            resultfile = task.cache_dir / checksum / "_result.pklz"
+            try:
+                # the results found in the cache were saved before the task started
+                if resultfile.stat().st_mtime < self.started[task.name]:
+                    continue
+            except OSError:
+                continue
+            result = load_result(checksum, [task.cache_dir])
+            if result is not None and getattr(result, "duration", None) is not None:
+                durations.append(result.duration)
+        return max(durations) if durations else None
+
+    def unblock(self, task):
+        """Decrease the counter of the unfinished predecessors of the task."""
+        self.blocking[task.name] -= 1
+        if not self.blocking[task.name]:
+            self.queue(task)
@@ -57,7 +57,7 @@ from .specs import (
     SingularitySpec,
     attr_fields,
 )
-from .helpers import ensure_list, execute
+from .helpers import ensure_list, execute, read_and_display_async
 from .helpers_file import template_update, is_local_file
 
 
@@ -219,6 +219,9 @@ class FunctionTask(TaskBase):
 class ShellCommandTask(TaskBase):
     """Wrap a shell command as a task element."""
 
+    # the command is run in the output directory explicitly
+    _uses_cwd = False
+
     def __new__(cls, container_info=None, *args, **kwargs):
         if not container_info:
             return super(ShellCommandTask, cls).__new__(cls)
@@ -396,21 +399,37 @@ class ShellCommandTask(TaskBase):
 
     def _run_task(self):
         self.output_ = None
+        args = self._args_run()
+        if args:
+            # the working directory is not changed in threads
+            values = execute(args, strip=self.strip, cwd=self.audit.odir)
+            self._set_output(values)
+
+    async def _run_task_async(self):
+        self.output_ = None
+        args = self._args_run()
+        if args:
+            values = await read_and_display_async(
+                *args, strip=self.strip, hide_display=True, cwd=self.audit.odir
+            )
+            self._set_output(values)
+
+    def _args_run(self):
         if isinstance(self, ContainerTask):
             args = self.container_args + self.command_args
         else:
             args = self.command_args
-        if args:
-            # removing empty strings
-            args = [str(el) for el in args if el not in ["", " "]]
-            keys = ["return_code", "stdout", "stderr"]
-            values = execute(args, strip=self.strip)
-            self.output_ = dict(zip(keys, values))
-            if self.output_["return_code"]:
-                if self.output_["stderr"]:
-                    raise RuntimeError(self.output_["stderr"])
-                else:
-                    raise RuntimeError(self.output_["stdout"])
+        # removing empty strings
+        return [str(el) for el in args if el not in ["", " "]]
+
+    def _set_output(self, values):
+        keys = ["return_code", "stdout", "stderr"]
+        self.output_ = dict(zip(keys, values))
+        if self.output_["return_code"]:
+            if self.output_["stderr"]:
+                raise RuntimeError(self.output_["stderr"])
+            else:
+                raise RuntimeError(self.output_["stdout"])
 
 
 class ContainerTask(ShellCommandTask):
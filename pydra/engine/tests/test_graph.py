@@ -378,6 +378,19 @@ def test_maxpath_5():
     assert graph.max_paths["d"] == {"b": 1, "c": 2}
 
 
+def test_critical_paths_1():
+    """a-> b -> c; a -> c; d -> b"""
+    graph = DiGraph(nodes=[B, A, C, D], edges=[(A, B), (B, C), (A, C), (D, B)])
+    assert graph.calculate_critical_paths() == {"a": 3, "b": 2, "c": 1, "d": 3}
+
+
+def test_critical_paths_2():
+    """a-> b -> c; a -> c; d; with weights"""
+    graph = DiGraph(nodes=[B, A, C, D], edges=[(A, B), (B, C), (A, C)])
+    critical_paths = graph.calculate_critical_paths(weights={"a": 2, "c": 10, "d": 20})
+    assert critical_paths == {"a": 13, "b": 11, "c": 10, "d": 20}
+
+
 def test_copy_1():
     """a -> b"""
     graph = DiGraph(nodes=[B, A], edges=[(A, B)])
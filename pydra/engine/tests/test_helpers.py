@@ -1,4 +1,5 @@
 import os
+import shutil
 import hashlib
 from pathlib import Path
 import random
@@ -8,8 +9,19 @@ import pytest
 import cloudpickle as cp
 
 from .utils import multiply, raise_xeq1
-from ..helpers import hash_value, hash_function, get_available_cpus, save, load_and_run
-from .. import helpers_file
+from ..helpers import (
+    hash_value,
+    hash_function,
+    get_available_cpus,
+    save,
+    load_and_run,
+    load_and_run_batch,
+    load_task,
+    load_result,
+    result_registry,
+    ResultRegistry,
+)
+from .. import helpers, helpers_file
 from ..specs import File, Directory
 from ..core import Workflow
 
@@ -199,6 +211,84 @@ def test_get_available_cpus():
         assert get_available_cpus() == os.cpu_count()
 
 
+def _result_dir(tmpdir, name, size):
+    """ an output directory with a result file of the given size """
+    output_dir = Path(tmpdir) / name
+    output_dir.mkdir()
+    (output_dir / "_result.pklz").write_bytes(b"r" * size)
+    return output_dir
+
+
+def test_result_registry_lru(tmpdir):
+    """ the least recently used results are dropped when the registry is full"""
+    registry = ResultRegistry(max_size=30)
+    a, b, c, d = [_result_dir(tmpdir, name, 10) for name in "abcd"]
+    registry.put(a, "result_a")
+    registry.put(b, "result_b")
+    registry.put(c, "result_c")
+    assert registry.get(a) == "result_a"
+    registry.put(d, "result_d")
+    assert registry.get(b) is None
+    assert registry.get(a) == "result_a"
+    assert registry.size == 30
+    # results larger than the registry are not kept
+    e = _result_dir(tmpdir, "e", 40)
+    registry.put(e, "result_e")
+    assert registry.get(e) is None
+    registry.discard(a)
+    assert registry.get(a) is None
+    assert registry.size == 20
+
+
+def test_load_result_registry(tmpdir):
+    """ the result saved is returned from the registry without reading the file,
+        until the file is modified or removed
+    """
+    task = multiply(name="mult", x=2, y=10, cache_dir=tmpdir)
+    task()
+    result_file = task.output_dir / "_result.pklz"
+    result = load_result(task.checksum, [Path(tmpdir)])
+    assert result.output.out == 20
+    assert load_result(task.checksum, [Path(tmpdir)]) is result
+    # the file is read again if it was written again
+    result_file.write_bytes(result_file.read_bytes() + b"\n")
+    reloaded = load_result(task.checksum, [Path(tmpdir)])
+    assert reloaded is not result and reloaded.output.out == 20
+    result_file.write_bytes(b"")
+    assert load_result(task.checksum, [Path(tmpdir)]) is None
+
+
+def test_result_registry_removed(tmpdir):
+    """ a task whose output directory was removed is run again """
+    task = multiply(name="mult", x=2, y=10, cache_dir=tmpdir)
+    task()
+    assert task.done
+    shutil.rmtree(task.output_dir)
+    assert not task.done
+    assert task.result() is None
+    task = multiply(name="mult", x=2, y=10, cache_dir=tmpdir)
+    assert task().output.out == 20
+    assert (task.output_dir / "_result.pklz").exists()
+
+
+def test_result_registry_file_size(tmpdir, monkeypatch):
+    """ the results are sized by their result files, without pickling them """
+    task = multiply(name="mult", x=2, y=10, cache_dir=tmpdir)
+    result = task()
+    registry = ResultRegistry()
+
+    def no_dumps(obj):
+        raise AssertionError("the result is pickled")
+
+    monkeypatch.setattr(helpers.cp, "dumps", no_dumps)
+    registry.put(task.output_dir, result)
+    assert registry.get(task.output_dir) is result
+    assert registry.size == (task.output_dir / "_result.pklz").stat().st_size
+    # the results without a file are not kept
+    registry.put(Path(tmpdir) / "missing", result)
+    assert registry.get(Path(tmpdir) / "missing") is None
+
+
 def test_load_and_run(tmpdir):
     """ testing load_and_run for pickled task"""
     task_pkl = Path(tmpdir.join("task_main.pkl"))
@@ -218,6 +308,90 @@ def test_load_and_run(tmpdir):
     assert result_1.output.out == 20
 
 
+def test_load_and_run_batch(tmpdir):
+    """ testing load_and_run_batch for pickled task, a result file for every state"""
+    task_pkl = Path(tmpdir.join("task_main.pkl"))
+
+    task = raise_xeq1(name="raise", x=[1, 2, 3]).split("x")
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    with task_pkl.open("wb") as fp:
+        cp.dump(task, fp)
+
+    outcomes = load_and_run_batch(task_pkl=task_pkl, inds=[0, 1, 2])
+    assert isinstance(outcomes[0], Exception)
+    assert "i'm raising an exception" in str(outcomes[0])
+    result_1 = cp.loads(outcomes[1].read_bytes())
+    result_2 = cp.loads(outcomes[2].read_bytes())
+    assert result_1.output.out == 2
+    assert result_2.output.out == 3
+    assert outcomes[1].parent != outcomes[2].parent
+
+
+def test_load_task_template(tmpdir, monkeypatch):
+    """ the task is unpickled once per process for all the states,
+        until the pickle file changes
+    """
+    task_pkl = Path(tmpdir.join("task_main.pkl"))
+    task = multiply(name="mult", x=[1, 2], y=10).split("x")
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl.write_bytes(cp.dumps(task))
+
+    loads = []
+    cp_loads = cp.loads
+
+    def loads_spy(data):
+        # the input and output specs are unpickled separately
+        if len(data) == task_pkl.stat().st_size:
+            loads.append(data)
+        return cp_loads(data)
+
+    monkeypatch.setattr(helpers.cp, "loads", loads_spy)
+    task_0 = load_task(task_pkl=task_pkl, ind=0)
+    task_1 = load_task(task_pkl=task_pkl, ind=1)
+    assert len(loads) == 1
+    assert (task_0.inputs.x, task_1.inputs.x) == (1, 2)
+    assert task_0.state is None and task_1.state is None
+    assert task_0.checksum != task_1.checksum
+
+    task = multiply(name="mult", x=[3, 4, 5], y=10).split("x")
+    task.state.prepare_states(inputs=task.inputs)
+    task.state.prepare_inputs()
+    task_pkl.write_bytes(cp.dumps(task))
+    assert load_task(task_pkl=task_pkl, ind=1).inputs.x == 4
+    assert len(loads) == 2
+
+
+def test_load_task_template_wf(tmpdir, monkeypatch):
+    """ a state of a workflow is loaded from a single unpickling of the file """
+    task_pkl = Path(tmpdir.join("wf_main.pkl"))
+    wf = Workflow(name="wf", input_spec=["x"])
+    wf.add(multiply(name="mult", x=wf.lzin.x, y=10))
+    wf.set_output([("out", wf.mult.lzout.out)])
+    wf.split("x", x=[1, 2])
+    wf.state.prepare_states(inputs=wf.inputs)
+    wf.state.prepare_inputs()
+    task_pkl.write_bytes(cp.dumps(wf))
+
+    loads = []
+    cp_loads = cp.loads
+
+    def loads_spy(data):
+        if len(data) == task_pkl.stat().st_size:
+            loads.append(data)
+        return cp_loads(data)
+
+    monkeypatch.setattr(helpers.cp, "loads", loads_spy)
+    wf_1 = load_task(task_pkl=task_pkl, ind=1)
+    assert len(loads) == 1
+    assert wf_1.inputs.x == 2 and wf_1.state is None
+    # workflows are not shared by the states
+    wf_0 = load_task(task_pkl=task_pkl, ind=0)
+    assert len(loads) == 2
+    assert wf_0.inputs.x == 1 and wf_0 is not wf_1
+
+
 def test_load_and_run_exception_load(tmpdir):
     """ testing raising exception and saving info in crashfile when when load_and_run"""
     task_pkl = Path(tmpdir.join("task_main.pkl"))
@@ -1,5 +1,6 @@
 import os
 import time
+from hashlib import sha256, blake2b
 import warnings
 import pytest
 from pathlib import Path
@@ -13,6 +14,14 @@ from ..helpers_file import (
     ensure_list,
     _cifs_table,
     _parse_mount_table,
+    hash_file,
+    hash_dir,
+    file_hash_cache,
+    FileHashCache,
+    hash_algorithm,
+    get_hash_algorithm,
+    resolve_hash_algorithm,
+    HASH_ALGORITHMS,
 )
 
 
@@ -410,3 +419,158 @@ def test_cifs_check():
 
     _cifs_table[:] = []
     _cifs_table.extend(orig_table)
+
+
+@pytest.fixture()
+def hash_cache(tmpdir, monkeypatch):
+    """ the file hashes are stored in a temporary database """
+    monkeypatch.setattr(file_hash_cache, "path", tmpdir / "hashes.sqlite")
+    file_hash_cache.clear()
+    yield file_hash_cache
+    file_hash_cache.clear()
+
+
+def _old_file(path, content):
+    """ writing a file modified long enough ago to be cached """
+    path.write_text(content)
+    past = time.time() - 10
+    os.utime(path, (past, past))
+    return path
+
+
+def _no_open(*args, **kwargs):
+    raise AssertionError("the file is read")
+
+
+def test_hash_file_cache(tmpdir, hash_cache, monkeypatch):
+    afile = _old_file(Path(tmpdir) / "file.txt", "content")
+    orig_hash = hash_file(afile)
+    assert orig_hash == sha256(b"content").hexdigest()
+
+    # the hash is read from the memory, and from the database
+    with monkeypatch.context() as m:
+        m.setattr("pydra.engine.helpers_file.open", _no_open)
+        assert hash_file(afile) == orig_hash
+        hash_cache.clear()
+        assert hash_file(afile) == orig_hash
+    # the database is shared by the processes
+    key = hash_cache.key(afile, "sha256")
+    assert FileHashCache(tmpdir / "hashes.sqlite").get(key) == orig_hash
+
+    # a modified file is hashed again
+    _old_file(afile, "new content")
+    assert hash_file(afile) == sha256(b"new content").hexdigest()
+
+
+def test_hash_file_cache_recent(tmpdir, hash_cache):
+    """ the hash of a file that was just modified is not cached """
+    afile = Path(tmpdir) / "file.txt"
+    afile.write_text("content")
+    assert hash_file(afile) == sha256(b"content").hexdigest()
+    assert hash_cache.key(afile, "sha256") is None
+
+
+def test_hash_dir_cache(tmpdir, hash_cache, monkeypatch):
+    dirpath = Path(tmpdir) / "dir"
+    dirpath.mkdir()
+    for name in ["a", "b", "c"]:
+        _old_file(dirpath / name, name)
+    orig_hash = hash_dir(dirpath)
+
+    with monkeypatch.context() as m:
+        m.setattr("pydra.engine.helpers_file.open", _no_open)
+        assert hash_dir(dirpath) == orig_hash
+
+    _old_file(dirpath / "b", "bb")
+    assert hash_dir(dirpath) != orig_hash
+
+
+def test_hash_algorithm(tmpdir, hash_cache):
+    afile = _old_file(Path(tmpdir) / "file.txt", "content")
+    assert get_hash_algorithm() == "sha256"
+    with hash_algorithm("blake2b"):
+        assert get_hash_algorithm() == "blake2b"
+        assert hash_file(afile) == blake2b(b"content", digest_size=32).hexdigest()
+        # the default algorithm is used if None
+        with hash_algorithm(None):
+            assert hash_file(afile) == sha256(b"content").hexdigest()
+    assert get_hash_algorithm() == "sha256"
+    # the hashes of the algorithms are cached separately
+    assert hash_cache.get(hash_cache.key(afile, "blake2b")) != hash_cache.get(
+        hash_cache.key(afile, "sha256")
+    )
+    # reading the file in small chunks gives the same hash
+    assert hash_file(afile, chunk_len=3, crypto=sha256) == hash_file(afile)
+
+
+def test_hash_file_cache_keys(tmpdir, hash_cache):
+    """ the hashes are cached by the device of the file too,
+        and by the qualified name of a custom hash function
+    """
+    dirpath = Path(tmpdir) / "dir"
+    dirpath.mkdir()
+    afile = _old_file(dirpath / "file.txt", "content")
+    st_dev = os.stat(afile).st_dev
+    assert hash_cache.signature(afile).startswith(f"{st_dev}:")
+
+    with hash_algorithm("blake2b"):
+        assert hash_file(afile) == blake2b(b"content", digest_size=32).hexdigest()
+    # the default digest size of hashlib.blake2b
+    assert hash_file(afile, crypto=blake2b) == blake2b(b"content").hexdigest()
+    assert hash_cache.get(hash_cache.key(afile, "blake2b")) != hash_file(
+        afile, crypto=blake2b
+    )
+    # the hashes of anonymous functions are not cached
+    assert hash_file(afile, crypto=lambda: sha256()) == hash_file(afile)
+    assert hash_dir(dirpath, crypto=lambda: blake2b(digest_size=32)) == hash_dir(
+        dirpath, crypto=HASH_ALGORITHMS["blake2b"]
+    )
+    assert hash_cache.get_manifest(dirpath, "blake2b")
+
+
+def test_hash_algorithm_fast():
+    assert resolve_hash_algorithm("fast") in ["xxh3", "blake2b"]
+    with pytest.raises(ValueError, match="Unknown hash algorithm"):
+        resolve_hash_algorithm("md4")
+
+
+def test_hash_dir_manifest(tmpdir, hash_cache, monkeypatch):
+    dirpath = Path(tmpdir) / "dir"
+    (dirpath / "sub").mkdir(parents=True)
+    names = ["a", "b", "sub/c", "sub/d"]
+    for name in names:
+        _old_file(dirpath / name, name)
+    orig_hash = hash_dir(dirpath, max_workers=2)
+    # the hash of the directory is the hash of the hashes of the files
+    crypto_obj = sha256()
+    for name in names:
+        crypto_obj.update(sha256(name.encode()).hexdigest().encode())
+    assert orig_hash == crypto_obj.hexdigest()
+    manifest = hash_cache.get_manifest(dirpath, "sha256")
+    assert sorted(manifest) == [os.path.join(*name.split("/")) for name in names]
+
+    # only the modified files are hashed again
+    hashed = []
+
+    def _hash_file(afile, **kwargs):
+        hashed.append(Path(afile).name)
+        return hash_file(afile, **kwargs)
+
+    monkeypatch.setattr("pydra.engine.helpers_file.hash_file", _hash_file)
+    assert hash_dir(dirpath) == orig_hash
+    assert hashed == []
+    _old_file(dirpath / "sub" / "c", "cc")
+    hash_cache.clear()
+    new_hash = hash_dir(dirpath)
+    assert new_hash != orig_hash
+    assert hashed == ["c"]
+    # the manifest is shared by the processes
+    assert FileHashCache(tmpdir / "hashes.sqlite").get_manifest(
+        dirpath, "sha256"
+    ) == hash_cache.get_manifest(dirpath, "sha256")
+
+    # the files removed from the directory are removed from the manifest
+    (dirpath / "a").unlink()
+    assert hash_dir(dirpath) not in [orig_hash, new_hash]
+    assert len(hash_cache.get_manifest(dirpath, "sha256")) == 3
+    assert hash_cache.get_manifest(dirpath, "blake2b") == {}
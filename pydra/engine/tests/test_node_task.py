@@ -17,6 +17,7 @@ from .utils import (
 )
 
 from ..core import TaskBase
+from ..state import State
 from ..submitter import Submitter
 
 
@@ -331,6 +332,63 @@ def test_task_init_9():
     assert nn1.checksum == nn2.checksum
 
 
+def test_task_checksum_states(monkeypatch):
+    """ the checksums of the states are the checksums of the tasks with
+        the inputs of the states, cached until the inputs change
+    """
+    nn = fun_addvar(name="NA", a=[3, 5, 7], b=[10, 20]).split(["a", "b"])
+    checksums = nn.checksum_states()
+    assert checksums == [
+        fun_addvar(name="NA", a=a, b=b).checksum for a in [3, 5, 7] for b in [10, 20]
+    ]
+
+    def prepare_states(inputs):
+        raise AssertionError("the states are prepared again")
+
+    with monkeypatch.context() as m:
+        m.setattr(nn.state, "prepare_states", prepare_states)
+        assert nn.checksum_states() == checksums
+        assert nn.checksum_states(3) == checksums[3]
+
+    nn.inputs.b = [10, 30]
+    assert nn.checksum_states() == [
+        fun_addvar(name="NA", a=a, b=b).checksum for a in [3, 5, 7] for b in [10, 30]
+    ]
+
+
+def test_task_checksum_states_other_states(monkeypatch):
+    """ the checksums of the states depending on the states of an upstream task
+        are cached until the upstream states are prepared again
+    """
+    na = fun_addvar(name="NA", a=[3, 5], b=10).split("a")
+    na.state.prepare_states(na.inputs)
+    na.state.prepare_inputs()
+    nb = fun_addvar(name="NB", a=[13, 15], b=[1, 2])
+    nb.state = State(
+        "NB", splitter=["_NA", "NB.b"], other_states={"NA": (na.state, "a")}
+    )
+    checksums = nb.checksum_states()
+    assert checksums == [
+        fun_addvar(name="NB", a=a, b=b).checksum for a in [13, 15] for b in [1, 2]
+    ]
+
+    prepared = []
+    prepare_states = nb.state.prepare_states
+
+    def prepare_states_spy(inputs):
+        prepared.append(inputs)
+        return prepare_states(inputs)
+
+    monkeypatch.setattr(nb.state, "prepare_states", prepare_states_spy)
+    assert nb.checksum_states() == checksums
+    assert nb.checksum_states(3) == checksums[3]
+    assert not prepared
+
+    na.state.prepare_states(na.inputs)
+    assert nb.checksum_states() == checksums
+    assert len(prepared) == 1
+
+
 def test_task_error():
     func = fun_div(name="div", a=1, b=0)
     with pytest.raises(ZeroDivisionError):
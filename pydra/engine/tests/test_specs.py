@@ -308,3 +308,57 @@ def test_input_file_hash_4(tmpdir):
         f.write("hi")
     hash3 = inputs(in_file=[{"file": file_diffcontent, "int": 3}]).hash
     assert hash1 != hash3
+
+
+def test_input_hash_cached(tmpdir, monkeypatch):
+    """ the hashes of the fields are cached until the fields are set """
+    file = tmpdir.join("in_file.txt")
+    with open(file, "w") as f:
+        f.write("hello")
+    fields = [("a", int), ("b", ty.List[int]), ("in_file", File)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=1, b=[1, 2], in_file=file)
+    hash1 = inputs.hash
+
+    from .. import helpers
+
+    hashed = []
+    hash_value = helpers.hash_value
+
+    def hash_field(*args, **kwargs):
+        if "value" in kwargs:
+            hashed.append(kwargs["value"])
+        return hash_value(*args, **kwargs)
+
+    monkeypatch.setattr(helpers, "hash_value", hash_field)
+    assert inputs.hash == hash1
+    # only the file is hashed again
+    assert hashed == [file]
+
+    hashed.clear()
+    inputs.a = 2
+    hash2 = inputs.hash
+    assert hashed == [2, file]
+    assert hash2 != hash1
+    assert hash2 == make_klass(input_spec)(a=2, b=[1, 2], in_file=file).hash
+
+    # the content of the file is checked
+    with open(file, "w") as f:
+        f.write("hi")
+    assert inputs.hash != hash2
+
+
+def test_input_hash_cached_copy():
+    """ setting a field of a shallow copy doesn't change the hash of the original """
+    from copy import copy
+
+    fields = [("a", int), ("b", int)]
+    input_spec = SpecInfo(name="Inputs", fields=fields, bases=(BaseSpec,))
+    inputs = make_klass(input_spec)(a=1, b=1)
+    inputs.hash
+    inputs_copy = copy(inputs)
+    inputs_copy.a = 2
+    assert inputs_copy.hash == make_klass(input_spec)(a=2, b=1).hash
+    inputs.b = 2
+    assert inputs.hash == make_klass(input_spec)(a=1, b=2).hash
+    assert inputs_copy.hash == make_klass(input_spec)(a=2, b=1).hash
@@ -1,13 +1,20 @@
+import asyncio
 from dateutil import parser
 import re
 import shutil
 import subprocess as sp
+import json
+import os
+import sys
 import time
 
+from pathlib import Path
 import pytest
 
-from .utils import gen_basic_wf
-from ..core import Workflow
+from .utils import gen_basic_wf, fun_div, multiply, add2, identity
+from ..core import Workflow, TaskBase
+from ..task import ShellCommandTask
+from ..workers import ConcurrentFuturesWorker, SlurmWorker
 from ..submitter import Submitter
 from ... import mark
 
@@ -20,6 +27,56 @@ def sleep_add_one(x):
     return x + 1
 
 
+@mark.task
+def sleep_on_two(x):
+    time.sleep(3 if x == 2 else 0)
+    return x
+
+
+@mark.task
+def timestamp(x):
+    return time.time()
+
+
+@mark.task
+def list_sum(x):
+    return sum(x)
+
+
+@mark.task
+def pid(x):
+    return os.getpid()
+
+
+@mark.task
+def exit_on_two(x):
+    if x == 2:
+        os._exit(1)
+    return x
+
+
+@mark.task
+def fail_first(x, attempts_dir, failures=1):
+    # the first runs of x=2 fail, the runs of every x are counted
+    attempts_file = Path(attempts_dir) / str(x)
+    attempts = int(attempts_file.read_text()) if attempts_file.exists() else 0
+    attempts_file.write_text(str(attempts + 1))
+    if x == 2 and attempts < failures:
+        raise IOError("transient failure")
+    return x
+
+
+def attempts(attempts_dir):
+    return {int(path.name): int(path.read_text()) for path in attempts_dir.iterdir()}
+
+
+@mark.task
+def sleep_interval(x):
+    start = time.time()
+    time.sleep(1)
+    return start, time.time()
+
+
 def test_callable_wf(plugin):
     wf = gen_basic_wf()
     with pytest.raises(NotImplementedError):
@@ -103,6 +160,439 @@ def test_wf_in_wf(plugin):
     assert res.output.out == 7
 
 
+def test_wf_in_wf_concurrent():
+    """ WF(SUBWF(A --> B), C --> D): D starts while SUBWF is running """
+    wf = Workflow(name="wf_in_wf_concurrent", input_spec=["x"])
+    wf.inputs.x = 2
+
+    subwf = Workflow(name="sub_wf", input_spec=["x"])
+    subwf.add(sleep_interval(name="sub_a", x=subwf.lzin.x))
+    subwf.add(sleep_interval(name="sub_b", x=subwf.sub_a.lzout.out))
+    subwf.set_output([("out", subwf.sub_b.lzout.out)])
+    subwf.inputs.x = wf.lzin.x
+    wf.add(subwf)
+
+    wf.add(add2(name="wf_c", x=wf.lzin.x))
+    wf.add(sleep_interval(name="wf_d", x=wf.wf_c.lzout.out))
+    wf.set_output([("sub", wf.sub_wf.lzout.out), ("d", wf.wf_d.lzout.out)])
+
+    with Submitter("cf", n_procs=2) as sub:
+        sub(wf)
+
+    res = wf.result()
+    (_, end_sub), (start_d, _) = res.output.sub, res.output.d
+    assert start_d < end_sub
+
+
+@pytest.mark.parametrize("chunksize", [1, 4])
+def test_wf_states_results_registered(tmpdir, monkeypatch, chunksize):
+    """ the results of the states returned by the processes are registered,
+        so they are not read from the disk by the submitter
+    """
+    reads = []
+    pid = os.getpid()
+    read_bytes = Path.read_bytes
+
+    def read_bytes_spy(self):
+        # the processes of the pool are forked with the spy
+        if os.getpid() == pid and self.name == "_result.pklz":
+            reads.append(self)
+        return read_bytes(self)
+
+    monkeypatch.setattr(Path, "read_bytes", read_bytes_spy)
+    wf = Workflow(name="wf", input_spec=["x"], cache_dir=tmpdir)
+    wf.add(add2(name="taska", x=wf.lzin.x).split("x"))
+    wf.add(add2(name="taskb", x=wf.taska.lzout.out))
+    wf.inputs.x = list(range(20))
+    wf.set_output([("out", wf.taskb.lzout.out)])
+    with Submitter("cf", n_procs=2, chunksize=chunksize) as sub:
+        sub(wf)
+
+    assert wf.result().output.out == list(range(4, 24))
+    assert reads == []
+
+
+def test_wf_no_done_polling(plugin, monkeypatch):
+    """ the scheduler releases the successors when the futures complete,
+        so it never has to check if the tasks are done
+    """
+
+    def fail_done(self):
+        raise Exception("task.done should not be used by the scheduler")
+
+    monkeypatch.setattr(TaskBase, "done", property(fail_done))
+    # A --> B --> D
+    # A --> C (two states)
+    wf = Workflow("wf_branches", input_spec=["x"])
+    wf.inputs.x = 1
+    wf.add(sleep_add_one(name="taska", x=wf.lzin.x))
+    wf.add(sleep_add_one(name="taskb", x=wf.taska.lzout.out))
+    wf.add(sleep_add_one(name="taskc", x=wf.taska.lzout.out).split("x", x=[1, 2]))
+    wf.add(sleep_add_one(name="taskd", x=wf.taskb.lzout.out))
+    wf.set_output([("out_c", wf.taskc.lzout.out), ("out_d", wf.taskd.lzout.out)])
+    with Submitter(plugin) as sub:
+        sub(wf)
+
+    res = wf.result()
+    assert res.output.out_c == [2, 3]
+    assert res.output.out_d == 4
+
+
+def test_wf_error(plugin):
+    """ the error from a failing task is raised by the scheduler
+        and the successors of the task are not run
+    """
+    wf = Workflow("wf_error", input_spec=["x"])
+    wf.inputs.x = 0
+    wf.add(fun_div(name="div", a=1, b=wf.lzin.x))
+    wf.add(sleep_add_one(name="taska", x=wf.div.lzout.out))
+    wf.set_output([("out", wf.taska.lzout.out)])
+    with pytest.raises(ZeroDivisionError):
+        with Submitter(plugin) as sub:
+            sub(wf)
+    assert wf.taska.result() is None
+
+
+def test_wf_pipeline_states():
+    """ with pipeline_states the states of taskb
+        don't wait for the slow state of taska
+    """
+    wf = Workflow("wf_pipeline", input_spec=["x"])
+    wf.add(sleep_on_two(name="taska", x=wf.lzin.x).split("x"))
+    wf.add(timestamp(name="taskb", x=wf.taska.lzout.out))
+    wf.set_output([("out", wf.taskb.lzout.out)])
+    wf.inputs.x = [0, 1, 2]
+    with Submitter("cf", n_procs=2, pipeline_states=True) as sub:
+        sub(wf)
+
+    res = wf.result()
+    assert res.output.out[2] - res.output.out[0] > 2
+    assert res.output.out[2] - res.output.out[1] > 2
+
+
+def test_wf_pipeline_states_combiner(plugin):
+    """ with pipeline_states, a state of taskb waits for the combined group
+        of states from taska, and taskc waits for a single state of taskb
+    """
+    wf = Workflow("wf_pipeline_comb", input_spec=["x", "y"])
+    wf.add(
+        multiply(name="taska", x=wf.lzin.x, y=wf.lzin.y).split(["x", "y"]).combine("x")
+    )
+    wf.add(list_sum(name="taskb", x=wf.taska.lzout.out))
+    wf.add(add2(name="taskc", x=wf.taskb.lzout.out))
+    wf.set_output([("out", wf.taskc.lzout.out)])
+    wf.inputs.x = [1, 2]
+    wf.inputs.y = [10, 20, 30]
+    with Submitter(plugin, pipeline_states=True) as sub:
+        sub(wf)
+
+    res = wf.result()
+    assert res.output.out == [32, 62, 92]
+
+
+def test_wf_critical_path(tmpdir):
+    """ the first task of the longest chain is submitted
+        before the independent task, and the durations are recorded
+        (but not the durations of the cached tasks)
+    """
+
+    def critical_wf(x):
+        wf = Workflow("wf_critical", input_spec=["x"], cache_dir=tmpdir)
+        wf.add(timestamp(name="short", x=0))
+        wf.add(timestamp(name="chain1", x=wf.lzin.x))
+        wf.add(timestamp(name="chain2", x=wf.chain1.lzout.out))
+        wf.add(timestamp(name="chain3", x=wf.chain2.lzout.out))
+        wf.set_output([("short", wf.short.lzout.out), ("chain1", wf.chain1.lzout.out)])
+        wf.inputs.x = x
+        with Submitter("cf", n_procs=1) as sub:
+            sub(wf)
+        return wf
+
+    wf = critical_wf(1)
+    res = wf.result()
+    assert res.output.chain1 < res.output.short
+    durations = json.loads((wf.cache_dir / "_durations.json").read_text())
+    assert set(durations) == {
+        "wf_critical.short",
+        "wf_critical.chain1",
+        "wf_critical.chain2",
+        "wf_critical.chain3",
+    }
+    # the durations are the times the tasks took to run
+    assert durations["wf_critical.short"] == wf.short.result().duration
+
+    # short is found in the cache, its duration is kept
+    wf = critical_wf(2)
+    new_durations = json.loads((wf.cache_dir / "_durations.json").read_text())
+    assert new_durations["wf_critical.short"] == durations["wf_critical.short"]
+    # the chain is run again
+    assert new_durations["wf_critical.chain1"] != durations["wf_critical.chain1"]
+
+
+@pytest.mark.parametrize(
+    "resources, worker_args",
+    [({"cpus": 2}, {"n_procs": 2}), ({"mem_gb": 2}, {"n_procs": 2, "mem_gb": 3})],
+)
+def test_wf_resources(resources, worker_args):
+    """ two tasks that together require more resources than the worker has
+        are not running at the same time
+    """
+    wf = Workflow("wf_resources", input_spec=["x"])
+    wf.add(sleep_interval(name="taska", x=1).set_resources(**resources))
+    wf.add(sleep_interval(name="taskb", x=2).set_resources(**resources))
+    wf.set_output([("a", wf.taska.lzout.out), ("b", wf.taskb.lzout.out)])
+    with Submitter("cf", **worker_args) as sub:
+        sub(wf)
+
+    res = wf.result()
+    (start_a, end_a), (start_b, end_b) = res.output.a, res.output.b
+    assert end_a <= start_b or end_b <= start_a
+
+
+def test_wf_resources_oversized():
+    """ a task requiring more CPUs than the worker has still runs """
+    wf = Workflow("wf_resources_big", input_spec=["x"])
+    wf.add(add2(name="taska", x=wf.lzin.x).set_resources(cpus=64))
+    wf.set_output([("out", wf.taska.lzout.out)])
+    wf.inputs.x = 1
+    with Submitter("cf", n_procs=2) as sub:
+        sub(wf)
+
+    assert wf.result().output.out == 3
+
+
+def test_task_chunksize():
+    """ the states are run in batches of chunksize states """
+    task = pid(name="task", x=[1, 2, 3, 4]).split("x")
+    with Submitter("cf", n_procs=2, chunksize=4) as sub:
+        sub(task)
+
+    results = task.result()
+    assert len(results) == 4
+    assert len({res.output.out for res in results}) == 1
+    # every state has its own cache entry
+    assert len({res_dir for res_dir in task.output_dir}) == 4
+    assert all((res_dir / "_result.pklz").exists() for res_dir in task.output_dir)
+
+
+@pytest.mark.parametrize("chunksize", [1, 4])
+def test_cf_process_crash(tmpdir, chunksize):
+    """ a process dying only fails the state it was running,
+        the pool is respawned and the other states are run
+    """
+    task = exit_on_two(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    task.state.prepare_states(task.inputs)
+    task.state.prepare_inputs()
+    task_pkl = task.pickle_task()
+    worker = ConcurrentFuturesWorker(n_procs=2, chunksize=chunksize)
+    worker.loop = asyncio.new_event_loop()
+
+    async def run_states():
+        jobs = [worker.run_el((ind, task_pkl, task)) for ind in range(4)]
+        return await asyncio.gather(*jobs, return_exceptions=True)
+
+    try:
+        outcomes = worker.loop.run_until_complete(run_states())
+    finally:
+        worker.close()
+        worker.loop.close()
+    assert isinstance(outcomes[1], RuntimeError)
+    assert "died" in str(outcomes[1])
+    for ind in [0, 2, 3]:
+        assert outcomes[ind] == task.output_dir[ind] / "_result.pklz"
+        assert outcomes[ind].exists()
+
+
+@pytest.mark.parametrize(
+    "resources, worker_args", [({"timeout": 1}, {}), ({}, {"timeout": 1})]
+)
+def test_cf_timeout(tmpdir, resources, worker_args):
+    """ a task running longer than its timeout is killed,
+        and the worker keeps running the next tasks
+    """
+    hung = sleep_on_two(name="hung", x=2, cache_dir=tmpdir).set_resources(**resources)
+    task = add2(name="task", x=2, cache_dir=tmpdir)
+    with Submitter("cf", n_procs=1, **worker_args) as sub:
+        start = time.time()
+        with pytest.raises(Exception) as excinfo:
+            sub(hung)
+        assert time.time() - start < 3
+        sub(task)
+    assert "did not finish in 1 seconds" in str(excinfo.value)
+    assert task.result().output.out == 4
+
+
+@pytest.mark.parametrize("plugin_args", [("cf", 1), ("cf", 4), ("threads", 1)])
+def test_retries(tmpdir, plugin_args):
+    """ a failed state is run again, the other states are run once """
+    plugin, chunksize = plugin_args
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = fail_first(name="task", x=[1, 2, 3], attempts_dir=str(attempts_dir))
+    task.split("x").set_retries(2, delay=0.1)
+    task.cache_dir = tmpdir
+    with Submitter(plugin, n_procs=2, chunksize=chunksize) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [1, 2, 3]
+    assert attempts(attempts_dir) == {1: 1, 2: 2, 3: 1}
+
+
+def test_retries_exceptions(tmpdir):
+    """ only the failures raising the exceptions of the policy are retried,
+        and no more than the number of retries
+    """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = fail_first(name="task", x=2, attempts_dir=str(attempts_dir), failures=5)
+    task.cache_dir = tmpdir
+    task.set_retries(3, delay=0.1, retry_on=ValueError)
+    with pytest.raises(IOError):
+        with Submitter("cf", n_procs=2) as sub:
+            sub(task)
+    assert attempts(attempts_dir) == {2: 1}
+
+    task.set_retries(2, delay=0.1, backoff=1, retry_on=(ValueError, IOError))
+    with pytest.raises(IOError):
+        with Submitter("cf", n_procs=2) as sub:
+            sub(task)
+    assert attempts(attempts_dir) == {2: 4}
+
+
+def test_rerun_failed_states(tmpdir):
+    """ running a task again only runs the states that failed """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = fail_first(name="task", x=[1, 2, 3], attempts_dir=str(attempts_dir))
+    task.split("x")
+    task.cache_dir = tmpdir
+    with pytest.raises(IOError):
+        with Submitter("cf", n_procs=3) as sub:
+            sub(task)
+    assert attempts(attempts_dir) == {1: 1, 2: 1, 3: 1}
+
+    with Submitter("cf", n_procs=3) as sub:
+        sub(task)
+    assert [res.output.out for res in task.result()] == [1, 2, 3]
+    assert attempts(attempts_dir) == {1: 1, 2: 2, 3: 1}
+
+
+def test_wf_threads(tmpdir):
+    """ the threads plugin runs the tasks in the output directories,
+        without changing the working directory of the process
+    """
+    cwd = os.getcwd()
+    wf = Workflow("wf_threads", input_spec=["x"], cache_dir=tmpdir)
+    wf.add(multiply(name="mult", x=wf.lzin.x, y=2).split("x"))
+    wf.add(ShellCommandTask(name="shell", executable="pwd"))
+    wf.set_output([("out", wf.mult.lzout.out), ("pwd", wf.shell.lzout.stdout)])
+    wf.inputs.x = [1, 2, 3]
+    with Submitter("threads", n_procs=2) as sub:
+        sub(wf)
+
+    res = wf.result()
+    assert res.output.out == [2, 4, 6]
+    assert res.output.pwd.strip() == str(wf.shell.output_dir)
+    assert os.getcwd() == cwd
+
+
+@mark.task
+def write_relative(x):
+    # the file is written in the working directory
+    Path("out.txt").write_text(str(x))
+    time.sleep(0.1)
+    return int(Path("out.txt").read_text())
+
+
+@pytest.mark.parametrize("plugin_name", ["threads", "cf"])
+def test_function_task_cwd(tmpdir, monkeypatch, plugin_name):
+    """ the function tasks run in their output directories,
+        one at a time in the threads of the process
+    """
+    monkeypatch.chdir(tmpdir.mkdir("cwd"))
+    cwd = os.getcwd()
+    task = write_relative(name="write", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter(plugin_name, n_procs=4) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [1, 2, 3, 4]
+    for x, output_dir in zip([1, 2, 3, 4], task.output_dir):
+        assert (output_dir / "out.txt").read_text() == str(x)
+    assert not Path(cwd, "out.txt").exists()
+    assert os.getcwd() == cwd
+
+
+def test_shell_procs(monkeypatch):
+    """ with shell_procs the shell commands are run by the submitter loop,
+        concurrently up to the limit, without the worker
+    """
+
+    def no_worker(*args, **kwargs):
+        raise Exception("the worker shouldn't be used")
+
+    monkeypatch.setattr(ConcurrentFuturesWorker, "run_el", no_worker)
+    shelly = ShellCommandTask(
+        name="shelly", executable="sleep", args=["1", "1.1", "1.2", "1.3"]
+    ).split("args")
+    t0 = time.time()
+    with Submitter("cf", n_procs=1, shell_procs=2) as sub:
+        sub(shelly)
+    elapsed = time.time() - t0
+
+    assert [res.output.return_code for res in shelly.result()] == [0, 0, 0, 0]
+    assert 2 < elapsed < 4
+
+
+def test_shell_procs_same_checksum(tmpdir):
+    """ two states with the same checksum run by the submitter loop,
+        the second one waits for the lock of the first one without blocking the loop
+    """
+    import threading
+
+    shelly = ShellCommandTask(
+        name="shelly", executable="sleep", args=["1", "1"], cache_dir=tmpdir
+    ).split("args")
+
+    def run():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        with Submitter("cf", n_procs=1, shell_procs=2) as sub:
+            sub(shelly)
+
+    # a daemon thread, so a deadlock fails the test instead of blocking the tests
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive()
+    assert [res.output.return_code for res in shelly.result()] == [0, 0]
+
+
+def max_overlap(intervals):
+    """ the maximal number of intervals overlapping at the same time """
+    return max(
+        sum(start <= start_ot < end for (start, end) in intervals)
+        for (start_ot, _) in intervals
+    )
+
+
+def test_task_window():
+    """ at most window states of a splitter are submitted at the same time """
+    task = sleep_interval(name="task", x=[1, 2, 3, 4]).split("x")
+    with Submitter("cf", n_procs=4, window=2) as sub:
+        sub(task)
+
+    results = task.result()
+    assert max_overlap([res.output.out for res in results]) == 2
+
+
+def test_wf_window():
+    """ the window limits the states of a workflow node """
+    wf = Workflow("wf_window", input_spec=["x"])
+    wf.add(sleep_interval(name="taska", x=wf.lzin.x).split("x"))
+    wf.set_output([("out", wf.taska.lzout.out)])
+    wf.inputs.x = [1, 2, 3]
+    with Submitter("cf", n_procs=3, window=1) as sub:
+        sub(wf)
+
+    assert max_overlap(wf.result().output.out) == 1
+
+
 @pytest.mark.flaky(reruns=2)  # when dask
 def test_wf2(plugin_dask_opt):
     """ workflow as a node
@@ -233,3 +723,671 @@ def test_slurm_max_jobs(tmpdir):
             prev = et
             continue
         assert (prev - et).seconds >= 2
+
+
+FAKE_SBATCH = """#!/bin/bash
+echo "sbatch $@" >> "$FAKE_SLURM_DIR/calls"
+jobid=$$$RANDOM
+script="${@: -1}"
+error=/dev/null
+array=""
+for arg in "$@"; do
+    case $arg in
+        --error=*) error="${arg#--error=}";;
+        --array=*) array="${arg#--array=}";;
+    esac
+done
+run() {
+    touch "$FAKE_SLURM_DIR/$1.running"
+    (
+        sh "$script" 2> "$2"
+        echo $? > "$FAKE_SLURM_DIR/$1.exit"
+        rm "$FAKE_SLURM_DIR/$1.running"
+    ) > /dev/null 2>&1 &
+}
+if [ -z "$array" ]; then
+    run $jobid "${error//%j/$jobid}"
+else
+    array="${array%\\%*}"
+    for range in ${array//,/ }; do
+        for i in $(seq ${range%-*} ${range#*-}); do
+            export SLURM_ARRAY_TASK_ID=$i
+            err="${error//%A/$jobid}"
+            run ${jobid}_$i "${err//%a/$i}"
+        done
+    done
+fi
+echo "Submitted batch job $jobid"
+"""
+
+FAKE_SCONTROL = """#!/bin/bash
+echo "scontrol $@" >> "$FAKE_SLURM_DIR/calls"
+if [ -e "$FAKE_SLURM_DIR/max_array_size" ]; then
+    echo "MaxArraySize            = $(cat "$FAKE_SLURM_DIR/max_array_size")"
+else
+    echo "MaxArraySize            = 1001"
+fi
+"""
+
+FAKE_SQUEUE = """#!/bin/bash
+echo "squeue $@" >> "$FAKE_SLURM_DIR/calls"
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-j" ]; then ids="$2"; fi
+    shift
+done
+cd "$FAKE_SLURM_DIR"
+for id in ${ids//,/ }; do
+    for running in $id.running ${id}_*.running; do
+        if [ -e "$running" ]; then echo ${running%.running}; fi
+    done
+done
+"""
+
+FAKE_SACCT = """#!/bin/bash
+echo "sacct $@" >> "$FAKE_SLURM_DIR/calls"
+# the accounting lags behind the queue for the next $(cat sacct_lag) calls
+if [ -e "$FAKE_SLURM_DIR/sacct_lag" ]; then
+    lag=$(cat "$FAKE_SLURM_DIR/sacct_lag")
+    if [ "$lag" -gt 0 ]; then
+        echo $((lag - 1)) > "$FAKE_SLURM_DIR/sacct_lag"
+        exit 0
+    fi
+fi
+while [ $# -gt 0 ]; do
+    if [ "$1" = "-j" ]; then ids="$2"; fi
+    shift
+done
+for id in ${ids//,/ }; do
+    if [ -e "$FAKE_SLURM_DIR/$id.exit" ]; then
+        code=$(cat "$FAKE_SLURM_DIR/$id.exit")
+        if [ "$code" = 0 ]; then
+            echo "$id COMPLETED 0:0"
+        else
+            echo "$id FAILED $code:0"
+        fi
+    fi
+done
+"""
+
+
+@pytest.fixture
+def fake_slurm(tmpdir, monkeypatch):
+    """ stand-in sbatch, squeue, sacct and scontrol, running the jobs in the background;
+        returns the file with the calls of the commands
+    """
+    bin_dir = tmpdir.mkdir("fake_slurm")
+    for name, script in [
+        ("sbatch", FAKE_SBATCH),
+        ("squeue", FAKE_SQUEUE),
+        ("sacct", FAKE_SACCT),
+        ("scontrol", FAKE_SCONTROL),
+    ]:
+        cmd = bin_dir / name
+        cmd.write(script)
+        cmd.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir), prepend=os.pathsep)
+    monkeypatch.setenv("FAKE_SLURM_DIR", str(bin_dir))
+    return Path(bin_dir) / "calls"
+
+
+def test_slurm_batched_polling(tmpdir, fake_slurm):
+    """ all the submitted jobs are polled with a single squeue call """
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter("slurm", poll_delay=0.2, arrays=False) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    calls = fake_slurm.read_text().splitlines()
+    assert len([call for call in calls if call.startswith("sbatch")]) == 4
+    polled = [
+        call.split()[-1].split(",") for call in calls if call.startswith("squeue")
+    ]
+    assert max(len(jobids) for jobids in polled) == 4
+    # every job is checked with sacct once it is finished
+    sacct = [call.split()[4].split(",") for call in calls if call.startswith("sacct")]
+    assert sorted(sum(sacct, [])) == sorted(set(sum(polled, [])))
+
+
+def test_slurm_batched_polling_error(tmpdir, fake_slurm):
+    """ a failed job raises the error from the error file of the job """
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with pytest.raises(Exception) as excinfo:
+        with Submitter("slurm", poll_delay=0.2, arrays=False) as sub:
+            sub(task)
+    assert "division by zero" in str(excinfo.value)
+
+
+def test_slurm_polling_errors(tmpdir, fake_slurm, monkeypatch):
+    """ the failed polls are retried, the jobs fail after max_poll_errors """
+    poll_batch = SlurmWorker._poll_batch
+    polls = []
+
+    async def failing_poll_batch(self, jobids):
+        polls.append(jobids)
+        if len(polls) <= 2:
+            raise OSError("slurmctld not responding")
+        return await poll_batch(self, jobids)
+
+    monkeypatch.setattr(SlurmWorker, "_poll_batch", failing_poll_batch)
+    task = add2(name="task", x=1, cache_dir=tmpdir)
+    with Submitter("slurm", poll_delay=0.2, max_poll_errors=3) as sub:
+        sub(task)
+    assert task.result().output.out == 3
+
+    polls.clear()
+    task = add2(name="task", x=2, cache_dir=tmpdir)
+    with pytest.raises(Exception, match="slurmctld not responding"):
+        with Submitter("slurm", poll_delay=0.2, max_poll_errors=2) as sub:
+            sub(task)
+
+
+def test_slurm_accounting_lag(tmpdir, fake_slurm):
+    """ a finished job missing from sacct is pending during accounting_grace """
+    (fake_slurm.parent / "sacct_lag").write_text("2")
+    task = add2(name="task", x=1, cache_dir=tmpdir)
+    with Submitter("slurm", poll_delay=0.2, accounting_grace=30) as sub:
+        sub(task)
+    assert task.result().output.out == 3
+    calls = fake_slurm.read_text().splitlines()
+    assert len([call for call in calls if call.startswith("sacct")]) == 3
+
+    (fake_slurm.parent / "sacct_lag").write_text("2")
+    task = add2(name="task", x=2, cache_dir=tmpdir)
+    with pytest.raises(Exception, match="information not found"):
+        with Submitter("slurm", poll_delay=0.2, accounting_grace=0) as sub:
+            sub(task)
+
+
+def test_slurm_array(tmpdir, fake_slurm):
+    """ the states of a task are submitted as a single job array """
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter("slurm", poll_delay=0.2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    calls = fake_slurm.read_text().splitlines()
+    sbatch = [call for call in calls if call.startswith("sbatch")]
+    assert len(sbatch) == 1
+    assert "--array=0-3" in sbatch[0].split()
+    # every element of the array is checked with sacct once it is finished
+    sacct = [call.split()[4].split(",") for call in calls if call.startswith("sacct")]
+    jobid = sum(sacct, [])[0].split("_")[0]
+    assert sorted(sum(sacct, [])) == [f"{jobid}_{ind}" for ind in range(4)]
+
+
+def test_slurm_array_error(tmpdir, fake_slurm):
+    """ a failed element of an array raises the error from its error file """
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with pytest.raises(Exception) as excinfo:
+        with Submitter("slurm", poll_delay=0.2) as sub:
+            sub(task)
+    assert "division by zero" in str(excinfo.value)
+    # the other element has finished
+    assert task.result()[1].output.out == 2
+
+
+def test_slurm_array_retries(tmpdir, fake_slurm):
+    """ only the failed element of an array is submitted again """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = fail_first(name="task", x=[1, 2, 3], attempts_dir=str(attempts_dir))
+    task.split("x").set_retries(1, delay=0.1)
+    task.cache_dir = tmpdir
+    with Submitter("slurm", poll_delay=0.2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [1, 2, 3]
+    assert attempts(attempts_dir) == {1: 1, 2: 2, 3: 1}
+    calls = fake_slurm.read_text().splitlines()
+    arrays = [re.search(r"--array=(\S+)", call) for call in calls]
+    assert [m.group(1) for m in arrays if m] == ["0-2", "1"]
+
+
+def test_slurm_array_max_jobs(tmpdir, fake_slurm):
+    """ max_jobs limits the running elements of all the arrays """
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter("slurm", poll_delay=0.2, max_jobs=2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    calls = fake_slurm.read_text().splitlines()
+    arrays = [re.search(r"--array=(\S+)", call) for call in calls]
+    arrays = [m.group(1) for m in arrays if m]
+    assert arrays[0] == "0-1"
+    assert sorted(",".join(arrays).replace("-", ",").split(",")) == ["0", "1", "2", "3"]
+
+
+def test_slurm_array_max_size(tmpdir, fake_slurm):
+    """ the states with indices above MaxArraySize are submitted in other arrays """
+    (fake_slurm.parent / "max_array_size").write_text("2")
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4, 5], cache_dir=tmpdir)
+    task.split("x")
+    with Submitter("slurm", poll_delay=0.2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5, 6]
+    calls = fake_slurm.read_text().splitlines()
+    arrays = [re.search(r"--array=(\S+)", call) for call in calls]
+    assert [m.group(1) for m in arrays if m] == ["0-1", "0-1", "0"]
+    # MaxArraySize is read once
+    assert len([call for call in calls if call.startswith("scontrol")]) == 1
+
+
+@pytest.mark.parametrize(
+    "slurm_args", [{"arrays": False}, {}, {"pilots": 1, "pilot_idle_timeout": 1}]
+)
+def test_slurm_retries_exceptions(tmpdir, fake_slurm, slurm_args):
+    """ the failures of the jobs are retried if the task raised
+        one of the exceptions of the policy
+    """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = fail_first(
+        name="task", x=[1, 2], attempts_dir=str(attempts_dir), failures=2
+    )
+    task.split("x").set_retries(3, delay=0.1, retry_on=ValueError)
+    task.cache_dir = tmpdir
+    with pytest.raises(IOError, match="transient failure"):
+        with Submitter("slurm", poll_delay=0.2, **slurm_args) as sub:
+            sub(task)
+    assert attempts(attempts_dir) == {1: 1, 2: 1}
+
+    task.set_retries(3, delay=0.1, retry_on=IOError)
+    with Submitter("slurm", poll_delay=0.2, **slurm_args) as sub:
+        sub(task)
+    assert [res.output.out for res in task.result()] == [1, 2]
+    assert attempts(attempts_dir) == {1: 1, 2: 3}
+
+
+def test_slurm_array_spec():
+    assert SlurmWorker()._array_spec([3, 0, 1, 5, 6, 8]) == "0-1,3,5-6,8"
+    assert SlurmWorker(max_jobs=4)._array_spec([2, 1]) == "1-2"
+
+
+def test_slurm_array_chunks():
+    assert SlurmWorker._array_chunks([3, 0, 1], 1001) == [(0, [0, 1, 3])]
+    assert SlurmWorker._array_chunks([999, 1000, 1001, 2500], 1001) == [
+        (999, [999, 1000, 1001]),
+        (2500, [2500]),
+    ]
+    assert SlurmWorker._array_chunks([5, 3], 4) == [(3, [3, 5])]
+
+
+def test_slurm_pilots(tmpdir, fake_slurm):
+    """ the tasks are run by the pilot jobs, submitted as a single array """
+    wf = Workflow(name="wf", input_spec=["x"], cache_dir=tmpdir)
+    wf.add(sleep_add_one(name="taska", x=wf.lzin.x).split("x"))
+    wf.add(sleep_add_one(name="taskb", x=wf.taska.lzout.out))
+    wf.inputs.x = [1, 2, 3, 4]
+    wf.set_output([("out", wf.taskb.lzout.out)])
+    with Submitter("slurm", poll_delay=0.2, pilots=2, pilot_idle_timeout=1) as sub:
+        sub(wf)
+
+    assert wf.result().output.out == [3, 4, 5, 6]
+    calls = fake_slurm.read_text().splitlines()
+    sbatch = [call for call in calls if call.startswith("sbatch")]
+    assert len(sbatch) == 1
+    assert "--array=0-1" in sbatch[0].split()
+    assert sbatch[0].endswith("pilot.sh")
+    # the tasks are not checked with sacct
+    assert not [call for call in calls if call.startswith("sacct")]
+
+
+def test_slurm_pilots_error(tmpdir, fake_slurm):
+    """ the error of a task run by a pilot job is raised """
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with pytest.raises(Exception) as excinfo:
+        with Submitter("slurm", poll_delay=0.2, pilots=1, pilot_idle_timeout=1) as sub:
+            sub(task)
+    assert "division by zero" in str(excinfo.value)
+
+
+@mark.task
+def kill_first(x, attempts_dir):
+    # the process running the first attempt is killed
+    attempts_file = Path(attempts_dir) / str(x)
+    attempts = int(attempts_file.read_text()) if attempts_file.exists() else 0
+    attempts_file.write_text(str(attempts + 1))
+    if attempts == 0:
+        os.kill(os.getpid(), 9)
+    return x
+
+
+def test_slurm_pilots_killed(tmpdir, fake_slurm):
+    """ the task of a killed pilot job is queued again, once its lease expired """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = kill_first(name="task", x=1, attempts_dir=str(attempts_dir))
+    task.cache_dir = tmpdir
+    with Submitter(
+        "slurm", poll_delay=0.2, pilots=1, pilot_idle_timeout=1, pilot_lease=1
+    ) as sub:
+        sub(task)
+
+    assert task.result().output.out == 1
+    assert attempts(attempts_dir) == {1: 2}
+    # a new pilot job was submitted for the task
+    calls = fake_slurm.read_text().splitlines()
+    assert len([call for call in calls if call.startswith("sbatch")]) == 2
+
+
+def test_slurm_pilots_killed_error(tmpdir, fake_slurm):
+    """ the task fails if the pilot jobs running it keep dying """
+    attempts_dir = Path(tmpdir.mkdir("attempts"))
+    task = kill_first(name="task", x=1, attempts_dir=str(attempts_dir))
+    task.cache_dir = tmpdir
+    with pytest.raises(Exception, match="queued again 0 times"):
+        with Submitter(
+            "slurm",
+            poll_delay=0.2,
+            pilots=1,
+            pilot_idle_timeout=1,
+            pilot_lease=1,
+            pilot_requeues=0,
+        ) as sub:
+            sub(task)
+
+
+FAKE_SUBMIT = r"""#!/bin/bash
+echo "$(basename $0) $@" >> "$FAKE_BATCH_DIR/calls"
+jobid=$$$RANDOM
+script="${@: -1}"
+error=/dev/null
+prev=""
+for arg in "$@"; do
+    if [ "$prev" = "-e" ]; then error="$arg"; fi
+    prev="$arg"
+done
+error="${error//\$JOB_ID/$jobid}"
+error="${error//%J/$jobid}"
+touch "$FAKE_BATCH_DIR/$jobid.running"
+(
+    sh "$script" 2> "$error"
+    echo $? > "$FAKE_BATCH_DIR/$jobid.exit"
+    rm "$FAKE_BATCH_DIR/$jobid.running"
+) > /dev/null 2>&1 &
+"""
+
+FAKE_SGE_QSTAT = r"""#!/bin/bash
+echo "qstat $@" >> "$FAKE_BATCH_DIR/calls"
+echo "job-ID  prior   name  user  state submit/start at     queue      slots"
+echo "-----------------------------------------------------------------------"
+cd "$FAKE_BATCH_DIR"
+for running in *.running; do
+    if [ -e "$running" ]; then
+        echo "${running%.running} 0.55500 task user r 01/01/2020 00:00:00 all.q@node 1"
+    fi
+done
+"""
+
+FAKE_SGE_QACCT = r"""#!/bin/bash
+echo "qacct $@" >> "$FAKE_BATCH_DIR/calls"
+cd "$FAKE_BATCH_DIR"
+for done in *.exit; do
+    if [ -e "$done" ]; then
+        echo "=============================================================="
+        echo "qname        all.q"
+        echo "jobnumber    ${done%.exit}"
+        echo "failed       0"
+        echo "exit_status  $(cat "$done")"
+    fi
+done
+"""
+
+FAKE_PBS_QSTAT = r"""#!/bin/bash
+echo "qstat $@" >> "$FAKE_BATCH_DIR/calls"
+if [ "$1" = "-x" ]; then
+    shift 2
+    for id in "$@"; do
+        if [ -e "$FAKE_BATCH_DIR/$id.exit" ]; then
+            echo "Job Id: $id.server"
+            echo "    Job_Name = task"
+            echo "    job_state = F"
+            echo "    Exit_status = $(cat "$FAKE_BATCH_DIR/$id.exit")"
+            echo
+        fi
+    done
+else
+    echo "Job id            Name             User              Time Use S Queue"
+    echo "----------------  ---------------- ----------------  -------- - -----"
+    for id in "$@"; do
+        if [ -e "$FAKE_BATCH_DIR/$id.running" ]; then
+            echo "$id.server  task  user  00:00:00 R workq"
+        else
+            echo "qstat: $id.server Job has finished, use -x or -H" >&2
+        fi
+    done
+fi
+"""
+
+FAKE_LSF_BJOBS = r"""#!/bin/bash
+echo "bjobs $@" >> "$FAKE_BATCH_DIR/calls"
+fmt="$3"
+shift 3
+for id in "$@"; do
+    code="-"
+    if [ -e "$FAKE_BATCH_DIR/$id.running" ]; then
+        state=RUN
+    elif [ -e "$FAKE_BATCH_DIR/$id.exit" ]; then
+        state=DONE
+        if [ "$(cat "$FAKE_BATCH_DIR/$id.exit")" != 0 ]; then
+            state=EXIT
+            code=$(cat "$FAKE_BATCH_DIR/$id.exit")
+        fi
+    else
+        echo "Job <$id> is not found" >&2
+        continue
+    fi
+    if [ "$fmt" = "jobid stat" ]; then echo "$id $state"; else echo "$id $state $code"; fi
+done
+"""
+
+FAKE_BATCH = {
+    "sge": {
+        "qsub": FAKE_SUBMIT + 'echo "$jobid"\n',
+        "qstat": FAKE_SGE_QSTAT,
+        "qacct": FAKE_SGE_QACCT,
+    },
+    "pbs": {"qsub": FAKE_SUBMIT + 'echo "$jobid.server"\n', "qstat": FAKE_PBS_QSTAT},
+    "lsf": {
+        "bsub": FAKE_SUBMIT + 'echo "Job <$jobid> is submitted to queue <normal>."\n',
+        "bjobs": FAKE_LSF_BJOBS,
+    },
+}
+
+
+@pytest.fixture(params=sorted(FAKE_BATCH))
+def fake_batch(request, tmpdir, monkeypatch):
+    """ stand-in commands of a batch system, running the jobs in the background;
+        returns the plugin and the file with the calls of the commands
+    """
+    bin_dir = tmpdir.mkdir("fake_batch")
+    for name, script in FAKE_BATCH[request.param].items():
+        cmd = bin_dir / name
+        cmd.write(script)
+        cmd.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir), prepend=os.pathsep)
+    monkeypatch.setenv("FAKE_BATCH_DIR", str(bin_dir))
+    return request.param, Path(bin_dir) / "calls"
+
+
+def test_batch_backend(tmpdir, fake_batch):
+    """ the tasks are submitted as jobs, and polled together """
+    plugin, calls_file = fake_batch
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter(plugin, poll_delay=0.2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    calls = calls_file.read_text().splitlines()
+    submit = next(iter(FAKE_BATCH[plugin]))
+    assert len([call for call in calls if call.startswith(submit)]) == 4
+
+
+def test_batch_backend_error(tmpdir, fake_batch):
+    """ a failed job raises the error from the error file of the job """
+    plugin, _ = fake_batch
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with pytest.raises(Exception) as excinfo:
+        with Submitter(plugin, poll_delay=0.2) as sub:
+            sub(task)
+    assert "division by zero" in str(excinfo.value)
+
+
+def test_sge_batched_qacct(tmpdir, monkeypatch):
+    """ the finished SGE jobs are checked with a single qacct call per poll """
+    bin_dir = tmpdir.mkdir("fake_batch")
+    for name, script in FAKE_BATCH["sge"].items():
+        cmd = bin_dir / name
+        cmd.write(script)
+        cmd.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir), prepend=os.pathsep)
+    monkeypatch.setenv("FAKE_BATCH_DIR", str(bin_dir))
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter("sge", poll_delay=0.2) as sub:
+        sub(task)
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    calls = (Path(bin_dir) / "calls").read_text().splitlines()
+    qacct = [call.split() for call in calls if call.startswith("qacct")]
+    qstat = [call for call in calls if call.startswith("qstat")]
+    assert qacct and len(qacct) <= len(qstat)
+    assert all(call[1:4:2] == ["-o", "-b"] and call[-1] == "-j" for call in qacct)
+
+
+def test_dask_states(tmpdir, monkeypatch):
+    """ the states of a task are sent to a LocalCluster with a single map """
+    distributed = pytest.importorskip("distributed")
+    mapped = []
+    client_map = distributed.Client.map
+
+    def map_spy(self, func, *iterables, **kwargs):
+        mapped.append(list(iterables[1]))
+        return client_map(self, func, *iterables, **kwargs)
+
+    monkeypatch.setattr(distributed.Client, "map", map_spy)
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with distributed.LocalCluster(n_workers=2, threads_per_worker=1) as cluster:
+        with Submitter("dask", address=cluster.scheduler_address) as sub:
+            sub(task)
+            # the task scattered to the cluster is released with its last state
+            assert not sub.worker._templates
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    assert mapped == [[0, 1, 2, 3]]
+
+
+def test_dask_states_error(tmpdir):
+    """ the error of a state run by Dask is raised """
+    distributed = pytest.importorskip("distributed")
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with distributed.LocalCluster(n_workers=1, threads_per_worker=1) as cluster:
+        with pytest.raises(Exception) as excinfo:
+            with Submitter("dask", address=cluster.scheduler_address) as sub:
+                sub(task)
+    assert "division by zero" in str(excinfo.value)
+
+
+def gen_dask_wf(cache_dir):
+    wf = Workflow(name="wf", input_spec=["x", "y"], cache_dir=cache_dir)
+    wf.add(add2(name="a", x=wf.lzin.x).split("x"))
+    wf.add(multiply(name="b", x=wf.a.lzout.out, y=wf.lzin.y).split(["_a", "y"]))
+    wf.add(identity(name="c", x=wf.b.lzout.out).combine("a.x"))
+    wf.inputs.x = [1, 2, 3]
+    wf.inputs.y = [10, 100]
+    wf.set_output([("out", wf.c.lzout.out)])
+    return wf
+
+
+def test_dask_compiled_wf(tmpdir, monkeypatch):
+    """ the workflow is run as a single Dask graph,
+        and the nodes found in the cache are pruned when it's run again
+    """
+    distributed = pytest.importorskip("distributed")
+    submitted = []
+    client_submit = distributed.Client.submit
+
+    def submit_spy(self, func, *args, **kwargs):
+        submitted.append(kwargs["key"])
+        return client_submit(self, func, *args, **kwargs)
+
+    monkeypatch.setattr(distributed.Client, "submit", submit_spy)
+    with distributed.LocalCluster(n_workers=2, threads_per_worker=1) as cluster:
+        wf = gen_dask_wf(tmpdir)
+        with Submitter(
+            "dask", address=cluster.scheduler_address, compile_workflows=True
+        ) as sub:
+            sub(wf)
+        assert wf.result().output.out == [[30, 40, 50], [300, 400, 500]]
+        assert sorted(key.split("-")[0] for key in submitted) == ["a", "b", "c"]
+
+        submitted.clear()
+        wf = gen_dask_wf(tmpdir)
+        with Submitter(
+            "dask", address=cluster.scheduler_address, compile_workflows=True
+        ) as sub:
+            sub(wf)
+        assert wf.result().output.out == [[30, 40, 50], [300, 400, 500]]
+        assert submitted == []
+
+
+def test_dask_compiled_wf_error(tmpdir):
+    """ the error of a node is raised """
+    distributed = pytest.importorskip("distributed")
+    wf = Workflow(name="wf", input_spec=["a", "b"], cache_dir=tmpdir)
+    wf.add(fun_div(name="div", a=wf.lzin.a, b=wf.lzin.b).split(("a", "b")))
+    wf.add(identity(name="id", x=wf.div.lzout.out))
+    wf.inputs.a = [1, 2]
+    wf.inputs.b = [0, 1]
+    wf.set_output([("out", wf.id.lzout.out)])
+    with distributed.LocalCluster(n_workers=1, threads_per_worker=1) as cluster:
+        with pytest.raises(Exception) as excinfo:
+            with Submitter(
+                "dask", address=cluster.scheduler_address, compile_workflows=True
+            ) as sub:
+                sub(wf)
+    assert "division by zero" in str(excinfo.value)
+
+
+@pytest.fixture
+def daemons():
+    """ two pydra-worker daemons on localhost, returns their addresses """
+    procs, hosts = [], []
+    for _ in range(2):
+        proc = sp.Popen(
+            [sys.executable, "-m", "pydra.engine.daemon", "--port", "0", "-n", "2"],
+            stdout=sp.PIPE,
+            universal_newlines=True,
+        )
+        procs.append(proc)
+        hosts.append(proc.stdout.readline().split()[-1])
+    yield hosts
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+def test_remote(tmpdir, daemons):
+    """ the tasks are balanced between the daemons """
+    task = sleep_add_one(name="task", x=[1, 2, 3, 4], cache_dir=tmpdir).split("x")
+    with Submitter("remote", hosts=daemons) as sub:
+        sub(task)
+        statuses = sub.loop.run_until_complete(sub.worker.status())
+
+    assert [res.output.out for res in task.result()] == [2, 3, 4, 5]
+    assert [status["finished"] for status in statuses.values()] == [2, 2]
+
+
+def test_remote_wf(tmpdir, daemons):
+    """ a workflow with stateless tasks, a daemon that is not available is skipped """
+    wf = gen_basic_wf()
+    wf.cache_dir = tmpdir
+    with Submitter("remote", hosts=["127.0.0.1:1"] + daemons) as sub:
+        sub(wf)
+    assert wf.result().output.out == 9
+
+
+def test_remote_error(tmpdir, daemons):
+    """ the error of a task run by a daemon is raised (keeping its type) """
+    task = fun_div(name="task", a=[1, 2], b=[0, 1], cache_dir=tmpdir).split(("a", "b"))
+    with pytest.raises(ZeroDivisionError) as excinfo:
+        with Submitter("remote", hosts=daemons) as sub:
+            sub(task)
+    assert "division by zero" in str(excinfo.value)
@@ -56,6 +56,30 @@ def test_checksum():
     )
 
 
+def test_checksum_hash_algorithm():
+    nn = funaddtwo(a=3)
+    sha_checksum = nn.checksum
+    nn.hash_algorithm = "blake2b"
+    assert nn.checksum.startswith("FunctionTask_blake2b-")
+    nn.hash_algorithm = "fast"
+    assert nn.hash_algorithm in ["xxh3", "blake2b"]
+    assert nn.checksum.startswith(f"FunctionTask_{nn.hash_algorithm}-")
+    nn.hash_algorithm = None
+    assert nn.checksum == sha_checksum
+    with pytest.raises(ValueError):
+        nn.hash_algorithm = "md4"
+
+    # the checksums of the states use the algorithm of the task
+    nn = funaddtwo(a=[1, 2]).split("a")
+    sha_checksums = nn.checksum_states()
+    nn.hash_algorithm = "blake2b"
+    checksums = nn.checksum_states()
+    assert all(ch.startswith("FunctionTask_blake2b-") for ch in checksums)
+    assert len(set(checksums)) == 2
+    nn.hash_algorithm = None
+    assert nn.checksum_states() == sha_checksums
+
+
 def test_annotated_func():
     @mark.task
     def testfunc(
@@ -1,15 +1,35 @@
 """Execution workers."""
 import asyncio
+import getpass
+import json
 import sys
 import re
+import weakref
+from time import localtime, strftime, time
 from tempfile import gettempdir
 from pathlib import Path
 from shutil import copyfile
+from uuid import uuid4
 
 import concurrent.futures as cf
+from functools import partial
+import cloudpickle as cp
 
 from .core import TaskBase
-from .helpers import get_available_cpus, read_and_display_async, save, load_and_run
+from .helpers import (
+    get_available_cpus,
+    keep_cwd_in_thread,
+    read_and_display_async,
+    save,
+    load_and_run,
+    load_and_run_batch,
+    load_and_run_result,
+    run_state,
+    run_task,
+    load_result,
+    result_registry,
+)
+from .specs import LazyField, attr_fields
 
 import logging
 
@@ -28,6 +48,70 @@ class Worker:
         """Return coroutine for task execution."""
         raise NotImplementedError
 
+    async def run_with_retries(self, runnable, rerun=False, run_el=None):
+        """
+        Run a task, running it again when it fails, as allowed by its retry policy.
+
+        The task (or the state of a task) is run again if the exception
+        raised by the worker is one of the exceptions of the policy
+        (see :py:meth:`~pydra.engine.core.TaskBase.set_retries`),
+        waiting longer before every new attempt.
+
+        Parameters
+        ----------
+        runnable : :class:`~pydra.engine.core.TaskBase` or :obj:`tuple`
+            Task, or tuple with the index of the state, the task pickle file
+            and the task
+        rerun : :obj:`bool`
+            Passed to the task
+        run_el : callable
+            Function returning the coroutine running the task,
+            :py:meth:`run_el` by default
+
+        """
+        run_el = run_el or self.run_el
+        task = runnable if isinstance(runnable, TaskBase) else runnable[-1]
+        if isinstance(runnable, TaskBase):
+            name = task.name
+        else:
+            name = f"{task.name} (state {runnable[0]})"
+        policy = task._runtime_requirements
+        delay = policy.retry_delay
+        for attempt in range(1, policy.retries + 2):
+            try:
+                return await run_el(runnable, rerun=rerun)
+            except policy.retry_on as e:
+                if attempt > policy.retries:
+                    raise
+                logger.warning(
+                    f"{name} failed ({e}), running it again in {delay} seconds "
+                    f"(retry {attempt} of {policy.retries})"
+                )
+                await asyncio.sleep(delay)
+                delay *= policy.retry_backoff
+
+    @staticmethod
+    def _recorded_error(error, output_dir, since=None):
+        """
+        Return the exception recorded by a task that failed in another process.
+
+        The failures of the tasks run by other processes are reported
+        as generic exceptions, the exception recorded in the error file
+        of the task keeps its type (so it is matched by the retry policy
+        of the task). ``error`` is returned if the task did not record
+        an exception since ``since`` (e.g., the job was killed).
+        """
+        errorfile = Path(output_dir) / "_error.pklz"
+        try:
+            # allowing for the coarse modification times of some file systems
+            if since is not None and errorfile.stat().st_mtime < since - 1:
+                return error
+            with errorfile.open("rb") as fp:
+                recorded = cp.load(fp)["error message"]
+        except Exception:
+            return error
+        return recorded if isinstance(recorded, Exception) else error
+
     def close(self):
         """Close this worker."""
 
@@ -59,14 +143,59 @@ class Worker:
 
 
 class DistributedWorker(Worker):
-    """Base Worker for distributed execution."""
+    """
+    Base Worker for distributed execution.
 
-    def __init__(self, loop=None, max_jobs=None):
-        """Initialize the worker."""
+    The jobs are submitted with :py:attr:`_cmd`, and all the submitted jobs
+    are polled together: the subclasses (the backends) create the commands
+    and parse their outputs.
+    """
+
+    _cmd = None
+    _jobid_re = re.compile(r"\d+")
+    _jobid_patterns = ()
+
+    def __init__(
+        self,
+        loop=None,
+        max_jobs=None,
+        poll_delay=1,
+        max_poll_errors=5,
+        accounting_grace=60,
+        **kwargs,
+    ):
+        """
+        Initialize the worker.
+
+        Parameters
+        ----------
+        max_jobs : int
+            Maximum number of submitted jobs
+        poll_delay : seconds
+            Delay between polls of the submitted jobs
+        max_poll_errors : int
+            Number of consecutive failed polls after which the jobs fail
+        accounting_grace : seconds
+            Time a finished job can be missing from the accounting
+            before it fails
+
+        """
         super().__init__(loop=loop)
         self.max_jobs = max_jobs
         """Maximum number of concurrently running jobs."""
-        self._jobs = 0
+        self._job_slots = None
+        if not poll_delay or poll_delay < 0:
+            poll_delay = 0
+        self.poll_delay = poll_delay
+        """Delay (in seconds) between polls of the submitted jobs."""
+        self.max_poll_errors = max_poll_errors
+        self.accounting_grace = accounting_grace
+        self._missing_since = {}
+        # futures of the submitted jobs by job ID, resolved by the poller
+        self._jobs_waiting = {}
+        self._poller = None
+        # error files of the submitted jobs
+        self.error = {}
 
     def _prepare_runscripts(self, task, interpreter="/bin/sh", rerun=False):
 
@@ -105,43 +234,248 @@ class DistributedWorker(Worker):
             fp.writelines(bcmd)
         return script_dir, batchscript
 
-    async def fetch_finished(self, futures):
+    async def limit_jobs(self, job):
         """
-        Awaits asyncio's :class:`asyncio.Task` until one is finished.
+        Await a job coroutine once a job slot is available.
 
-        Limits number of submissions based on
-        py:attr:`DistributedWorker.max_jobs`.
+        Limits number of running jobs based on
+        py:attr:`DistributedWorker.max_jobs`, the jobs are started
+        in the order they were submitted.
 
         Parameters
         ----------
-        futures : set of asyncio awaitables
-            Task execution coroutines or asyncio :class:`asyncio.Task`
+        job : coroutine
+            Coroutine submitting the job and polling it until completion.
+
+        """
+        if not self.max_jobs:
+            return await job
+        if self._job_slots is None:
+            # created lazily, so it is bound to the running loop
+            self._job_slots = asyncio.Semaphore(self.max_jobs)
+        async with self._job_slots:
+            return await job
+
+    async def wait_for_job(self, jobid):
+        """
+        Wait until the submitted job is finished.
+
+        All the submitted jobs are polled together by a single
+        poller coroutine (see :py:meth:`_poll_jobs`).
 
         Returns
         -------
-        pending : set
-            Pending asyncio :class:`asyncio.Task`.
+        done : :obj:`bool`
+            True, if the job finished successfully (an exception is raised otherwise).
 
         """
-        done, unqueued = set(), set()
-        job_slots = self.max_jobs - self._jobs if self.max_jobs else float("inf")
-        if len(futures) > job_slots:
-            # convert to list to simplify indexing
-            logger.warning(f"Reducing queued jobs due to max jobs ({self.max_jobs})")
-            futures = list(futures)
-            futures, unqueued = set(futures[:job_slots]), set(futures[job_slots:])
-        try:
-            self._jobs += len(futures)
-            done, pending = await asyncio.wait(
-                futures, return_when=asyncio.FIRST_COMPLETED
+        loop = asyncio.get_event_loop()
+        self._jobs_waiting[jobid] = loop.create_future()
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.ensure_future(self._poll_jobs())
+        return await self._jobs_waiting[jobid]
+
+    async def _poll_jobs(self):
+        """
+        Poll all the jobs that are waited for, until there are none left.
+
+        A failed poll is retried at the next interval, the jobs fail
+        after :py:attr:`max_poll_errors` consecutive failed polls.
+        """
+        errors = 0
+        while self._jobs_waiting:
+            jobids = list(self._jobs_waiting)
+            try:
+                statuses = await self._poll_batch(jobids)
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors < self.max_poll_errors:
+                    logger.warning(
+                        f"Polling the jobs failed ({e}), "
+                        f"retrying in {self.poll_delay} seconds"
+                    )
+                    statuses = {}
+                else:
+                    statuses = {jobid: e for jobid in jobids}
+            for jobid, status in statuses.items():
+                if status is False:
+                    continue
+                fut = self._jobs_waiting.pop(jobid)
+                if isinstance(status, Exception):
+                    fut.set_exception(status)
+                else:
+                    fut.set_result(True)
+            if self._jobs_waiting:
+                await asyncio.sleep(self.poll_delay)
+
+    def run_el(self, runnable, rerun=False):
+        """Worker submission API."""
+        script_dir, batch_script = self._prepare_runscripts(runnable, rerun=rerun)
+        if (script_dir / script_dir.parts[1]) == gettempdir():
+            logger.warning("Temporary directories may not be shared across computers")
+
+        if isinstance(runnable, TaskBase):
+            checksum = runnable.checksum
+            cache_dir = runnable.cache_dir
+            name = runnable.name
+        else:
+            checksum = runnable[-1].checksum_states()[runnable[0]]
+            cache_dir = runnable[-1].cache_dir
+            name = runnable[-1].name
+
+        return self.limit_jobs(
+            self._submit_job(
+                batch_script, name=name, checksum=checksum, cache_dir=cache_dir
             )
-        except ValueError:
-            # nothing pending!
-            pending = set()
-        self._jobs -= len(done)
-        logger.debug(f"Tasks finished: {len(done)}")
-        # ensure pending + unqueued tasks persist
-        return pending.union(unqueued)
+        )
+
+    async def _submit_job(self, batchscript, name, checksum, cache_dir):
+        """Coroutine that submits task runscript and polls job until completion or error."""
+        script_dir = cache_dir / f"{self.__class__.__name__}_scripts" / checksum
+        submitted = time()
+        jobid, error_file = await self._submit(
+            batchscript, script_dir, jobname=".".join((name, checksum))
+        )
+        self.error[jobid] = error_file
+        # the job is polled together with the other submitted jobs
+        try:
+            await self.wait_for_job(jobid)
+        except Exception as e:
+            raise self._recorded_error(e, cache_dir / checksum, since=submitted)
+        # the result file was (re)written by the job
+        result_registry.discard(cache_dir / checksum)
+        return True
+
+    async def _submit(self, batchscript, script_dir, jobname, array=None):
+        """
+        Submit the batch script (as a job array if ``array`` is set).
+
+        Returns
+        -------
+        jobid : :obj:`str`
+            ID of the job (of the array).
+        error_file : :obj:`str`
+            Error file of the job, None if set by the user.
+
+        """
+        args, error_file = self._submit_args(
+            batchscript, script_dir, jobname, array=array
+        )
+        # TO CONSIDER: add random sleep to avoid overloading calls
+        _, stdout, _ = await read_and_display_async(self._cmd, *args, hide_display=True)
+        jobid = self._jobid_re.search(stdout)
+        if not jobid:
+            raise RuntimeError("Could not extract job ID")
+        jobid = jobid.group()
+        if error_file:
+            for pattern in self._jobid_patterns:
+                error_file = error_file.replace(pattern, jobid)
+        return jobid, error_file
+
+    async def _poll_batch(self, jobids):
+        """
+        Check the status of the submitted jobs with a single query of the queue.
+
+        The exit codes are checked only for the jobs that left the queue.
+
+        Returns
+        -------
+        statuses : :obj:`dict`
+            For every job ID: False if the job is still pending or running,
+            True if it finished successfully, or the exception of a failed job.
+
+        """
+        logger.debug(f"Polling {len(jobids)} jobs")
+        _, stdout, _ = await read_and_display_async(
+            *self._queue_cmd(jobids), hide_display=True
+        )
+        queued = self._parse_queue(stdout)
+        statuses = {jobid: False for jobid in jobids if jobid in queued}
+        finished = [jobid for jobid in jobids if jobid not in queued]
+        if finished:
+            # jobs are no longer running - check exit codes
+            statuses.update(await self._verify_exit_codes(finished))
+        return statuses
+
+    async def _verify_exit_codes(self, jobids):
+        """
+        Check the exit codes of the jobs that left the queue.
+
+        The jobs missing from the accounting are pending
+        for :py:attr:`accounting_grace` seconds (the accounting can lag
+        behind the queue), they fail after that.
+        """
+        statuses = {}
+        for cmd in self._exit_cmds(jobids):
+            _, stdout, _ = await read_and_display_async(*cmd, hide_display=True)
+            statuses.update(self._parse_exit(stdout))
+        now = time()
+        for jobid in jobids:
+            if jobid in statuses:
+                self._missing_since.pop(jobid, None)
+                continue
+            since = self._missing_since.setdefault(jobid, now)
+            if now - since < self.accounting_grace:
+                statuses[jobid] = False
+            else:
+                del self._missing_since[jobid]
+                statuses[jobid] = RuntimeError(f"Job {jobid} information not found")
+        return {jobid: statuses[jobid] for jobid in jobids}
+
+    def _job_error(self, jobid):
+        """Parse the error message of a failed job."""
+        try:
+            error_line = Path(self.error[jobid]).read_text().split("\n")[-2]
+        except (TypeError, OSError, IndexError):
+            # error file not available
+            error_line = ""
+        if "Exception" in error_line:
+            error_message = error_line.replace("Exception: ", "")
+        elif "Error" in error_line:
+            error_message = error_line.replace("Exception: ", "")
+        else:
+            error_message = "Job failed (unknown reason - TODO)"
+        return error_message
+
+    def _submit_args(self, batchscript, script_dir, jobname, array=None):
+        """
+        Create the arguments of the submission command.
+
+        Returns
+        -------
+        args : :obj:`list`
+            Arguments of :py:attr:`_cmd`.
+        error_file : :obj:`str`
+            Error file of the job, with one of :py:attr:`_jobid_patterns`
+            standing for the job ID (None if set by the user).
+
+        """
+        raise NotImplementedError
+
+    def _queue_cmd(self, jobids):
+        """Return the command listing the jobs that are pending or running."""
+        raise NotImplementedError
+
+    def _parse_queue(self, stdout):
+        """Return the IDs of the jobs that are pending or running."""
+        raise NotImplementedError
+
+    def _exit_cmds(self, jobids):
+        """Return the commands querying the exit codes of the finished jobs."""
+        raise NotImplementedError
+
+    def _parse_exit(self, stdout):
+        """
+        Parse the output of an exit code query.
+
+        Returns
+        -------
+        statuses : :obj:`dict`
+            The statuses of the jobs found in the output (see :py:meth:`_poll_batch`).
+
+        """
+        raise NotImplementedError
 
 
 class SerialPool:
@@ -180,46 +514,323 @@ class SerialWorker(Worker):
 class ConcurrentFuturesWorker(Worker):
     """A worker to execute in parallel using Python's concurrent futures."""
 
-    def __init__(self, n_procs=None):
-        """Initialize Worker."""
+    _executor = cf.ProcessPoolExecutor
+
+    def __init__(self, n_procs=None, mem_gb=None, chunksize=1, timeout=None):
+        """
+        Initialize Worker.
+
+        If a process of the pool dies (e.g., a task is killed when running out
+        of memory), the pool is replaced by a new one, and the tasks that were
+        running in the dead pool are run again, each one alone in the pool,
+        so only the task that kills its process fails.
+
+        Parameters
+        ----------
+        n_procs : :obj:`int`
+            Number of processes (threads) and CPUs used by the worker,
+            all available CPUs by default.
+        mem_gb : :obj:`float`
+            Memory (in GB) available for the tasks,
+            total memory of the system by default.
+        chunksize : :obj:`int`
+            Maximum number of states of a task that are run by a single
+            call in a process (the states submitted together are batched).
+        timeout : :obj:`float`
+            Wall-clock time limit (in seconds) of the tasks that don't set
+            their own (see :py:meth:`~pydra.engine.core.TaskBase.set_resources`),
+            the processes of the pool are killed when a task exceeds it.
+
+        """
         super(ConcurrentFuturesWorker, self).__init__()
         self.n_procs = get_available_cpus() if n_procs is None else n_procs
+        if mem_gb is None:
+            try:
+                from ..utils.profiler import get_system_total_memory_gb
+
+                mem_gb = get_system_total_memory_gb()
+            except Exception:
+                logger.warning("Total memory not available, not limiting memory")
+        self.mem_gb = mem_gb
         # added cpu_count to verify, remove once confident and let PPE handle
-        self.pool = cf.ProcessPoolExecutor(self.n_procs)
+        self.pool = self._executor(self.n_procs)
+        # resources used by the running tasks
+        self._cpus_used = 0
+        self._mem_used = 0
+        self._resources = None
+        self.chunksize = chunksize
+        # states waiting to be run in a batch, by task pickle file
+        self._batches = {}
+        self.timeout = timeout
+        # the pools whose processes were killed after a timeout
+        self._killed_pools = weakref.WeakSet()
         # self.loop = asyncio.get_event_loop()
         logger.debug("Initialize ConcurrentFuture")
 
     def run_el(self, runnable, rerun=False, **kwargs):
         """Run a task."""
         assert self.loop, "No event loop available to submit tasks"
+        if self.chunksize > 1 and not isinstance(runnable, TaskBase):
+            return self.exec_batched(runnable, rerun=rerun)
         return self.exec_as_coro(runnable, rerun=rerun)
 
     async def exec_as_coro(self, runnable, rerun=False):
         """Run a task (coroutine wrapper)."""
         if isinstance(runnable, TaskBase):
-            res = await self.loop.run_in_executor(self.pool, runnable._run, rerun)
+            res = await self._run_in_pool(runnable, runnable._run, rerun)
+            result_registry.put(runnable.output_dir, res)
         else:  # it could be tuple that includes pickle files with tasks and inputs
             ind, task_main_pkl, task_orig = runnable
-            res = await self.loop.run_in_executor(
-                self.pool, load_and_run, task_main_pkl, ind, rerun
+            res, result = await self._run_in_pool(
+                task_orig, load_and_run_result, task_main_pkl, ind, rerun
             )
+            self._register_result(res, result)
         return res
 
+    @staticmethod
+    def _register_result(resultfile, result):
+        """Register the result of a state returned by another process."""
+        if result is None:
+            # the result file was (re)written by another process
+            result_registry.discard(resultfile.parent)
+        else:
+            result_registry.put(resultfile.parent, result)
+
+    async def exec_batched(self, runnable, rerun=False):
+        """
+        Run a state of a task in a batch (coroutine wrapper).
+
+        The states of the same task submitted together are collected in batches
+        of :py:attr:`chunksize` states, every batch is run by a single call.
+        """
+        ind, task_main_pkl, task_orig = runnable
+        key = (task_main_pkl, rerun)
+        if key not in self._batches:
+            self._batches[key] = ([], self.loop.create_future())
+            # the states submitted in the same loop iteration join the batch
+            self.loop.call_soon(self._run_batch, key, task_orig)
+        inds, outcomes = self._batches[key]
+        inds.append(ind)
+        position = len(inds) - 1
+        if len(inds) == self.chunksize:
+            self._run_batch(key, task_orig)
+        outcome = (await outcomes)[position]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def _run_batch(self, key, task_orig):
+        """Start the batch of states (if not started yet)."""
+        if key not in self._batches:
+            return
+        inds, outcomes = self._batches.pop(key)
+        asyncio.ensure_future(self._exec_batch(key, task_orig, inds, outcomes))
+
+    async def _exec_batch(self, key, task_orig, inds, outcomes):
+        task_main_pkl, rerun = key
+        logger.debug(f"Running {len(inds)} states of {task_orig} in a batch")
+        timeout = self._timeout(task_orig)
+        try:
+            try:
+                results = await self._run_in_pool(
+                    task_orig,
+                    load_and_run_batch,
+                    task_main_pkl,
+                    inds,
+                    rerun,
+                    True,
+                    timeout=timeout and timeout * len(inds),
+                    isolate=len(inds) == 1,
+                )
+            except cf.process.BrokenProcessPool:
+                logger.warning(
+                    f"A process died running a batch of {task_orig.name}, "
+                    "the states of the batch are run one by one"
+                )
+                results = await asyncio.gather(
+                    *[
+                        self._run_in_pool(
+                            task_orig, load_and_run_result, task_main_pkl, ind, rerun
+                        )
+                        for ind in inds
+                    ],
+                    return_exceptions=True,
+                )
+        except Exception as e:
+            outcomes.set_exception(e)
+            return
+        outcomes_states = []
+        for outcome in results:
+            if isinstance(outcome, Exception):
+                outcomes_states.append(outcome)
+            else:
+                self._register_result(*outcome)
+                outcomes_states.append(outcome[0])
+        outcomes.set_result(outcomes_states)
+
+    async def _run_in_pool(self, task, func, *args, timeout=None, isolate=True):
+        """
+        Run a function in the pool, with the resources required by the task.
+
+        If the pool breaks, it is respawned and the function is run again.
+        Unless the processes were killed after another task timed out,
+        the function is then run alone in the pool, and an error is raised
+        if the pool breaks again. If ``isolate`` is False,
+        :class:`~concurrent.futures.process.BrokenProcessPool` is raised
+        instead of running the function alone.
+        """
+        if timeout is None:
+            timeout = self._timeout(task)
+        alone = False
+        while True:
+            cpus, mem_gb = await self.acquire_resources(task, exclusive=alone)
+            pool = self.pool
+            try:
+                return await asyncio.wait_for(
+                    self.loop.run_in_executor(pool, func, *args), timeout
+                )
+            except cf.process.BrokenProcessPool:
+                self._respawn(pool)
+                if pool in self._killed_pools:
+                    logger.debug(f"Resubmitting {task.name} to the new pool")
+                elif not isolate:
+                    raise
+                elif alone:
+                    raise RuntimeError(
+                        f"The process running {task.name} died unexpectedly"
+                    )
+                else:
+                    logger.warning(
+                        f"A process of the pool died, {task.name} is run again alone"
+                    )
+                    alone = True
+            except asyncio.TimeoutError:
+                if self._kill(pool):
+                    self._respawn(pool)
+                raise TimeoutError(
+                    f"{task.name} did not finish in {timeout} seconds"
+                ) from None
+            finally:
+                await self.release_resources(cpus, mem_gb)
+
+    def _timeout(self, task):
+        """Return the wall-clock time limit of the task."""
+        timeout = task._runtime_requirements.timeout
+        return self.timeout if timeout is None else timeout
+
+    def _respawn(self, pool):
+        """Replace the broken pool (unless it has already been replaced)."""
+        if pool is self.pool:
+            logger.debug("Respawning the pool of processes")
+            self.pool = self._executor(self.n_procs)
+            pool.shutdown(wait=False)
+
+    def _kill(self, pool):
+        """Kill the processes of the pool, return True if they were killed."""
+        processes = getattr(pool, "_processes", None)
+        if not processes:
+            logger.warning("The timed out task can't be stopped, it keeps running")
+            return False
+        self._killed_pools.add(pool)
+        for process in list(processes.values()):
+            process.kill()
+        return True
+
+    def _requirements(self, task):
+        """Return the CPUs and memory used by the task, limited to the worker's."""
+        requirements = task._runtime_requirements
+        cpus = min(requirements.cpus, self.n_procs)
+        mem_gb = requirements.mem_gb or 0
+        if self.mem_gb is not None:
+            mem_gb = min(mem_gb, self.mem_gb)
+        if (cpus, mem_gb) != (requirements.cpus, requirements.mem_gb or 0):
+            logger.warning(
+                f"{task.name} requires more resources than available, "
+                f"it will run with {cpus} CPUs and {mem_gb} GB"
+            )
+        return cpus, mem_gb
+
+    def _fits(self, cpus, mem_gb):
+        if self._cpus_used + cpus > self.n_procs:
+            return False
+        return self.mem_gb is None or self._mem_used + mem_gb <= self.mem_gb
+
+    async def acquire_resources(self, task, exclusive=False):
+        """
+        Wait until the resources required by the task are free.
+
+        Smaller tasks can start while a larger task is waiting
+        for the running tasks to finish.
+        If ``exclusive`` is True, all the resources of the worker are reserved.
+
+        Returns
+        -------
+        cpus, mem_gb :
+            Resources reserved for the task.
+
+        """
+        if exclusive:
+            cpus, mem_gb = self.n_procs, self.mem_gb or 0
+        else:
+            cpus, mem_gb = self._requirements(task)
+        if self._resources is None:
+            # created lazily, so it is bound to the running loop
+            self._resources = asyncio.Condition()
+        async with self._resources:
+            await self._resources.wait_for(lambda: self._fits(cpus, mem_gb))
+            self._cpus_used += cpus
+            self._mem_used += mem_gb
+        return cpus, mem_gb
+
+    async def release_resources(self, cpus, mem_gb):
+        """Free the resources of a finished task."""
+        async with self._resources:
+            self._cpus_used -= cpus
+            self._mem_used -= mem_gb
+            self._resources.notify_all()
+
     def close(self):
         """Finalize the internal pool of tasks."""
         self.pool.shutdown()
 
 
+class ThreadWorker(ConcurrentFuturesWorker):
+    """
+    A worker to execute in parallel using threads of the current process.
+
+    Suited to tasks that release the GIL (e.g., NumPy or shell commands),
+    the stateless tasks are run without pickling the tasks and the results.
+    The working directory is shared by all the threads: shell commands run
+    concurrently in the output directories of their tasks, the tasks using
+    the working directory (e.g. function tasks) run one at a time in their
+    output directories (see :py:func:`~pydra.engine.helpers.enter_output_dir`).
+    """
+
+    _executor = partial(cf.ThreadPoolExecutor, initializer=keep_cwd_in_thread)
+
+
 class SlurmWorker(DistributedWorker):
     """A worker to execute tasks on SLURM systems."""
 
     _cmd = "sbatch"
+    _jobid_patterns = ("%j", "%A")
     _sacct_re = re.compile(
-        "(?P<jobid>\\d*) +(?P<status>\\w*)\\+? +" "(?P<exit_code>\\d+):\\d+"
+        "(?P<jobid>\\d+(?:_\\d+)?) +(?P<status>\\w*)\\+? +" "(?P<exit_code>\\d+):\\d+"
     )
 
     def __init__(
-        self, loop=None, max_jobs=None, poll_delay=1, sbatch_args=None, **kwargs
+        self,
+        loop=None,
+        max_jobs=None,
+        poll_delay=1,
+        sbatch_args=None,
+        arrays=True,
+        max_array_size=None,
+        pilots=None,
+        pilot_idle_timeout=60,
+        pilot_lease=60,
+        pilot_requeues=2,
+        **kwargs,
     ):
         """
         Initialize SLURM Worker.
@@ -231,105 +842,591 @@ class SlurmWorker(DistributedWorker):
         sbatch_args : str
             Additional sbatch arguments
         max_jobs : int
-            Maximum number of submitted jobs
+            Maximum number of submitted jobs (counting the elements of the arrays)
+        arrays : bool
+            If True, the states of a task submitted together are submitted
+            as job arrays (the index of an element is the state index,
+            offset if the state index reaches ``max_array_size``).
+        max_array_size : int
+            Upper bound of the array indices, MaxArraySize of the SLURM
+            configuration (read with ``scontrol show config``) if not set.
+        pilots : int
+            If set, the tasks are not submitted as jobs, but queued in a directory
+            of the cache and run by at most ``pilots`` long-lived pilot jobs
+            (see :py:func:`~pydra.engine.helpers.run_pilot`).
+        pilot_idle_timeout : seconds
+            Time after which a pilot job without any task to run exits,
+            the pilot jobs are submitted again if new tasks are queued.
+        pilot_lease : seconds
+            Time after which a task is queued again if the pilot job running it
+            stopped renewing its lease (e.g., the pilot was killed).
+        pilot_requeues : int
+            Number of times a task is queued again before it fails.
 
         """
-        super().__init__(loop=loop, max_jobs=max_jobs)
-        if not poll_delay or poll_delay < 0:
-            poll_delay = 0
-        self.poll_delay = poll_delay
+        super().__init__(
+            loop=loop, max_jobs=max_jobs, poll_delay=poll_delay, **kwargs
+        )
         self.sbatch_args = sbatch_args or ""
-        self.error = {}
+        self.arrays = arrays
+        self.max_array_size = max_array_size
+        # states waiting to be submitted in an array, by task pickle file
+        self._arrays = {}
+        self.pilots = pilots
+        self.pilot_idle_timeout = pilot_idle_timeout
+        self.pilot_lease = pilot_lease
+        self.pilot_requeues = pilot_requeues
+        self._requeued = {}
+        self._queue_dir = None
+        self._queued = 0
+        self._pilot_ids = set()
 
     def run_el(self, runnable, rerun=False):
         """Worker submission API."""
-        script_dir, batch_script = self._prepare_runscripts(runnable, rerun=rerun)
-        if (script_dir / script_dir.parts[1]) == gettempdir():
-            logger.warning("Temporary directories may not be shared across computers")
+        if self.pilots:
+            return self._queue_task(runnable, rerun=rerun)
+        if self.arrays and not isinstance(runnable, TaskBase):
+            # every element of an array takes a job slot
+            return self.limit_jobs(self._submit_state(runnable, rerun=rerun))
+        return super().run_el(runnable, rerun=rerun)
 
+    async def _queue_task(self, runnable, rerun=False):
+        """Queue a task (or a state of a task) for the pilot jobs, and wait for it."""
+        script_dir, _ = self._prepare_runscripts(runnable, rerun=rerun)
         if isinstance(runnable, TaskBase):
-            checksum = runnable.checksum
-            cache_dir = runnable.cache_dir
-            name = runnable.name
+            ind, cache_dir = None, runnable.cache_dir
         else:
-            checksum = runnable[-1].checksum_states()[runnable[0]]
-            cache_dir = runnable[-1].cache_dir
-            name = runnable[-1].name
+            ind, cache_dir = runnable[0], runnable[-1].cache_dir
+        if self._queue_dir is None:
+            self._queue_dir = (
+                cache_dir / f"{self.__class__.__name__}_pilots" / uuid4().hex
+            )
+            self._queue_dir.mkdir(parents=True)
+        self._queued += 1
+        jobid = f"task-{self._queued:08d}"
+        queued = time()
+        spec = {"task_pkl": str(script_dir / "_task.pklz"), "ind": ind, "rerun": rerun}
+        # the pilots only see the complete file
+        tmp = self._queue_dir / f"{jobid}.tmp"
+        tmp.write_text(json.dumps(spec))
+        tmp.rename(self._queue_dir / f"{jobid}.json")
+        try:
+            await self.wait_for_job(jobid)
+        except Exception as e:
+            raise self._recorded_error(e, cache_dir / script_dir.name, since=queued)
+        # the result file was (re)written by the pilot
+        result_registry.discard(cache_dir / script_dir.name)
+        return True
+
+    def _poll_queue(self, jobids):
+        """
+        Check the outcomes of the tasks run by the pilot jobs.
 
-        return self._submit_job(
-            batch_script, name=name, checksum=checksum, cache_dir=cache_dir
+        The tasks whose lease has expired are queued again
+        (or fail, after :py:attr:`pilot_requeues` times).
+        """
+        statuses = {}
+        for jobid in jobids:
+            done = self._queue_dir / "done" / f"{jobid}.json"
+            if done.exists():
+                error = json.loads(done.read_text())["error"]
+                statuses[jobid] = True if error is None else Exception(error)
+                continue
+            statuses[jobid] = False
+            running = self._queue_dir / "running" / f"{jobid}.json"
+            try:
+                if time() - running.stat().st_mtime < self.pilot_lease:
+                    continue
+            except OSError:
+                # not claimed by a pilot yet
+                continue
+            requeued = self._requeued.get(jobid, 0)
+            if requeued >= self.pilot_requeues:
+                statuses[jobid] = RuntimeError(
+                    f"The pilot job running {jobid} died "
+                    f"(the task was queued again {requeued} times)"
+                )
+                continue
+            logger.warning(f"The pilot job running {jobid} died, queuing it again")
+            self._requeued[jobid] = requeued + 1
+            try:
+                running.rename(self._queue_dir / f"{jobid}.json")
+            except OSError:
+                # the pilot has just finished it
+                pass
+        return statuses
+
+    async def _start_pilots(self, nr_tasks):
+        """Submit the pilot jobs missing for the tasks left in the queue."""
+        if self._pilot_ids:
+            _, stdout, _ = await read_and_display_async(
+                *self._queue_cmd(self._pilot_ids), hide_display=True
+            )
+            self._pilot_ids &= self._parse_queue(stdout)
+        missing = min(self.pilots, nr_tasks) - len(self._pilot_ids)
+        if missing <= 0:
+            return
+        missing = min(missing, await self._max_array_size())
+        batchscript = self._queue_dir / "pilot.sh"
+        python_string = (
+            f'"from pydra.engine.helpers import run_pilot; '
+            f"run_pilot('{str(self._queue_dir)}', "
+            f"idle_timeout={self.pilot_idle_timeout}, "
+            f'lease={self.pilot_lease})"'
         )
+        bcmd = "\n".join(("#!/bin/sh", f"{sys.executable} -c " + python_string, ""))
+        with batchscript.open("wt") as fp:
+            fp.writelines(bcmd)
+        logger.debug(f"Submitting {missing} pilot jobs")
+        jobid, _ = await self._submit(
+            batchscript,
+            self._queue_dir,
+            jobname="pydra-pilot",
+            array=f"0-{missing - 1}",
+        )
+        self._pilot_ids.update(f"{jobid}_{ind}" for ind in range(missing))
 
-    async def _submit_job(self, batchscript, name, checksum, cache_dir):
-        """Coroutine that submits task runscript and polls job until completion or error."""
-        script_dir = cache_dir / f"{self.__class__.__name__}_scripts" / checksum
+    async def _submit_state(self, runnable, rerun=False):
+        """
+        Submit a state of a task as an element of a job array.
+
+        The states of the same task submitted in the same loop iteration
+        are collected in a single array (split if the state indices do not fit
+        in an array), every element is polled separately.
+        """
+        ind, task_main_pkl, task_orig = runnable
+        key = (task_main_pkl, rerun)
+        if key not in self._arrays:
+            self._arrays[key] = ([], self.loop.create_future())
+            # the states submitted in the same loop iteration join the array
+            self.loop.call_soon(self._start_array, key, task_orig)
+        inds, submitted = self._arrays[key]
+        inds.append(ind)
+        since = time()
+        jobids, checksums = await submitted
+        try:
+            await self.wait_for_job(jobids[ind])
+        except Exception as e:
+            output_dir = task_orig.cache_dir / checksums[ind]
+            raise self._recorded_error(e, output_dir, since=since)
+        # the result file was (re)written by the job
+        result_registry.discard(task_orig.cache_dir / checksums[ind])
+        return True
+
+    def _start_array(self, key, task_orig):
+        """Start the submission of the array (if not started yet)."""
+        if key not in self._arrays:
+            return
+        inds, submitted = self._arrays.pop(key)
+        asyncio.ensure_future(self._submit_array(key, task_orig, inds, submitted))
+
+    async def _submit_array(self, key, task_orig, inds, submitted):
+        task_main_pkl, rerun = key
+        logger.debug(f"Submitting {len(inds)} states of {task_orig} as a job array")
+        # job IDs of the array elements by state index
+        jobids = {}
+        try:
+            max_size = await self._max_array_size()
+            for offset, chunk in self._array_chunks(inds, max_size):
+                script_dir, batch_script = self._prepare_array_runscript(
+                    task_main_pkl, task_orig, offset=offset, rerun=rerun
+                )
+                jobid, error_file = await self._submit(
+                    batch_script,
+                    script_dir,
+                    jobname=".".join((task_orig.name, task_orig.checksum)),
+                    array=self._array_spec([ind - offset for ind in chunk]),
+                )
+                for ind in chunk:
+                    jobids[ind] = f"{jobid}_{ind - offset}"
+                    self.error[jobids[ind]] = (
+                        error_file.replace("%a", str(ind - offset))
+                        if error_file
+                        else None
+                    )
+            checksums = task_orig.checksum_states()
+        except Exception as e:
+            submitted.set_exception(e)
+            return
+        submitted.set_result((jobids, checksums))
+
+    async def _max_array_size(self):
+        """Return the upper bound of the array indices (MaxArraySize)."""
+        if self.max_array_size is None:
+            try:
+                _, stdout, _ = await read_and_display_async(
+                    "scontrol", "show", "config", hide_display=True
+                )
+                self.max_array_size = int(
+                    re.search(r"^MaxArraySize\s*=\s*(\d+)", stdout, re.M).group(1)
+                )
+            except (OSError, AttributeError):
+                # the default of SLURM
+                self.max_array_size = 1001
+        return self.max_array_size
+
+    @staticmethod
+    def _array_chunks(inds, max_size):
+        """
+        Split the state indices into chunks fitting in an array.
+
+        Returns
+        -------
+        chunks : :obj:`list`
+            Pairs of the offset of the array indices (0 if the state indices
+            fit as they are) and the state indices of a chunk.
+
+        """
+        chunks = []
+        for ind in sorted(inds):
+            if chunks and ind - chunks[-1][0] < max_size:
+                chunks[-1].append(ind)
+            else:
+                chunks.append([ind])
+        return [(0 if chunk[-1] < max_size else chunk[0], chunk) for chunk in chunks]
+
+    def _prepare_array_runscript(
+        self, task_main_pkl, task_orig, interpreter="/bin/sh", offset=0, rerun=False
+    ):
+        """Write the batch script running the state given by the array index."""
+        script_dir = (
+            task_orig.cache_dir
+            / f"{self.__class__.__name__}_scripts"
+            / task_orig.checksum
+        )
+        script_dir.mkdir(parents=True, exist_ok=True)
+        task_pkl = script_dir / "_task.pklz"
+        if not task_pkl.exists():
+            copyfile(task_main_pkl, task_pkl)
+        if not task_pkl.stat().st_size:
+            raise Exception("Missing or empty task!")
+        if (script_dir / script_dir.parts[1]) == gettempdir():
+            logger.warning("Temporary directories may not be shared across computers")
+
+        batchscript = script_dir / f"batchscript_array_rerun{rerun}_{offset}.sh"
+        python_string = (
+            f'"from pydra.engine.helpers import load_and_run; '
+            f"load_and_run(task_pkl='{str(task_pkl)}', "
+            f'ind=$((SLURM_ARRAY_TASK_ID + {offset})), rerun={rerun})"'
+        )
+        bcmd = "\n".join(
+            (f"#!{interpreter}", f"{sys.executable} -c " + python_string, "")
+        )
+        with batchscript.open("wt") as fp:
+            fp.writelines(bcmd)
+        return script_dir, batchscript
+
+    def _array_spec(self, inds):
+        """Create the ``--array`` specification of the indices, e.g. 0-3,7."""
+        ranges = []
+        for ind in sorted(inds):
+            if ranges and ranges[-1][1] == ind - 1:
+                ranges[-1][1] = ind
+            else:
+                ranges.append([ind, ind])
+        return ",".join(
+            str(first) if first == last else f"{first}-{last}" for first, last in ranges
+        )
+
+    async def _poll_batch(self, jobids):
+        """Check the jobs with a single squeue call, and a single sacct call."""
+        if self.pilots:
+            statuses = self._poll_queue(jobids)
+            await self._start_pilots(list(statuses.values()).count(False))
+            return statuses
+        return await super()._poll_batch(jobids)
+
+    def _submit_args(self, batchscript, script_dir, jobname, array=None):
         sargs = self.sbatch_args.split()
-        jobname = re.search(r"(?<=-J )\S+|(?<=--job-name=)\S+", self.sbatch_args)
-        if not jobname:
-            jobname = ".".join((name, checksum))
+        if not re.search(r"(?<=-J )\S+|(?<=--job-name=)\S+", self.sbatch_args):
             sargs.append(f"--job-name={jobname}")
+        pattern = "slurm-%A_%a" if array else "slurm-%j"
         output = re.search(r"(?<=-o )\S+|(?<=--output=)\S+", self.sbatch_args)
         if not output:
-            output_file = str(script_dir / "slurm-%j.out")
+            output_file = str(script_dir / f"{pattern}.out")
             sargs.append(f"--output={output_file}")
         error = re.search(r"(?<=-e )\S+|(?<=--error=)\S+", self.sbatch_args)
         if not error:
-            error_file = str(script_dir / "slurm-%j.err")
+            error_file = str(script_dir / f"{pattern}.err")
             sargs.append(f"--error={error_file}")
         else:
             error_file = None
+        if array:
+            sargs.append(f"--array={array}")
         sargs.append(str(batchscript))
-        # TO CONSIDER: add random sleep to avoid overloading calls
-        _, stdout, _ = await read_and_display_async("sbatch", *sargs, hide_display=True)
-        jobid = re.search(r"\d+", stdout)
-        if not jobid:
-            raise RuntimeError("Could not extract job ID")
-        jobid = jobid.group()
-        if error_file:
-            error_file = error_file.replace("%j", jobid)
-        self.error[jobid] = error_file.replace("%j", jobid)
-        # intermittent polling
-        while True:
-            # 3 possibilities
-            # False: job is still pending/working
-            # True: job is complete
-            # Exception: Polling / job failure
-            done = await self._poll_job(jobid)
-            if done:
-                return True
-            await asyncio.sleep(self.poll_delay)
-
-    async def _poll_job(self, jobid):
-        cmd = ("squeue", "-h", "-j", jobid)
-        logger.debug(f"Polling job {jobid}")
-        rc, stdout, stderr = await read_and_display_async(*cmd, hide_display=True)
-        if not stdout or "slurm_load_jobs error" in stderr:
-            # job is no longer running - check exit code
-            status = await self._verify_exit_code(jobid)
-            return status
-        return False
-
-    async def _verify_exit_code(self, jobid):
-        cmd = ("sacct", "-n", "-X", "-j", jobid, "-o", "JobID,State,ExitCode")
-        _, stdout, _ = await read_and_display_async(*cmd, hide_display=True)
-        if not stdout:
-            raise RuntimeError("Job information not found")
-        m = self._sacct_re.search(stdout)
-        error_file = self.error[jobid]
-        if int(m.group("exit_code")) != 0 or m.group("status") != "COMPLETED":
-            if m.group("status") in ["RUNNING", "PENDING"]:
-                return False
-            # TODO: potential for requeuing
-            # parsing the error message
-            error_line = Path(error_file).read_text().split("\n")[-2]
-            if "Exception" in error_line:
-                error_message = error_line.replace("Exception: ", "")
-            elif "Error" in error_line:
-                error_message = error_line.replace("Exception: ", "")
+        return sargs, error_file
+
+    def _queue_cmd(self, jobids):
+        # the elements of the arrays are listed one by one (-r)
+        arrays = sorted({jobid.split("_")[0] for jobid in jobids})
+        return ("squeue", "-h", "-r", "-o", "%i", "-j", ",".join(arrays))
+
+    def _parse_queue(self, stdout):
+        # nothing is listed if some of the jobs are no longer known by slurmctld
+        return set(stdout.split())
+
+    def _exit_cmds(self, jobids):
+        return [
+            (
+                "sacct",
+                "-n",
+                "-X",
+                "-j",
+                ",".join(jobids),
+                "-o",
+                "JobID,State,ExitCode",
+            )
+        ]
+
+    def _parse_exit(self, stdout):
+        statuses = {}
+        for m in self._sacct_re.finditer(stdout):
+            jobid = m.group("jobid")
+            if int(m.group("exit_code")) != 0 or m.group("status") != "COMPLETED":
+                if m.group("status") in ["RUNNING", "PENDING"]:
+                    statuses[jobid] = False
+                else:
+                    # the task is resubmitted if its retry policy allows it
+                    statuses[jobid] = Exception(self._job_error(jobid))
             else:
-                error_message = "Job failed (unknown reason - TODO)"
-            raise Exception(error_message)
-        return True
+                statuses[jobid] = True
+        return statuses
+
+    def close(self):
+        """Let the pilot jobs exit as soon as the queue is empty."""
+        if self._queue_dir is not None:
+            (self._queue_dir / "stop").touch()
+
+
+class SGEWorker(DistributedWorker):
+    """A worker to execute tasks on SGE (Grid Engine) systems."""
+
+    _cmd = "qsub"
+    _jobid_patterns = ("$JOB_ID",)
+    _qacct_re = re.compile(r"^(jobnumber|failed|exit_status)\s+(\d+)", re.M)
+
+    def __init__(
+        self, loop=None, max_jobs=None, poll_delay=1, qsub_args=None, **kwargs
+    ):
+        """
+        Initialize SGE Worker.
+
+        Parameters
+        ----------
+        poll_delay : seconds
+            Delay between polls to qmaster
+        qsub_args : str
+            Additional qsub arguments
+        max_jobs : int
+            Maximum number of submitted jobs
+
+        """
+        super().__init__(
+            loop=loop, max_jobs=max_jobs, poll_delay=poll_delay, **kwargs
+        )
+        self.qsub_args = qsub_args or ""
+        self._submit_times = {}
+
+    def _submit_args(self, batchscript, script_dir, jobname, array=None):
+        qargs = self.qsub_args.split()
+        if "-N" not in qargs:
+            qargs += ["-N", jobname]
+        if "-o" not in qargs:
+            qargs += ["-o", str(script_dir / "sge-$JOB_ID.out")]
+        if "-e" not in qargs:
+            error_file = str(script_dir / "sge-$JOB_ID.err")
+            qargs += ["-e", error_file]
+        else:
+            error_file = None
+        return ["-terse", *qargs, str(batchscript)], error_file
+
+    def _queue_cmd(self, jobids):
+        # qstat doesn't select jobs by ID, all the jobs of the user are listed
+        return ("qstat", "-u", getpass.getuser())
+
+    def _parse_queue(self, stdout):
+        queued = set()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if fields and fields[0].isdigit():
+                queued.add(fields[0])
+        return queued
+
+    async def _submit(self, batchscript, script_dir, jobname, array=None):
+        jobid, error_file = await super()._submit(
+            batchscript, script_dir, jobname, array=array
+        )
+        self._submit_times[jobid] = time()
+        return jobid, error_file
+
+    def _exit_cmds(self, jobids):
+        # qacct -j selects a single job (by ID), so all the jobs of the user
+        # started since the first of the jobs was submitted are listed at once
+        # (with a margin for the clocks of the hosts)
+        since = min(self._submit_times.get(jobid, time()) for jobid in jobids)
+        begin = strftime("%Y%m%d%H%M", localtime(since - 300))
+        return [("qacct", "-o", getpass.getuser(), "-b", begin, "-j")]
+
+    def _parse_exit(self, stdout):
+        statuses = {}
+        # the records are separated by lines of "=", the last record of a job is used
+        for record in re.split(r"^=+$", stdout, flags=re.M):
+            fields = dict(self._qacct_re.findall(record))
+            if "jobnumber" not in fields or "exit_status" not in fields:
+                continue
+            jobid = fields["jobnumber"]
+            if int(fields.get("failed", 0)) or int(fields["exit_status"]):
+                statuses[jobid] = Exception(self._job_error(jobid))
+            else:
+                statuses[jobid] = True
+        return statuses
+
+
+class PBSWorker(DistributedWorker):
+    """A worker to execute tasks on PBS Professional (OpenPBS) systems."""
+
+    _cmd = "qsub"
+
+    def __init__(
+        self, loop=None, max_jobs=None, poll_delay=1, qsub_args=None, **kwargs
+    ):
+        """
+        Initialize PBS Worker.
+
+        Parameters
+        ----------
+        poll_delay : seconds
+            Delay between polls to the PBS server
+        qsub_args : str
+            Additional qsub arguments
+        max_jobs : int
+            Maximum number of submitted jobs
+
+        """
+        super().__init__(
+            loop=loop, max_jobs=max_jobs, poll_delay=poll_delay, **kwargs
+        )
+        self.qsub_args = qsub_args or ""
+
+    def _submit_args(self, batchscript, script_dir, jobname, array=None):
+        # the output files can't contain the job ID, every task has its own directory
+        qargs = self.qsub_args.split()
+        if "-N" not in qargs:
+            qargs += ["-N", jobname]
+        if "-o" not in qargs:
+            qargs += ["-o", str(script_dir / "pbs.out")]
+        if "-e" not in qargs:
+            error_file = str(script_dir / "pbs.err")
+            qargs += ["-e", error_file]
+        else:
+            error_file = None
+        return [*qargs, str(batchscript)], error_file
+
+    def _queue_cmd(self, jobids):
+        return ("qstat", *jobids)
+
+    def _parse_queue(self, stdout):
+        queued = set()
+        for line in stdout.splitlines():
+            # e.g. 123.server  name  user  00:00:00 R workq
+            fields = line.split()
+            jobid = re.match(r"\d+", fields[0]) if fields else None
+            # some servers keep listing the completed jobs
+            if jobid and len(fields) > 4 and fields[4] not in ("C", "F"):
+                queued.add(jobid.group())
+        return queued
+
+    def _exit_cmds(self, jobids):
+        # the finished jobs are listed with -x
+        return [("qstat", "-x", "-f", *jobids)]
+
+    def _parse_exit(self, stdout):
+        statuses = {}
+        for record in re.split(r"^Job Id: ", stdout, flags=re.M):
+            jobid = re.match(r"\d+", record)
+            state = re.search(r"job_state = (\w)", record)
+            if not (jobid and state):
+                continue
+            jobid = jobid.group()
+            exit_status = re.search(r"Exit_status = (-?\d+)", record)
+            if state.group(1) != "F":
+                statuses[jobid] = False
+            elif exit_status and int(exit_status.group(1)) == 0:
+                statuses[jobid] = True
+            else:
+                statuses[jobid] = Exception(self._job_error(jobid))
+        return statuses
+
+
+class LSFWorker(DistributedWorker):
+    """A worker to execute tasks on IBM Spectrum LSF systems."""
+
+    _cmd = "bsub"
+    _jobid_patterns = ("%J",)
+    _queued_states = ("PEND", "PROV", "RUN", "PSUSP", "USUSP", "SSUSP", "WAIT")
+
+    def __init__(
+        self, loop=None, max_jobs=None, poll_delay=1, bsub_args=None, **kwargs
+    ):
+        """
+        Initialize LSF Worker.
+
+        Parameters
+        ----------
+        poll_delay : seconds
+            Delay between polls to the LSF master
+        bsub_args : str
+            Additional bsub arguments
+        max_jobs : int
+            Maximum number of submitted jobs
+
+        """
+        super().__init__(
+            loop=loop, max_jobs=max_jobs, poll_delay=poll_delay, **kwargs
+        )
+        self.bsub_args = bsub_args or ""
+
+    def _submit_args(self, batchscript, script_dir, jobname, array=None):
+        bargs = self.bsub_args.split()
+        if "-J" not in bargs:
+            bargs += ["-J", jobname]
+        if "-o" not in bargs:
+            bargs += ["-o", str(script_dir / "lsf-%J.out")]
+        if "-e" not in bargs:
+            error_file = str(script_dir / "lsf-%J.err")
+            bargs += ["-e", error_file]
+        else:
+            error_file = None
+        return [*bargs, "sh", str(batchscript)], error_file
+
+    def _queue_cmd(self, jobids):
+        return ("bjobs", "-noheader", "-o", "jobid stat", *jobids)
+
+    def _parse_queue(self, stdout):
+        queued = set()
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] in self._queued_states:
+                queued.add(fields[0])
+        return queued
+
+    def _exit_cmds(self, jobids):
+        return [("bjobs", "-noheader", "-o", "jobid stat exit_code", *jobids)]
+
+    def _parse_exit(self, stdout):
+        statuses = {}
+        for line in stdout.splitlines():
+            fields = line.split()
+            if len(fields) != 3:
+                continue
+            jobid, state, _ = fields
+            if state == "DONE":
+                statuses[jobid] = True
+            elif state == "EXIT":
+                statuses[jobid] = Exception(self._job_error(jobid))
+            else:
+                statuses[jobid] = False
+        return statuses
 
 
 class DaskWorker(Worker):
@@ -337,8 +1434,19 @@ class DaskWorker(Worker):
         This is an experimental implementation with limited testing.
     """
 
-    def __init__(self, **kwargs):
-        """Initialize Worker."""
+    def __init__(self, compile_workflows=False, **kwargs):
+        """
+        Initialize Worker.
+
+        Parameters
+        ----------
+        compile_workflows : :obj:`bool`
+            If True, a workflow is sent to the cluster as a single graph
+            of Dask tasks (see :py:meth:`run_workflow`).
+        kwargs :
+            Passed to :class:`dask.distributed.Client`.
+
+        """
         super(DaskWorker, self).__init__()
         try:
             from dask.distributed import Client
@@ -347,22 +1455,398 @@ class DaskWorker(Worker):
             raise
         self.client = None
         self.client_args = kwargs
+        self.compile_workflows = compile_workflows
+        self._client_starting = None
+        # states waiting to be mapped, by task pickle file
+        self._batches = {}
+        # task templates scattered to the cluster, with the number
+        # of their states not finished yet, by task pickle file
+        self._templates = {}
         logger.debug("Initialize Dask")
 
     def run_el(self, runnable, rerun=False, **kwargs):
         """Run a task."""
+        if not isinstance(runnable, TaskBase):
+            return self.exec_state(runnable, rerun=rerun)
         return self.exec_dask(runnable, rerun=rerun)
 
-    async def exec_dask(self, runnable, rerun=False):
-        """Run a task (coroutine wrapper)."""
-        if self.client is None:
+    async def get_client(self):
+        """Start the client (once) in the running loop."""
+        if self._client_starting is None:
             from dask.distributed import Client
 
-            self.client = await Client(**self.client_args, asynchronous=True)
-        future = self.client.submit(runnable._run, rerun)
+            self._client_starting = asyncio.ensure_future(
+                Client(**self.client_args, asynchronous=True)
+            )
+        self.client = await self._client_starting
+        return self.client
+
+    async def exec_dask(self, runnable, rerun=False):
+        """Run a task (coroutine wrapper)."""
+        client = await self.get_client()
+        future = client.submit(runnable._run, rerun)
         result = await future
+        result_registry.put(runnable.output_dir, result)
         return result
 
+    async def exec_state(self, runnable, rerun=False):
+        """
+        Run a state of a task (coroutine wrapper).
+
+        The states of the same task submitted in the same loop iteration
+        are sent with a single ``client.map`` over the state indices,
+        every state is awaited separately.
+        """
+        ind, task_main_pkl, task_orig = runnable
+        key = (task_main_pkl, rerun)
+        if key not in self._batches:
+            self._batches[key] = ([], self.loop.create_future())
+            # the states submitted in the same loop iteration join the map
+            self.loop.call_soon(self._map_batch, key, task_orig)
+        inds, mapped = self._batches[key]
+        inds.append(ind)
+        position = len(inds) - 1
+        futures = await mapped
+        try:
+            res = await futures[position]
+        finally:
+            self._release_template(task_main_pkl)
+        # the result file was (re)written by a worker of the cluster
+        result_registry.discard(res.parent)
+        return res
+
+    def _map_batch(self, key, task_orig):
+        """Start mapping the states (if not started yet)."""
+        if key not in self._batches:
+            return
+        inds, mapped = self._batches.pop(key)
+        asyncio.ensure_future(self._map_states(key, task_orig, inds, mapped))
+
+    async def _map_states(self, key, task_orig, inds, mapped):
+        task_main_pkl, rerun = key
+        logger.debug(f"Mapping {len(inds)} states of {task_orig}")
+        try:
+            client = await self.get_client()
+            if task_main_pkl not in self._templates:
+                # the task is sent to the cluster once, and shared by the states
+                scattered = await client.scatter(task_orig, broadcast=True)
+                self._templates.setdefault(task_main_pkl, [scattered, 0])
+            template = self._templates[task_main_pkl]
+            futures = client.map(
+                run_state, [template[0]] * len(inds), inds, rerun=rerun, pure=False
+            )
+        except Exception as e:
+            mapped.set_exception(e)
+            return
+        template[1] += len(inds)
+        mapped.set_result(futures)
+
+    def _release_template(self, task_main_pkl):
+        """Release the task scattered to the cluster once its states are finished."""
+        template = self._templates[task_main_pkl]
+        template[1] -= 1
+        if not template[1]:
+            del self._templates[task_main_pkl]
+            template[0].release()
+
+    async def run_workflow(self, wf, rerun=False):
+        """
+        Run a stateless workflow as a single graph of Dask tasks.
+
+        Every node is a task that depends on the tasks of the upstream nodes
+        and receives their results (and states), so the dependencies are
+        resolved by the Dask scheduler. The states of a node are mapped from
+        its task. The nodes with all their inputs known before running
+        (e.g., the upstream nodes were in the cache) are checked in the cache,
+        and pruned from the graph if their results are found.
+
+        Parameters
+        ----------
+        wf : :obj:`~pydra.engine.core.Workflow`
+            Stateless workflow with the connections already created,
+            without workflows as nodes
+
+        """
+        from dask.distributed import Future
+
+        client = await self.get_client()
+        # the futures of the nodes, or the results and states of the pruned nodes
+        upstream = {}
+        futures = []
+        for nd in wf.graph_sorted:
+            predecessors = [pred.name for pred in wf.graph.predecessors[nd.name]]
+            if all(not isinstance(upstream[name], Future) for name in predecessors):
+                # the inputs are known, so is the checksum
+                nd.inputs.retrieve_values(wf)
+                nd._checksum = None
+                if not rerun and self._cached(nd):
+                    logger.debug(f"{nd.name} found in the cache")
+                    upstream[nd.name] = (nd.result(), nd.state)
+                    continue
+            else:
+                # the inputs of the workflow are retrieved now
+                nd.inputs.retrieve_values(
+                    wf,
+                    exclude=[
+                        field.name
+                        for field in attr_fields(nd.inputs)
+                        if isinstance(getattr(nd.inputs, field.name), LazyField)
+                        and getattr(nd.inputs, field.name).name != wf.name
+                    ],
+                )
+            upstream[nd.name] = client.submit(
+                self._run_node,
+                nd,
+                {name: upstream[name] for name in predecessors},
+                rerun,
+                key=f"{nd.name}-{uuid4().hex}",
+                pure=False,
+            )
+            futures.append(upstream[nd.name])
+        logger.debug(f"Running {len(futures)} nodes of {wf} as a Dask graph")
+        await client.gather(futures)
+        # setting the inputs of the nodes, so the results can be collected
+        for nd in wf.graph_sorted:
+            if not isinstance(upstream[nd.name], Future):
+                continue
+            nd.inputs.retrieve_values(wf)
+            nd._checksum = None
+            if nd.state:
+                nd.state.prepare_states(nd.inputs)
+                nd.state.prepare_inputs()
+                checksums = nd.checksum_states()
+            else:
+                checksums = [nd.checksum]
+            for checksum in checksums:
+                # the result files were written by the workers of the cluster
+                result_registry.discard(nd.cache_dir / checksum)
+
+    @staticmethod
+    def _cached(task):
+        """Check if the results of the task (and all its states) are in the cache."""
+        if task.state:
+            task.state.prepare_states(task.inputs)
+            task.state.prepare_inputs()
+            checksums = task.checksum_states()
+        else:
+            checksums = [task.checksum]
+        for checksum in checksums:
+            result = load_result(checksum, task.cache_locations)
+            if result is None or result.errored:
+                return False
+        return True
+
+    @staticmethod
+    def _run_node(task, upstream, rerun=False):
+        """
+        Run a node of a workflow in a Dask worker (see :py:meth:`run_workflow`).
+
+        Parameters
+        ----------
+        task : :obj:`~pydra.engine.core.TaskBase`
+            The node, with the inputs connected to the upstream nodes still lazy
+        upstream : :obj:`dict`
+            The results and the states of the upstream nodes
+
+        Returns
+        -------
+        result, state :
+            The result(s) of the node, and its (prepared) state
+
+        """
+        from dask.distributed import worker_client
+
+        values = {}
+        for field in attr_fields(task.inputs):
+            value = getattr(task.inputs, field.name)
+            if isinstance(value, LazyField) and value.name in upstream:
+                values[field.name] = value.get_value_from_result(
+                    upstream[value.name][0]
+                )
+        task.inputs.retrieve_state_values(values)
+        task._checksum = None
+        if not task.state:
+            run_task(task, rerun=rerun)
+            result_registry.discard(task.output_dir)
+            return task.result(), None
+        # the states of the upstream nodes were prepared by their tasks
+        for name, (_, field) in task.state.other_states.items():
+            task.state.other_states[name] = (upstream[name][1], field)
+        task.state.prepare_states(task.inputs)
+        task.state.prepare_inputs()
+        inds = range(len(task.state.states_val))
+        with worker_client() as client:
+            template = client.scatter(task, broadcast=True)
+            client.gather(
+                client.map(
+                    run_state, [template] * len(inds), inds, rerun=rerun, pure=False
+                )
+            )
+        for checksum in task.checksum_states():
+            result_registry.discard(task.cache_dir / checksum)
+        return task.result(), task.state
+
     def close(self):
-        """Finalize the internal pool of tasks."""
-        pass
+        """Release the tasks scattered to the cluster."""
+        for scattered, _ in self._templates.values():
+            scattered.release()
+        self._templates.clear()
+
+
+class RemoteWorker(Worker):
+    """
+    A worker sending the tasks to ``pydra-worker`` daemons on other hosts.
+
+    The tasks are sent to the daemon with the lowest fraction of busy processes
+    (see :class:`~pydra.engine.daemon.WorkerDaemon`), the cache directories
+    have to be shared with the hosts of the daemons.
+    """
+
+    def __init__(self, hosts, token=None, **kwargs):
+        """
+        Initialize Worker.
+
+        Parameters
+        ----------
+        hosts : :obj:`list` of :obj:`str`
+            Addresses of the daemons, as ``host:port``.
+        token : :obj:`str`
+            Token required by the daemons.
+
+        """
+        super().__init__()
+        self.hosts = []
+        for host in hosts:
+            address, _, port = host.rpartition(":")
+            self.hosts.append((address, int(port)))
+        self.token = token
+        # number of processes of the daemons (0 if not available)
+        self._capacity = None
+        self._checking_hosts = None
+        self._running = {host: 0 for host in self.hosts}
+        self._slots = None
+        logger.debug("Initialize RemoteWorker")
+
+    def run_el(self, runnable, rerun=False, **kwargs):
+        """Run a task."""
+        return self.exec_remote(runnable, rerun=rerun)
+
+    async def exec_remote(self, runnable, rerun=False):
+        """Run a task on one of the daemons (coroutine wrapper)."""
+        if isinstance(runnable, TaskBase):
+            task_dir = (
+                runnable.cache_dir
+                / f"{self.__class__.__name__}_tasks"
+                / runnable.checksum
+            )
+            save(task_dir, task=runnable)
+            ind, task_pkl = None, task_dir / "_task.pklz"
+        else:
+            ind, task_pkl, _ = runnable
+        request = {"cmd": "run", "task_pkl": str(task_pkl), "ind": ind, "rerun": rerun}
+        sent = time()
+        while True:
+            host = await self.acquire_host()
+            try:
+                streams = await self._connect(host)
+            except OSError as e:
+                # the task is sent to another daemon
+                logger.warning(f"Daemon {host[0]}:{host[1]} not available: {e}")
+                await self.release_host(host, available=False)
+                continue
+            try:
+                response = await self._request(streams, request)
+            except Exception as e:
+                if isinstance(runnable, TaskBase):
+                    output_dir = runnable.output_dir
+                else:
+                    output_dir = runnable[-1].cache_dir / (
+                        runnable[-1].checksum_states()[ind]
+                    )
+                raise self._recorded_error(e, output_dir, since=sent)
+            finally:
+                await self.release_host(host)
+            break
+        res = Path(response["result"])
+        # the result file was written by the daemon
+        result_registry.discard(res.parent)
+        return res
+
+    async def acquire_host(self):
+        """Wait for a daemon with a free process, and reserve the process."""
+        if self._checking_hosts is None:
+            self._checking_hosts = asyncio.ensure_future(self._check_hosts())
+        await self._checking_hosts
+        async with self._slots:
+            await self._slots.wait_for(
+                lambda: self._free_host() or not any(self._capacity.values())
+            )
+            host = self._free_host()
+            if host is None:
+                raise RuntimeError("No pydra-worker daemon available")
+            self._running[host] += 1
+        return host
+
+    async def release_host(self, host, available=True):
+        """Free the process reserved on the daemon."""
+        async with self._slots:
+            self._running[host] -= 1
+            if not available:
+                self._capacity[host] = 0
+            self._slots.notify_all()
+
+    def _free_host(self):
+        hosts = [
+            host for host in self.hosts if self._running[host] < self._capacity[host]
+        ]
+        if not hosts:
+            return None
+        return min(hosts, key=lambda host: self._running[host] / self._capacity[host])
+
+    async def _check_hosts(self):
+        """Get the number of processes of every daemon."""
+        self._slots = asyncio.Condition()
+        self._capacity = {}
+        for host in self.hosts:
+            try:
+                status = await self._request(
+                    await self._connect(host), {"cmd": "status"}
+                )
+                self._capacity[host] = status["n_procs"]
+            except OSError as e:
+                logger.warning(f"Daemon {host[0]}:{host[1]} not available: {e}")
+                self._capacity[host] = 0
+
+    async def status(self):
+        """Return the status of every daemon (None if not available)."""
+        statuses = {}
+        for host in self.hosts:
+            try:
+                status = await self._request(
+                    await self._connect(host), {"cmd": "status"}
+                )
+            except OSError:
+                status = None
+            statuses[f"{host[0]}:{host[1]}"] = status
+        return statuses
+
+    async def _connect(self, host):
+        return await asyncio.open_connection(*host)
+
+    async def _request(self, streams, request):
+        """Send the request to a daemon, and wait for the response."""
+        reader, writer = streams
+        if self.token:
+            request = dict(request, token=self.token)
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            line = await reader.readline()
+        finally:
+            writer.close()
+        if not line:
+            raise RuntimeError("Connection to the daemon lost")
+        response = json.loads(line)
+        if "error" in response:
+            raise Exception(response["error"])
+        return response